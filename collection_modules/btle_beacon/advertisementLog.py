@@ -0,0 +1,266 @@
+"""
+Advertisement log
+Keeps every detection as a fixed width binary record, for dwell time
+and traffic analysis over days of observations.
+
+The log is a directory of segment files, each an 8 byte header,
+LOG_MAGIC, followed by RECORD_DTYPE records:
+
+    ts      int64   wall clock time, ns since the epoch
+    mac     uint64  MAC as a little endian int, int(hex mac, 16)
+    uuid    uint16  index in the uuid table
+    major   uint16
+    minor   uint16
+    rssi    int8
+    tx      int8
+
+The uuid table, uuids.bin in the same directory, holds the raw 16
+byte UUIDs in the order they were first seen, UUIDs after the first
+65535 are all logged as OTHER_UUID. A new segment is started every
+segment interval and the oldest are deleted past max segments.
+
+AdvertisementLog packs records into a buffer that is written out
+on flush, AdvertisementLogReader memory maps the segments as NumPy
+structured arrays:
+
+    reader = AdvertisementLogReader('/var/log/beacons')
+    seen = reader.query(start=datetime(2026, 10, 1), mac='C4A1B2C3D4E5')
+    dwell = seen['ts'].max() - seen['ts'].min()
+"""
+
+from simplesensor.shared import ThreadsafeLogger
+from threading import Lock
+from datetime import datetime
+import numpy as np
+import os
+import struct
+import time
+
+LOG_MAGIC = b'BGADV\x00\x01\x00'
+
+RECORD_DTYPE = np.dtype([
+    ('ts', '<i8'),
+    ('mac', '<u8'),
+    ('uuid', '<u2'),
+    ('major', '<u2'),
+    ('minor', '<u2'),
+    ('rssi', 'i1'),
+    ('tx', 'i1')])
+
+# the raw MAC and 2 zero bytes read as the little endian mac field
+_RECORD = struct.Struct('<q6s2xHHHbb')
+assert _RECORD.size == RECORD_DTYPE.itemsize
+
+OTHER_UUID = 0xFFFF
+
+_SEGMENT_PREFIX = 'adv-'
+_SEGMENT_SUFFIX = '.seg'
+_UUID_FILE = 'uuids.bin'
+# buffered bytes written out without waiting for the next flush
+_MAX_BUFFER = 1 << 20
+
+def segmentStart(name):
+    """ Wall clock ns a segment file was started at, from its name. """
+    return int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)])
+
+def listSegments(directory):
+    """ Segment file names, oldest first. """
+    return sorted(name for name in os.listdir(directory)
+        if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX))
+
+class AdvertisementLog(object):
+    """
+    Appends detections to the segment files of a directory.
+    Thread safe, every device thread can write to it.
+    """
+
+    def __init__(self, directory, segmentInterval, maxSegments, loggingQueue):
+        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.directory = directory
+        self.segmentInterval = segmentInterval*1000000
+        self.maxSegments = maxSegments
+        self.lock = Lock()
+        self.records = 0
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.uuidPath = os.path.join(directory, _UUID_FILE)
+        self.uuids = {}
+        if os.path.exists(self.uuidPath):
+            with open(self.uuidPath, 'rb') as f:
+                table = f.read()
+            for index in range(len(table)//16):
+                self.uuids[table[index*16:index*16 + 16]] = index
+
+        self.buffer = bytearray()
+        self.file = None
+        self.segmentEnd = 0
+        self.openSegment()
+
+    def openSegment(self, timestamp=None):
+        """
+        Start a new segment at the monotonic timestamp of its first
+        record, or now. Called with the lock held or from __init__.
+        """
+        if self.file is not None:
+            self.file.write(self.buffer)
+            self.buffer.clear()
+            self.file.close()
+        # monotonic detection timestamps to wall clock, taken again
+        # for every segment so the log follows NTP corrections
+        self.offset = time.time_ns() - time.monotonic_ns()
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        start = timestamp + self.offset
+        self.segmentEnd = start + self.segmentInterval
+        path = os.path.join(self.directory, '%s%020i%s'%(_SEGMENT_PREFIX, start, _SEGMENT_SUFFIX))
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(LOG_MAGIC)
+        self.logger.info("Advertisement log segment %s"%path)
+
+        if self.maxSegments > 0:
+            for name in listSegments(self.directory)[:-self.maxSegments]:
+                os.remove(os.path.join(self.directory, name))
+
+    def uuidIndex(self, uuid):
+        """ Index of a new uuid, added to the table file right away. """
+        index = len(self.uuids)
+        if index >= OTHER_UUID:
+            return OTHER_UUID
+        with open(self.uuidPath, 'ab') as f:
+            f.write(uuid)
+        self.uuids[uuid] = index
+        return index
+
+    def write(self, detection):
+        self.writeMany((detection,))
+
+    def writeMany(self, detections):
+        pack = _RECORD.pack
+        with self.lock:
+            if self.closed:
+                # readers still finishing during shut down
+                return
+            uuids = self.uuids
+            offset = self.offset
+            segmentEnd = self.segmentEnd
+            buffer = self.buffer
+            for (mac, uuid, major, minor, tx, rssi, timestamp,
+                    deviceId, count, rssiMin, rssiMax, rssiMean) in detections:
+                ts = timestamp + offset
+                if ts >= segmentEnd:
+                    self.openSegment(timestamp)
+                    offset, segmentEnd = self.offset, self.segmentEnd
+                    ts = timestamp + offset
+                uuidIndex = uuids.get(uuid)
+                if uuidIndex is None:
+                    uuidIndex = self.uuidIndex(uuid)
+                buffer += pack(ts, mac, uuidIndex, major, minor, rssi, tx)
+            self.records += len(detections)
+            if len(buffer) >= _MAX_BUFFER:
+                self.file.write(buffer)
+                buffer.clear()
+
+    def flush(self):
+        """ Write out the buffered records, run periodically. """
+        with self.lock:
+            if self.closed:
+                return
+            if time.monotonic_ns() + self.offset >= self.segmentEnd:
+                self.openSegment()
+            self.file.write(self.buffer)
+            self.buffer.clear()
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.file.write(self.buffer)
+            self.buffer.clear()
+            self.file.close()
+
+class AdvertisementLogReader(object):
+    """
+    Reads an advertisement log directory. Segments are memory
+    mapped, nothing is read until the records are used.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def uuids(self):
+        """ The uuid table, raw 16 byte UUIDs by index. """
+        path = os.path.join(self.directory, _UUID_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'rb') as f:
+            table = f.read()
+        return [table[i:i + 16] for i in range(0, len(table) - 15, 16)]
+
+    def segments(self, start=None, end=None):
+        """ Paths of the segments holding records from start to end, ns. """
+        names = listSegments(self.directory)
+        starts = [segmentStart(name) for name in names]
+        paths = []
+        for i, name in enumerate(names):
+            # a segment ends where the next one starts
+            if end is not None and starts[i] >= end:
+                continue
+            if start is not None and i + 1 < len(names) and starts[i + 1] <= start:
+                continue
+            paths.append(os.path.join(self.directory, name))
+        return paths
+
+    def segment(self, path):
+        """ Records of one segment, a partly written last record is left out. """
+        count = (os.path.getsize(path) - len(LOG_MAGIC))//RECORD_DTYPE.itemsize
+        if count <= 0:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        with open(path, 'rb') as f:
+            if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                raise ValueError("%s is not an advertisement log segment"%path)
+        return np.memmap(path, dtype=RECORD_DTYPE, mode='r',
+            offset=len(LOG_MAGIC), shape=(count,))
+
+    def query(self, start=None, end=None, mac=None, uuid=None):
+        """
+        Records with start <= ts < end, of one MAC and one UUID
+        when given. Times are datetimes or ns since the epoch, the
+        MAC is hex or raw over the air bytes, the UUID raw bytes.
+        """
+        start, end = toNs(start), toNs(end)
+        if isinstance(mac, str):
+            mac = int(mac.replace(':', ''), 16)
+        elif isinstance(mac, bytes):
+            mac = int.from_bytes(mac, 'little')
+        if uuid is not None:
+            table = self.uuids()
+            if uuid not in table:
+                return np.empty(0, dtype=RECORD_DTYPE)
+            uuid = table.index(uuid)
+
+        parts = []
+        for path in self.segments(start, end):
+            records = self.segment(path)
+            mask = np.ones(len(records), dtype=bool)
+            if start is not None:
+                mask &= records['ts'] >= start
+            if end is not None:
+                mask &= records['ts'] < end
+            if mac is not None:
+                mask &= records['mac'] == mac
+            if uuid is not None:
+                mask &= records['uuid'] == uuid
+            parts.append(records[mask])
+        if not parts:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        return np.concatenate(parts)
+
+def toNs(value):
+    """ datetime, or ns since the epoch, to ns since the epoch. """
+    if isinstance(value, datetime):
+        return int(value.timestamp()*1000000)*1000
+    return value
@@ -0,0 +1,78 @@
+"""
+Advertisement log benchmark
+Times logging detections with AdvertisementLog in the batches the
+device thread hands over, against handing them on without a log, and
+then queries the log by time range and by MAC with
+AdvertisementLogReader.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.advertisementLogBenchmark --detections 1000000
+"""
+
+import argparse
+import queue
+import random
+import shutil
+import tempfile
+import time
+from ..advertisementLog import AdvertisementLog, AdvertisementLogReader
+from ..devices import DetectionData
+from .registryBenchmark import detections
+
+# detections parsed from one serial read
+_BATCH = 20
+
+def timeBatches(handle, batches):
+    start = time.perf_counter()
+    for batch in batches:
+        handle(batch)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--detections', type=int, default=1000000)
+    parser.add_argument('--beacons', type=int, default=1000)
+    parser.add_argument('--segments', type=int, default=4)
+    args = parser.parse_args()
+
+    rand = random.Random(0)
+    macs = ['%012X'%rand.getrandbits(48) for _ in range(args.beacons)]
+    # spread over the segments, a minute each
+    segmentInterval = 60000
+    step = args.segments*segmentInterval*1000000//args.detections
+    now = time.monotonic_ns()
+    stream = [DetectionData.fromFields(detection[:6] + (now + i*step,) + detection[7:])
+        for i, detection in enumerate(detections(macs, args.detections))]
+    batches = [stream[i:i + _BATCH] for i in range(0, len(stream), _BATCH)]
+
+    directory = tempfile.mkdtemp()
+    try:
+        log = AdvertisementLog(directory, segmentInterval, 0, queue.Queue())
+        baseline = timeBatches(lambda batch: None, batches)
+        elapsed = timeBatches(log.writeMany, batches)
+        start = time.perf_counter()
+        log.close()
+        elapsed += time.perf_counter() - start
+        print('write     %8.0f ns per detection, %i records' % (
+            (elapsed - baseline) / args.detections * 1e9, log.records))
+
+        reader = AdvertisementLogReader(directory)
+        start = time.perf_counter()
+        records = reader.query()
+        print('read all  %8.2f ms, %i records in %i segments' % (
+            (time.perf_counter() - start) * 1000, len(records), len(reader.segments())))
+        middle = int(records['ts'][len(records)//2])
+        start = time.perf_counter()
+        recent = reader.query(start=middle)
+        print('time      %8.2f ms, %i records from the middle on' % (
+            (time.perf_counter() - start) * 1000, len(recent)))
+        start = time.perf_counter()
+        one = reader.query(mac=macs[0])
+        print('mac       %8.2f ms, %i records of %s' % (
+            (time.perf_counter() - start) * 1000, len(one), macs[0]))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Decoder benchmark
+Times iBeacon decoding and filtering per advertisement over a corpus
+of iBeacon and non-iBeacon payloads, comparing the previous inline
+decode in DeviceThread.scanCallback with IBeaconDecoder.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.decoderBenchmark
+"""
+
+import argparse
+import time
+from ..devices import IBeaconDecoder
+from . import streams
+
+_ESTIMOTE_UUID = bytes.fromhex('B9407F30F5F8466EAFF925556B57FE6D')
+_KONTAKT_UUID = bytes.fromhex('F7826DA64FA24E988024BC5B71E0893E')
+
+# advertisement data as seen in scan responses at a venue
+CORPUS = {
+    'ibeacon_estimote': streams.buildIBeaconData(_ESTIMOTE_UUID, 100, 10, -74),
+    'ibeacon_kontakt': streams.buildIBeaconData(_KONTAKT_UUID, 1, 2, -59),
+    'eddystone_uid': bytes.fromhex('0201060303AAFE1516AAFE00E8EDD5D0C9A8AB0B2B44B0F8000000000001'),
+    'apple_nearby': bytes.fromhex('02011A0AFF4C0010050318A5D2AB'),
+    'microsoft_cdp': bytes.fromhex('1EFF0600010920020A8F1E9A6C5DC3B41B7A8B3E6E1F0C6A2A30C52B5EBA87'),
+    'flags_only': bytes.fromhex('020106'),
+    'scan_rsp_name': bytes.fromhex('0B094A424C5F53656E736F72'),
+}
+
+def legacyDecode(data, uuidFocusList, filterOnUuid, majorMin, majorMax, minorMin, minorMax):
+    """ The decode DeviceThread.scanCallback used before IBeaconDecoder. """
+    if len(data) > 15:
+        try:
+            majorNumber = data[26] | (data[25] << 8)
+        except:
+            majorNumber = 0
+        try:
+            minorNumber = data[28] | (data[27] << 8)
+        except:
+            minorNumber = 0
+        try:
+            udid = "%s" % ''.join(['%02X' % b for b in data[9:25]])
+        except:
+            pass
+        if (filterOnUuid and udid not in uuidFocusList):
+            return None
+        if (not (majorMin <= majorNumber <= majorMax) or
+            not (minorMin <= minorNumber <= minorMax)):
+                return None
+        if len(data) > 29:
+            rawTxPower = data[29]
+        else:
+            rawTxPower = 0
+        txPower = rawTxPower if rawTxPower <= 127 else rawTxPower - 256
+        return udid, majorNumber, minorNumber, txPower
+    return None
+
+def timeLegacy(payloads, rounds, focus):
+    uuidFocusList = [u.hex().upper() for u in focus] if focus else ['any']
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for data in payloads:
+            legacyDecode(data, uuidFocusList, bool(focus), 0, 9999, 0, 99999)
+    return time.perf_counter() - start
+
+def timeDecoder(payloads, rounds, focus):
+    decoder = IBeaconDecoder(focus, 0, 9999, 0, 99999)
+    decode = decoder.decode
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for data in payloads:
+            beacon = decode(data)
+            if beacon is not None:
+                # formatting is part of the cost for accepted packets
+                beacon[0].hex().upper()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=100000)
+    args = parser.parse_args()
+
+    for focusName, focus in (('no focus list', None), ('estimote focus', [_ESTIMOTE_UUID])):
+        print(focusName)
+        for name, data in sorted(CORPUS.items()):
+            legacy = timeLegacy([data], args.rounds, focus)
+            decoder = timeDecoder([data], args.rounds, focus)
+            print('  %-18s legacy %7.0f ns  decoder %7.0f ns  accepted %s' % (
+                name,
+                legacy / args.rounds * 1e9,
+                decoder / args.rounds * 1e9,
+                IBeaconDecoder(focus, 0, 9999, 0, 99999).decode(data) is not None))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Event benchmark
+Times firing a BGAPIEvent with 0, 1 and 3 subscribers, as
+`obj.event(earg)` is written in BGLib and the registry, against the previous implementation that made a handler
+object and looked up the function list on every access.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.eventBenchmark --fires 200000
+"""
+
+import argparse
+import timeit
+from ..devices.bluegiga.bglib import BGAPIEvent
+
+class LegacyEvent(object):
+    """ The event descriptor BGAPIEvent replaced. """
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return LegacyEventHandler(self, obj)
+
+    def __set__(self, obj, value):
+        pass
+
+class LegacyEventHandler(object):
+
+    def __init__(self, event, obj):
+        self.event = event
+        self.obj = obj
+
+    def _getfunctionlist(self):
+        try:
+            eventhandler = self.obj.__eventhandler__
+        except AttributeError:
+            eventhandler = self.obj.__eventhandler__ = {}
+        return eventhandler.setdefault(self.event, [])
+
+    def add(self, func):
+        self._getfunctionlist().append(func)
+        return self
+
+    def fire(self, earg=None):
+        for func in self._getfunctionlist():
+            func(self.obj, earg)
+
+    __iadd__ = add
+    __call__ = fire
+
+def source(eventType):
+    class Source(object):
+        event = eventType()
+    return Source()
+
+def handler(sender, earg):
+    pass
+
+def timeFire(eventType, subscribers, fires):
+    obj = source(eventType)
+    for _ in range(subscribers):
+        obj.event += handler
+    fire = lambda: obj.event(None)
+    return min(timeit.repeat(fire, number=fires, repeat=5)) / fires * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fires', type=int, default=200000)
+    args = parser.parse_args()
+
+    print('%-14s %12s %12s %12s' % ('event', '0 handlers', '1 handler', '3 handlers'))
+    for name, eventType in (
+            ('legacy', LegacyEvent),
+            ('BGAPIEvent', BGAPIEvent)):
+        print('%-14s %9.0f ns %9.0f ns %9.0f ns' % ((name,) + tuple(
+            timeFire(eventType, subscribers, args.fires) for subscribers in (0, 1, 3))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Fake dongle
+A pty pair standing in for a BLED112, so the device thread can open it
+like a real serial port.
+"""
+
+import os
+import pty
+import tty
+from threading import Thread
+from ..devices.bluegiga.capture import commandResponse
+
+class FakeDongle(object):
+    """
+    Answers every BGAPI command written to the port with a successful
+    response, and writes whatever is handed to write() back to the host.
+    """
+
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+        self.commands = []
+        self.alive = True
+        self.thread = Thread(target=self.answerCommands, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def answerCommands(self):
+        buffer = b''
+        while self.alive:
+            try:
+                buffer += os.read(self.master, 4096)
+            except OSError:
+                return
+            while len(buffer) >= 4:
+                length = 4 + (buffer[0] & 0x07) + buffer[1]
+                if len(buffer) < length:
+                    break
+                packetClass, packetCommand = buffer[2], buffer[3]
+                buffer = buffer[length:]
+                self.commands.append((packetClass, packetCommand))
+                self.write(commandResponse(packetClass, packetCommand))
+
+    def close(self):
+        self.alive = False
+        os.close(self.slave)
+        os.close(self.master)
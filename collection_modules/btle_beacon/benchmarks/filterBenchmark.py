@@ -0,0 +1,128 @@
+"""
+Filter benchmark
+Checks FilterBank against the pykalman filter it replaced and times
+both per sample. Exits non-zero when the filtered states disagree.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.filterBenchmark
+"""
+
+import argparse
+import random
+import sys
+import time
+from ..registry.filter import Filter, FilterBank
+
+class PykalmanFilter(object):
+    """ The previous Filter implementation. """
+
+    def __init__(self, first_obs):
+        from pykalman import KalmanFilter
+        self.state = first_obs
+        self.measurements = [first_obs]
+        self.kf = KalmanFilter(
+            initial_state_mean=0,
+            n_dim_state=1,
+            observation_covariance=0.8)
+
+    def update(self, rssi):
+        self.measurements = self.measurements[-5:]
+        self.measurements.append(rssi)
+        means, covariances = self.kf.filter(self.measurements)
+        self.state, self.covariance = self.kf.filter_update(
+            means[-1], covariances[-1], [rssi])
+        self.state = self.state[0]
+        self.covariance = self.covariance[0][0]
+
+def samples(clients, count, seed=1):
+    """ (client, rssi) samples for a random walk per client. """
+    rand = random.Random(seed)
+    levels = [rand.randint(-90, -40) for _ in range(clients)]
+    result = []
+    for _ in range(count):
+        client = rand.randrange(clients)
+        levels[client] = max(-100, min(-30, levels[client] + rand.randint(-4, 4)))
+        result.append((client, levels[client]))
+    return result
+
+def checkAccuracy(clients, count, batchSize):
+    """
+    Return the largest difference between pykalman and the bank,
+    updating one sample at a time and in batches.
+    """
+    stream = samples(clients, count)
+    reference, filters, batched = {}, {}, {}
+    bank, batchBank = FilterBank(4), FilterBank(4)
+    worst = 0.0
+    for i, (client, rssi) in enumerate(stream):
+        if i % batchSize == 0:
+            batchBank.endBatch()
+            batchBank.beginBatch()
+        if client not in reference:
+            reference[client] = PykalmanFilter(rssi)
+            filters[client] = Filter(rssi, bank)
+            batched[client] = Filter(rssi, batchBank)
+        reference[client].update(rssi)
+        filters[client].update(rssi)
+        batched[client].update(rssi)
+        worst = max(worst,
+            abs(reference[client].state - filters[client].state),
+            abs(reference[client].covariance - filters[client].covariance))
+    batchBank.endBatch()
+    for client in reference:
+        worst = max(worst, abs(reference[client].state - batched[client].state))
+    return worst
+
+def timeReference(stream):
+    filters = {}
+    start = time.perf_counter()
+    for client, rssi in stream:
+        if client not in filters:
+            filters[client] = PykalmanFilter(rssi)
+        filters[client].update(rssi)
+    return time.perf_counter() - start
+
+def timeBank(stream, batchSize):
+    bank = FilterBank()
+    filters = {}
+    start = time.perf_counter()
+    if batchSize <= 1:
+        for client, rssi in stream:
+            if client not in filters:
+                filters[client] = Filter(rssi, bank)
+            filters[client].update(rssi)
+    else:
+        for i in range(0, len(stream), batchSize):
+            bank.beginBatch()
+            for client, rssi in stream[i:i + batchSize]:
+                if client not in filters:
+                    filters[client] = Filter(rssi, bank)
+                filters[client].update(rssi)
+            bank.endBatch()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--tolerance', type=float, default=1e-6)
+    args = parser.parse_args()
+
+    worst = checkAccuracy(50, 5000, args.batch)
+    print('largest difference from pykalman: %g' % worst)
+
+    stream = samples(args.clients, args.samples)
+    for name, elapsed in (
+            ('pykalman', timeReference(stream)),
+            ('bank', timeBank(stream, 1)),
+            ('bank batched', timeBank(stream, args.batch))):
+        print('%-13s %8.2f us/sample' % (name, elapsed / len(stream) * 1e6))
+
+    if worst > args.tolerance:
+        print('FAIL: filtered state differs from pykalman by more than %g' % args.tolerance)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Logging benchmark
+Times the per sample client range log (show_client_range_debug) the way
+it used to be written, a dozen ThreadsafeLogger.debug calls each formatting
+its line, against BtleClient.logClientRange through ModuleLogger at INFO,
+at DEBUG sampled once per beacon per second and at DEBUG unsampled. Then
+times registering detections through the event manager with every debug
+flag on, at INFO and at DEBUG. Logs go to a multiprocessing queue drained
+by a thread, as they do in the collection point.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.loggingBenchmark --samples 20000
+"""
+
+import argparse
+import multiprocessing
+import queue
+import random
+import time
+from threading import Thread
+from simplesensor.shared import ThreadsafeLogger
+from .. import moduleConfigLoader as configLoader
+from ..eventManager import EventManager
+from ..registry import ClientRegistry, ClientContext, BtleClient
+from .registryBenchmark import detections
+
+def drain(loggingQueue):
+    while True:
+        if loggingQueue.get() is None:
+            return
+
+def settle(loggingQueue):
+    """ Let the drain thread catch up so it does not slow the next run. """
+    while not loggingQueue.empty():
+        time.sleep(0.05)
+
+def loadConfig(level, sampleInterval=1000):
+    # the config loader's own logs are not part of the benchmark
+    config = configLoader.load(queue.Queue(), __name__)
+    config['SendUpdateMessages'] = False
+    config['ShowClientRangeDebug'] = True
+    config['EventManagerDebug'] = True
+    config['LogLevel'] = level
+    config['LogSampleInterval'] = sampleInterval
+    return config
+
+def legacyLogClientRange(logger, client, eventType):
+    """ logClientRange before ModuleLogger. """
+    if eventType.upper() == "CLIENTIN":
+        logger.debug("<<<<<<<<<<<<<<<<< IN RANGE <<<<<<<<<<<<<<<<<")
+    else:
+        logger.debug(">>>>>>>>>>>>>>>>> OUT OF RANGE >>>>>>>>>>>>>>>>>")
+    logger.debug("    MAC is %s " %client.getMac())
+    logger.debug("    Beacon ID is %s " %client.beaconId)
+    logger.debug("    RSSI %i" %client.rssi)
+    logger.debug("    Major %i" %client.major)
+    logger.debug("    Minor %i" %client.minor)
+    logger.debug("    BTLE RSSI client in threshold %i" %client.context.rssiClientInThresh)
+    logger.debug("    BTLE RSSI client out threshold %i" %client.context.clientOutThresholdMin)
+    logger.debug("    inCount %i : outCount %i" %(client.numClientInRange,client.numClientOutRange))
+    if eventType.upper() == "CLIENTIN":
+        logger.debug("<<<<<<<<<<<<<<<<< IN RANGE END <<<<<<<<<<<<<<<<<")
+    else:
+        logger.debug(">>>>>>>>>>>>>>>>> OUT OF RANGE END >>>>>>>>>>>>>>>>>")
+    logger.debug("")
+
+def clients(loggingQueue, config, count):
+    context = ClientContext(config, loggingQueue)
+    rand = random.Random(0)
+    macs = ['%012X'%rand.getrandbits(48) for _ in range(count)]
+    return [BtleClient(detection, context) for detection in detections(macs, count)]
+
+def timeCalls(fn, samples, loggingQueue):
+    settle(loggingQueue)
+    start = time.perf_counter()
+    for i in range(samples):
+        fn(i)
+    return (time.perf_counter() - start) / samples * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--beacons', type=int, default=100)
+    args = parser.parse_args()
+
+    loggingQueue = multiprocessing.Queue()
+    drainThread = Thread(target=drain, args=(loggingQueue,), daemon=True)
+    drainThread.start()
+    beacons = args.beacons
+
+    print('per client range log')
+    legacyLogger = ThreadsafeLogger(loggingQueue, __name__)
+    population = clients(loggingQueue, loadConfig('DEBUG'), beacons)
+    print('  %-32s %8.2f us' % ('ThreadsafeLogger, line by line', timeCalls(
+        lambda i: legacyLogClientRange(legacyLogger, population[i % beacons], 'CLIENTIN'),
+        args.samples, loggingQueue)))
+    for name, level, sampleInterval in (
+            ('ModuleLogger INFO', 'INFO', 1000),
+            ('ModuleLogger DEBUG sampled', 'DEBUG', 1000),
+            ('ModuleLogger DEBUG every sample', 'DEBUG', 0)):
+        population = clients(loggingQueue, loadConfig(level, sampleInterval), beacons)
+        print('  %-32s %8.2f us' % (name, timeCalls(
+            lambda i: population[i % beacons].logClientRange('CLIENTIN'), args.samples, loggingQueue)))
+
+    print('per detection through the event manager')
+    rand = random.Random(0)
+    macs = ['%012X'%rand.getrandbits(48) for _ in range(beacons)]
+    stream = detections(macs, args.samples, seed=2)
+    for level in ('INFO', 'DEBUG'):
+        config = loadConfig(level)
+        registry = ClientRegistry(config, loggingQueue)
+        eventManager = EventManager(config, queue.Queue(), registry, loggingQueue)
+        print('  %-32s %8.2f us' % ('log_level ' + level, timeCalls(
+            lambda i: eventManager.registerDetectedClient(stream[i]), args.samples, loggingQueue)))
+        eventManager.stop()
+
+    loggingQueue.put(None)
+    drainThread.join()
+
+if __name__ == '__main__':
+    main()
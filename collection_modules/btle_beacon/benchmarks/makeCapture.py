@@ -0,0 +1,34 @@
+"""
+Make capture
+Writes a synthetic capture of a beacon population, to replay in place
+of a dongle with btle_replay_file or the replay benchmarks.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.makeCapture venue.bgcap --beacons 500 --duration 120 --rate 1 10
+"""
+
+import argparse
+from . import streams
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='capture file, appended to if it exists')
+    parser.add_argument('--beacons', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=60,
+        help='seconds of advertising')
+    parser.add_argument('--rate', type=float, nargs=2, default=[1, 10],
+        metavar=('MIN', 'MAX'), help='advertisements/sec range of a beacon')
+    parser.add_argument('--rssi', type=int, nargs=2, default=[-90, -40],
+        metavar=('MIN', 'MAX'), help='range of the mean RSSI of a beacon')
+    parser.add_argument('--rssi-std', type=float, default=4,
+        help='standard deviation of the RSSI around its mean')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    count = streams.syntheticCapture(args.path, args.beacons, args.duration,
+        args.rate, args.rssi, args.rssi_std, args.seed)
+    print('%i advertisements from %i beacons over %.0f s written to %s' % (
+        count, args.beacons, args.duration, args.path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Multi dongle benchmark
+Runs one device thread per fake dongle into a shared detection buffer,
+coalescer and registry, with every dongle hearing the same beacons at a
+different RSSI. Reports detections and drops per dongle and checks every
+beacon ends up in the registry exactly once. Exits non-zero when not.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.multiDongleBenchmark --dongles 3
+"""
+
+import argparse
+import queue
+import random
+import sys
+import time
+from .. import moduleConfigLoader as configLoader
+from ..devices.bluegiga import DeviceThread
+from ..detectionBuffer import DetectionBuffer, DetectionCoalescer, DetectionWorker
+from ..eventManager import EventManager
+from ..registry import ClientRegistry
+from .fakeDongle import FakeDongle
+from . import streams
+
+def run(dongleCount, beacons, rounds, window, mergePolicy, bufferSize):
+    loggingQueue = queue.Queue()
+    config = configLoader.load(loggingQueue, __name__)
+    config['BtleUuidFocusList'] = ['any']
+    config['SlackChannelWebhookUrl'] = ''
+    config['SendUpdateMessages'] = False
+
+    dongles = [FakeDongle() for _ in range(dongleCount)]
+    config['BtleDeviceIds'] = [dongle.port for dongle in dongles]
+    config['BtleScanWindow'] = [0xC8, 0x64]
+
+    registry = ClientRegistry(config, loggingQueue)
+    eventManager = EventManager(config, queue.Queue(), registry, loggingQueue)
+    detectionBuffer = DetectionBuffer(bufferSize)
+    worker = DetectionWorker(
+        detectionBuffer,
+        eventManager.registerClients,
+        loggingQueue,
+        coalescer=DetectionCoalescer(window, mergePolicy))
+    worker.start()
+
+    callbacks = {'onScan': detectionBuffer.put, 'onScanBatch': detectionBuffer.putMany}
+    deviceThreads = []
+    for deviceConfig in configLoader.deviceConfigs(config):
+        deviceThread = DeviceThread(callbacks, deviceConfig, loggingQueue)
+        deviceThread.start()
+        deviceThreads.append(deviceThread)
+    # wait for the start up commands to finish
+    while any(len(dongle.commands) < 7 for dongle in dongles):
+        time.sleep(0.05)
+
+    rand = random.Random(1)
+    senders = [rand.getrandbits(48).to_bytes(6, 'little') for _ in range(beacons)]
+    data = streams.buildIBeaconData(bytes(16), 1, 1)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for i, dongle in enumerate(dongles):
+            dongle.write(b''.join(
+                streams.buildScanResponse(sender, -50 - 5*i, data) for sender in senders))
+        time.sleep(0.01)
+    sent = time.perf_counter() - start
+    time.sleep(window + 1)
+
+    for deviceThread in deviceThreads:
+        deviceThread.stop()
+    for deviceThread in deviceThreads:
+        deviceThread.join()
+    worker.stop()
+    worker.join()
+    for dongle in dongles:
+        dongle.close()
+
+    sourceDrops = detectionBuffer.getStats()['sourceDrops']
+    for deviceThread in deviceThreads:
+        deviceId = deviceThread.btleConfig['BtleDeviceId']
+        print('%-14s scan window %3i  detections %7i  drops %6i' % (
+            deviceId, deviceThread.btleConfig['BtleScanWindow'],
+            deviceThread.detectionCount, sourceDrops.get(deviceId, 0)))
+    total = sum(deviceThread.detectionCount for deviceThread in deviceThreads)
+    print('%i detections in %.2f s, %i clients registered for %i beacons' % (
+        total, sent, len(registry.rClients), beacons))
+    return len(registry.rClients) == beacons
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dongles', type=int, default=3)
+    parser.add_argument('--beacons', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--window', type=float, default=0.5,
+        help='coalesce window in seconds')
+    parser.add_argument('--merge', default='best_rssi',
+        choices=('aggregate', 'best_rssi'))
+    parser.add_argument('--buffer', type=int, default=4096,
+        help='detection buffer size')
+    args = parser.parse_args()
+    ok = run(args.dongles, args.beacons, args.rounds, args.window, args.merge, args.buffer)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Parser benchmark
+Replays a BLED112 byte stream through BGLib and reports packets/sec
+for byte-at-a-time parsing and for chunked parsing.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.parserBenchmark [--stream FILE]
+"""
+
+import argparse
+import time
+from ..devices.bluegiga.bglib import BGLib
+from . import streams
+
+def _newParser():
+    ble = BGLib()
+    counter = [0]
+    def onScan(sender, args):
+        counter[0] += 1
+    ble.ble_evt_gap_scan_response += onScan
+    return ble, counter
+
+def runByteAtATime(stream):
+    ble, counter = _newParser()
+    start = time.perf_counter()
+    for b in stream:
+        ble.parse(bytes([b]))
+    return counter[0], time.perf_counter() - start
+
+def runChunked(reads):
+    ble, counter = _newParser()
+    start = time.perf_counter()
+    for chunk in reads:
+        ble.parse_chunk(chunk)
+    return counter[0], time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stream', help='raw BGAPI byte stream recorded from a BLED112')
+    parser.add_argument('--beacons', type=int, default=200)
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--max-read', type=int, default=256,
+        help='largest simulated serial read in bytes')
+    args = parser.parse_args()
+
+    if args.stream:
+        stream = streams.loadStream(args.stream)
+    else:
+        stream = streams.syntheticStream(args.beacons, args.packets)
+    reads = streams.splitReads(stream, args.max_read)
+
+    print('stream: %i bytes in %i reads' % (len(stream), len(reads)))
+    for name, (packets, elapsed) in (
+            ('byte-at-a-time', runByteAtATime(stream)),
+            ('chunked', runChunked(reads))):
+        print('%-15s %8i packets %8.3f s %10.0f packets/sec' % (
+            name, packets, elapsed, packets / elapsed if elapsed else 0))
+
+if __name__ == '__main__':
+    main()
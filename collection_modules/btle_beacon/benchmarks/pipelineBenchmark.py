@@ -0,0 +1,222 @@
+"""
+Pipeline benchmark
+Replays BGAPI traffic through the whole beacon pipeline without a dongle:
+ReplaySerial -> BGLib.parse -> DeviceThread.scanCallback ->
+EventManager.registerDetectedClient -> ClientRegistry -> outbound queue.
+
+For each beacon population a synthetic capture (or the capture given
+with --capture) is replayed as fast as possible, and the benchmark
+reports packets/sec, the p50/p99 latency from the serial read that
+delivered a packet to its detection being handled and to a Message
+being put on the outbound queue, and the peak RSS. Every population
+runs in a fresh process so the peak RSS is its own.
+
+Each population is run --repeat times and the fastest run is reported,
+single runs are noisy on a busy machine. With --baseline the packets/sec
+are compared against a file written earlier with --save-baseline, and
+the benchmark exits non-zero when any population is more than
+--threshold slower.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.pipelineBenchmark --populations 10 1000 50000
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.pipelineBenchmark --save-baseline base.json
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.pipelineBenchmark --baseline base.json --threshold 0.1
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+from .. import moduleConfigLoader as configLoader
+from ..devices.bluegiga import DeviceThread
+from ..devices.bluegiga.capture import ReplaySerial
+from ..eventManager import EventManager
+from ..registry import ClientRegistry
+from . import streams
+
+# packets replayed for each population, at least a few per beacon
+_MIN_PACKETS = 20000
+_MIN_PER_BEACON = 3
+# seconds without a new detection after the replay ran out
+_SETTLE_TIME = 0.5
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def rss():
+    """
+    Current and peak resident set size in kB. The peak from getrusage
+    survives exec, so the one in /proc is used where there is one.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return int(status['VmRSS'].split()[0]), int(status['VmHWM'].split()[0])
+    except (OSError, KeyError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak, peak
+
+class TimedReplaySerial(ReplaySerial):
+    """ ReplaySerial noting when the last bytes were read. """
+
+    lastRead = 0
+
+    def read(self, size=1):
+        data = super().read(size)
+        if data:
+            self.lastRead = time.perf_counter()
+        return data
+
+class TimedQueue(queue.Queue):
+    """ Outbound queue timing every Message from the read that caused it. """
+
+    def __init__(self, serial):
+        super().__init__()
+        self.serial = serial
+        self.latencies = []
+
+    def put(self, item, block=True, timeout=None):
+        # nothing consumes the messages, time them and let them go
+        self.latencies.append(time.perf_counter() - self.serial.lastRead)
+
+def makeCapture(beacons):
+    fd, path = tempfile.mkstemp(suffix='.bgcap')
+    os.close(fd)
+    os.remove(path)
+    packets = max(_MIN_PACKETS, beacons * _MIN_PER_BEACON)
+    # every beacon advertises once a second
+    streams.syntheticCapture(path, beacons, packets / beacons, rate=(1, 1))
+    return path
+
+def runPopulation(beacons, capture, results):
+    """ Replay a capture, or a synthetic one for beacons when there is none. """
+    if capture is None:
+        capture = makeCapture(beacons)
+    loggingQueue = queue.Queue()
+    config = configLoader.load(loggingQueue, __name__)
+    config['BtleUuidFocusList'] = ['any']
+    config['SlackChannelWebhookUrl'] = ''
+    config['SendUpdateMessages'] = False
+    config['BtleReplayFile'] = capture
+    config['BtleReplaySpeed'] = 0
+
+    serial = TimedReplaySerial(capture, speed=0, timeout=1)
+    outQueue = TimedQueue(serial)
+    registry = ClientRegistry(config, loggingQueue)
+    eventManager = EventManager(config, outQueue, registry, loggingQueue)
+
+    handled = []
+    finished = [0]
+    def onScan(detection):
+        eventManager.registerDetectedClient(detection)
+        finished[0] = time.perf_counter()
+        handled.append(finished[0] - serial.lastRead)
+
+    deviceThread = DeviceThread({'onScan': onScan}, config, loggingQueue)
+    deviceThread.device.openSerial = lambda: serial
+    rssStart = rss()[0]
+
+    start = time.perf_counter()
+    deviceThread.start()
+    count = -1
+    while True:
+        time.sleep(_SETTLE_TIME)
+        if serial.finished and len(handled) == count:
+            break
+        count = len(handled)
+    # the wait after the last detection is not part of the run
+    elapsed = finished[0] - start if handled else 0
+    deviceThread.stop()
+    deviceThread.join()
+    eventManager.stop()
+    if beacons is not None:
+        os.remove(capture)
+
+    results.put({
+        'packets': deviceThread.advertisementCount,
+        'detections': len(handled),
+        'clients': len(registry.rClients),
+        'messages': len(outQueue.latencies),
+        'pps': deviceThread.advertisementCount / elapsed if elapsed else 0,
+        'detectionP50': percentile(handled, 50) * 1000,
+        'detectionP99': percentile(handled, 99) * 1000,
+        'messageP50': percentile(outQueue.latencies, 50) * 1000,
+        'messageP99': percentile(outQueue.latencies, 99) * 1000,
+        'rssStart': rssStart,
+        'rssPeak': rss()[1],
+        })
+
+def run(beacons, capture=None):
+    """ Run the pipeline in a fresh process. """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=runPopulation, args=(beacons, capture, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--populations', type=int, nargs='+',
+        default=[10, 100, 1000, 10000, 50000])
+    parser.add_argument('--capture',
+        help='replay this capture instead of synthetic populations')
+    parser.add_argument('--baseline', help='json file with packets/sec to compare against')
+    parser.add_argument('--save-baseline', help='write the packets/sec to this json file')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='runs per population, the fastest counts')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='largest allowed slowdown against the baseline, 0.1 is 10%%')
+    args = parser.parse_args()
+
+    if args.capture:
+        runs = [('capture', None, args.capture)]
+    else:
+        runs = [(str(beacons), beacons, None) for beacons in args.populations]
+
+    print('%8s %8s %9s %8s %10s %10s %10s %10s %9s %9s' % (
+        'beacons', 'packets', 'pkts/sec', 'clients', 'det p50', 'det p99',
+        'msg p50', 'msg p99', 'rss kB', 'peak kB'))
+    pps = {}
+    for name, beacons, capture in runs:
+        result = max((run(beacons, capture) for _ in range(args.repeat)),
+            key=lambda result: result['pps'])
+        pps[name] = result['pps']
+        print('%8s %8i %9.0f %8i %8.2fms %8.2fms %8.2fms %8.2fms %9i %9i' % (
+            name, result['packets'], result['pps'], result['clients'],
+            result['detectionP50'], result['detectionP99'],
+            result['messageP50'], result['messageP99'],
+            result['rssStart'], result['rssPeak']))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(pps, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = False
+        for name, value in pps.items():
+            if name not in baseline:
+                continue
+            change = value / baseline[name] - 1
+            if change < -args.threshold:
+                regressed = True
+                print('%s beacons: %.0f packets/sec, %.1f%% slower than the baseline %.0f' % (
+                    name, value, -change * 100, baseline[name]))
+        if regressed:
+            sys.exit(1)
+        print('no population more than %.0f%% slower than the baseline' % (args.threshold * 100))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Reader benchmark
+Runs the device thread against a fake dongle on a pty pair and reports
+the latency from an advertisement hitting the port to its detection,
+and the CPU used while the room is empty, for each read mode.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.readerBenchmark
+"""
+
+import argparse
+import queue
+import time
+from .. import moduleConfigLoader as configLoader
+from ..devices.bluegiga import DeviceThread
+from .fakeDongle import FakeDongle
+from . import streams
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def runMode(readMode, packets, interval, idleSeconds):
+    loggingQueue = queue.Queue()
+    config = configLoader.load(loggingQueue, __name__)
+    config['BtleDeviceReadMode'] = readMode
+    config['BtleUuidFocusList'] = ['any']
+    config['SlackChannelWebhookUrl'] = ''
+
+    dongle = FakeDongle()
+    config['BtleDeviceId'] = dongle.port
+
+    received = []
+    deviceThread = DeviceThread(
+        {'onScan': lambda detection: received.append(time.perf_counter())},
+        config,
+        loggingQueue)
+    deviceThread.start()
+    # wait for the start up commands to finish
+    while len(dongle.commands) < 7:
+        time.sleep(0.05)
+    time.sleep(0.2)
+
+    data = streams.buildIBeaconData(bytes(16), 1, 1)
+    sent = []
+    for i in range(packets):
+        sent.append(time.perf_counter())
+        dongle.write(streams.buildScanResponse(bytes(6), -60, data))
+        time.sleep(interval)
+    time.sleep(0.5)
+    latencies = [(r - s) * 1000 for s, r in zip(sent, received)]
+
+    cpuStart = time.process_time()
+    time.sleep(idleSeconds)
+    idleCpu = (time.process_time() - cpuStart) / idleSeconds * 100
+
+    deviceThread.stop()
+    deviceThread.join()
+    dongle.close()
+    return len(received), latencies, idleCpu
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--packets', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.013,
+        help='seconds between advertisements')
+    parser.add_argument('--idle', type=float, default=5,
+        help='seconds to measure idle CPU for')
+    args = parser.parse_args()
+
+    for readMode in ('poll', 'blocking'):
+        count, latencies, idleCpu = runMode(readMode, args.packets, args.interval, args.idle)
+        print('%-9s received %4i/%i  latency p50 %6.2f ms p99 %6.2f ms  idle cpu %5.2f%%' % (
+            readMode, count, args.packets,
+            percentile(latencies, 50), percentile(latencies, 99), idleCpu))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Registry benchmark
+Registers a number of beacons with a ClientRegistry through the
+EventManager and reports memory per tracked client and update time.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.registryBenchmark --clients 10000
+"""
+
+import argparse
+import queue
+import random
+import time
+import tracemalloc
+from .. import moduleConfigLoader as configLoader
+from ..devices.detectionData import DetectionData, macFromHex
+from ..eventManager import EventManager
+from ..registry import ClientRegistry
+
+def detections(macs, count, seed=1):
+    """ Random detections spread over the given beacons, macs as hex. """
+    rand = random.Random(seed)
+    macs = [macFromHex(mac) for mac in macs]
+    clients = len(macs)
+    now = time.monotonic_ns()
+    result = [None]*count
+    for i in range(count):
+        mac = macs[i] if i < clients else macs[rand.randrange(clients)]
+        result[i] = DetectionData(
+            mac,
+            (i%10 + 1).to_bytes(16, 'big'),
+            i%100,
+            i%1000,
+            -59,
+            rand.randint(-90, -40),
+            now)
+    return result
+
+def run(clients, updates):
+    loggingQueue = queue.Queue()
+    config = configLoader.load(loggingQueue, __name__)
+    config['SendUpdateMessages'] = False
+    outQueue = queue.Queue()
+    rand = random.Random(0)
+    macs = ['%012X'%rand.getrandbits(48) for _ in range(clients)]
+    newClients = detections(macs, clients)
+    seen = detections(macs, updates, seed=2)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    registry = ClientRegistry(config, loggingQueue)
+    eventManager = EventManager(config, outQueue, registry, loggingQueue)
+    eventManager.registerClients(newClients)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for i in range(0, len(seen), 100):
+        eventManager.registerClients(seen[i:i+100])
+    elapsed = time.perf_counter() - start
+    eventManager.stop()
+
+    print('%i clients: %.0f bytes per client'%(
+        len(registry.rClients), (after - before)/len(registry.rClients)))
+    print('%i detections: %.1f us per detection'%(
+        len(seen), elapsed/len(seen)*1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--updates', type=int, default=100000)
+    args = parser.parse_args()
+    run(args.clients, args.updates)
+
+if __name__ == '__main__':
+    main()
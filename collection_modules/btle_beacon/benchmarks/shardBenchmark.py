@@ -0,0 +1,106 @@
+"""
+Shard benchmark
+Registers synthetic beacon populations with the in process registry and
+with ShardedRegistry for a number of shards, and reports detections/sec
+and the speedup over the in process registry. Time for the sharded runs
+includes sending detections to the shard processes. The parent column is
+the CPU time the collection point process spends packing and queueing
+each detection, the most any number of shards can reach is 1/parent. Shards
+only scale up to the number of cores, which is printed first.
+
+Usage:
+    python -m simplesensor.collection_modules.btle_beacon.benchmarks.shardBenchmark --populations 1000 10000 50000 --shards 1 2 4
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import random
+import time
+from threading import Thread
+from .. import moduleConfigLoader as configLoader
+from ..eventManager import EventManager
+from ..registry import ClientRegistry
+from ..registryShards import ShardedRegistry
+from .registryBenchmark import detections
+
+_BATCH_SIZE = 500
+
+def loadConfig(loggingQueue):
+    config = configLoader.load(loggingQueue, __name__)
+    config['SendUpdateMessages'] = False
+    return config
+
+def population(beacons, perBeacon):
+    rand = random.Random(0)
+    macs = ['%012X'%rand.getrandbits(48) for _ in range(beacons)]
+    return detections(macs, beacons*perBeacon)
+
+def batches(stream):
+    return [stream[i:i+_BATCH_SIZE] for i in range(0, len(stream), _BATCH_SIZE)]
+
+def runInProcess(stream):
+    loggingQueue = queue.Queue()
+    config = loadConfig(loggingQueue)
+    registry = ClientRegistry(config, loggingQueue)
+    eventManager = EventManager(config, queue.Queue(), registry, loggingQueue)
+    start = time.perf_counter()
+    for batch in batches(stream):
+        eventManager.registerClients(batch)
+    elapsed = time.perf_counter() - start
+    return elapsed, len(registry.rClients)
+
+def drain(loggingQueue):
+    try:
+        while True:
+            loggingQueue.get()
+    except (EOFError, OSError):
+        return
+
+def runSharded(stream, shards):
+    loggingQueue = multiprocessing.Queue()
+    Thread(target=drain, args=(loggingQueue,), daemon=True).start()
+    config = loadConfig(loggingQueue)
+    outQueue = queue.Queue()
+    sharded = ShardedRegistry(config, outQueue, loggingQueue, shards)
+    sharded.start()
+    sharded.sync()
+    parent = 0
+    start = time.perf_counter()
+    for batch in batches(stream):
+        # CPU time, shards running on the same core do not count
+        sent = time.thread_time()
+        sharded.registerClients(batch)
+        parent += time.thread_time() - sent
+    counts = sharded.sync()
+    elapsed = time.perf_counter() - start
+    sharded.stop()
+    return elapsed, parent, sum(counts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--populations', type=int, nargs='+',
+        default=[1000, 5000, 10000, 50000])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--per-beacon', type=int, default=5,
+        help='detections per beacon')
+    args = parser.parse_args()
+
+    print('%i cores' % len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+        else '%i cores' % os.cpu_count())
+    for beacons in args.populations:
+        stream = population(beacons, args.per_beacon)
+        elapsed, clients = runInProcess(stream)
+        inProcess = len(stream)/elapsed
+        print('%6i beacons  in process  %8.0f detections/sec                       %6i clients' % (
+            beacons, inProcess, clients))
+        for shards in args.shards:
+            elapsed, parent, clients = runSharded(stream, shards)
+            rate = len(stream)/elapsed
+            print('%6i beacons  %2i shards   %8.0f detections/sec  %5.2fx  parent %5.2f us  %6i clients' % (
+                beacons, shards, rate, rate/inProcess, parent/len(stream)*1e6, clients))
+
+if __name__ == '__main__':
+    main()
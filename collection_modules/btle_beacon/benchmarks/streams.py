@@ -0,0 +1,90 @@
+"""
+Streams
+Helpers to build and load BGAPI byte streams for the benchmarks.
+"""
+
+import heapq
+import random
+import struct
+from ..devices.bluegiga.capture import CaptureWriter
+
+_IBEACON_PREFIX = bytes([0x02, 0x01, 0x06, 0x1A, 0xFF, 0x4C, 0x00, 0x02, 0x15])
+
+def buildScanResponse(sender, rssi, data, addressType=1):
+    """ Build a raw ble_evt_gap_scan_response packet. """
+    payload = struct.pack('<bB6sBBB', rssi, 0, sender, addressType, 0xFF, len(data)) + data
+    return bytes([0x80, len(payload), 6, 0]) + payload
+
+def buildIBeaconData(uuid, major, minor, tx=-59):
+    """ Build iBeacon advertisement data. """
+    return _IBEACON_PREFIX + uuid + struct.pack('>HHb', major, minor, tx)
+
+def syntheticStream(beacons=200, packets=20000, seed=1):
+    """
+    Build a stream of scan responses for a population of iBeacons,
+    as the BLED112 would send it over the serial port.
+    """
+    rand = random.Random(seed)
+    population = []
+    for i in range(beacons):
+        sender = bytes(rand.randrange(256) for _ in range(6))
+        uuid = bytes(15) + bytes([1 + i % 10])
+        population.append((sender, buildIBeaconData(uuid, i % 100, i, -59)))
+    chunks = []
+    for _ in range(packets):
+        sender, data = rand.choice(population)
+        chunks.append(buildScanResponse(sender, rand.randint(-95, -35), data))
+    return b''.join(chunks)
+
+def syntheticCapture(path, beacons=200, duration=60, rate=(1, 10),
+        rssi=(-90, -40), rssiStd=4, seed=1):
+    """
+    Write a capture of a population of iBeacons advertising for
+    duration seconds. Each beacon advertises at a rate drawn from
+    the rate range (per second) with up to 10ms of random delay,
+    as BLE advertisers do, and is heard at a mean RSSI drawn from
+    the rssi range with normally distributed noise of rssiStd.
+    Returns the number of advertisements written.
+    """
+    rand = random.Random(seed)
+    schedule = []
+    population = []
+    for i in range(beacons):
+        sender = bytes(rand.randrange(256) for _ in range(6))
+        uuid = bytes(15) + bytes([1 + i % 10])
+        interval = 1/rand.uniform(*rate)
+        population.append((sender, buildIBeaconData(uuid, i % 100, i, -59),
+            interval, rand.uniform(*rssi)))
+        schedule.append((rand.uniform(0, interval), i))
+    heapq.heapify(schedule)
+
+    writer = CaptureWriter(path)
+    count = 0
+    while schedule[0][0] < duration:
+        at, i = schedule[0]
+        sender, data, interval, rssiMean = population[i]
+        level = int(round(rand.gauss(rssiMean, rssiStd)))
+        writer.write(buildScanResponse(sender, max(-127, min(-1, level)), data), int(at*1e9))
+        heapq.heapreplace(schedule, (at + interval + rand.uniform(0, 0.01), i))
+        count += 1
+    writer.close()
+    return count
+
+def loadStream(path):
+    """ Load a raw byte stream recorded from the dongle. """
+    with open(path, 'rb') as f:
+        return f.read()
+
+def splitReads(stream, maxRead=256, seed=1):
+    """
+    Split a stream into reads of random size, the way they
+    come off the serial port.
+    """
+    rand = random.Random(seed)
+    reads = []
+    pos = 0
+    while pos < len(stream):
+        size = rand.randint(1, maxRead)
+        reads.append(stream[pos:pos + size])
+        pos += size
+    return reads
@@ -7,14 +7,23 @@ from . import moduleConfigLoader as configLoader
 from .devices.bluegiga import DeviceThread as BlueGigaDeviceThread
 from .registry import ClientRegistry
 from simplesensor.shared import ThreadsafeLogger, ModuleProcess
-from .repeatedTimer import RepeatedTimer
+from .scheduler import Scheduler
 from .eventManager import EventManager
+from .registryShards import ShardedRegistry
+from .detectionBuffer import DetectionBuffer, DetectionCoalescer, DetectionWorker
+from .advertisementLog import AdvertisementLog
 from threading import Thread
 from datetime import datetime
 import multiprocessing as mp
 import time
 
 _ON_SCAN = 'onScan'
+_ON_SCAN_BATCH = 'onScanBatch'
+
+# seconds between per dongle stats in the log
+_DEVICE_STATS_INTERVAL = 60
+# seconds shut down waits for each reader and the detection worker
+_JOIN_TIMEOUT = 5
 
 class BtleCollectionPoint(Thread):
 
@@ -38,26 +47,81 @@ class BtleCollectionPoint(Thread):
         # Variables and objects
         self.alive = True
         self.callbacks = {
-            _ON_SCAN: self.handleBtleClientEvent
+            _ON_SCAN: self.handleBtleClientEvent,
+            _ON_SCAN_BATCH: self.handleBtleClientEvents
         }
-        self.clientRegistry = ClientRegistry(
-            self.moduleConfig, 
-            self.loggingQueue)
+        self._registryShards = self.moduleConfig['RegistryShards']
+        if self._registryShards > 0:
+            # registry partitions live in worker processes
+            self.clientRegistry = None
+            self.eventManager = ShardedRegistry(
+                self.moduleConfig,
+                pOutBoundQueue,
+                self.loggingQueue,
+                self._registryShards)
+        else:
+            self.clientRegistry = ClientRegistry(
+                self.moduleConfig, 
+                self.loggingQueue)
+
+            self.eventManager = EventManager(
+                self.moduleConfig, 
+                pOutBoundQueue, 
+                self.clientRegistry, 
+                self.loggingQueue)
+
+        # One reader thread per dongle
+        self.deviceConfigs = configLoader.deviceConfigs(self.moduleConfig)
+        self.deviceThreads = []
 
-        self.eventManager = EventManager(
-            self.moduleConfig, 
-            pOutBoundQueue, 
-            self.clientRegistry, 
-            self.loggingQueue)
+        # Detections are registered in batches off the reader thread,
+        # always when several readers or registry shards are used
+        self.detectionBuffer = None
+        self.detectionWorker = None
+        if (self.moduleConfig['DetectionBufferEnabled'] or
+            len(self.deviceConfigs) > 1 or
+            self._registryShards > 0):
+            self.detectionBuffer = DetectionBuffer(
+                self.moduleConfig['DetectionBufferSize'],
+                self.moduleConfig['DetectionBufferPolicy'])
+            coalescer = None
+            if self.moduleConfig['DetectionCoalesceWindow'] > 0:
+                coalescer = DetectionCoalescer(
+                    self.moduleConfig['DetectionCoalesceWindow']/1000,
+                    self.moduleConfig['DetectionMergePolicy'])
+            self.detectionWorker = DetectionWorker(
+                self.detectionBuffer,
+                self.eventManager.registerClients,
+                self.loggingQueue,
+                coalescer=coalescer)
+            self.callbacks[_ON_SCAN] = self.detectionBuffer.put
+            self.callbacks[_ON_SCAN_BATCH] = self.detectionBuffer.putMany
+
+        # raw detections are logged before anything folds them together
+        self.advertisementLog = None
+        if self.moduleConfig['AdvertisementLogDir']:
+            self.advertisementLog = AdvertisementLog(
+                self.moduleConfig['AdvertisementLogDir'],
+                self.moduleConfig['AdvertisementLogSegmentInterval'],
+                self.moduleConfig['AdvertisementLogMaxSegments'],
+                self.loggingQueue)
+            self._onScan = self.callbacks[_ON_SCAN]
+            self._onScanBatch = self.callbacks[_ON_SCAN_BATCH]
+            self.callbacks[_ON_SCAN] = self.logScan
+            self.callbacks[_ON_SCAN_BATCH] = self.logScanBatch
 
         # Threads
         self.btleThread = None
-        self.repeatTimerSweepClients = None
+        self.scheduler = Scheduler(self.loggingQueue)
 
         self.lastUpdate = datetime.now()
 
         # Constants
-        self._cleanupInterval = self.moduleConfig['AbandonedClientCleanupInterval']
+        self._cleanupInterval = min(
+            self.moduleConfig['AbandonedClientCleanupInterval'],
+            self.moduleConfig['AbandonedClientSweepTolerance'])
+        # registry shards save their own state
+        self._stateFile = self.moduleConfig['RegistryStateFile']
 
     def run(self):
         """
@@ -65,24 +129,61 @@ class BtleCollectionPoint(Thread):
         Sets up and starts the DeviceThread.
         Loops repeatedly reading incoming messages.
         """
-        # Pause for a bit to let things bootup on host machine
-        self.logger.info("Pausing execution 15 seconds" +
-            " waiting for other system services to start")
-        time.sleep(15)
-        self.logger.info("Done with our nap. " + 
-            "Time to start looking for clients")
-
-        # Start device thread, handles IO
-        self.deviceThread = BlueGigaDeviceThread(
-            self.callbacks, 
-            self.moduleConfig, 
-            self.loggingQueue)
-        self.deviceThread.start()
-
-        # Setup repeat task to run the sweep every X interval
-        self.repeatTimerSweepClients = RepeatedTimer(
-            (self._cleanupInterval/1000), 
-            self.clientRegistry.sweepOldClients)
+        # device threads wait for their dongle to answer
+        # instead of sleeping here for the host to boot
+        if self.clientRegistry and self._stateFile:
+            self.loadRegistryState()
+
+        if self._registryShards > 0:
+            self.eventManager.start()
+
+        if self.detectionWorker:
+            self.detectionWorker.start()
+
+        # Start device threads, handle IO
+        for deviceConfig in self.deviceConfigs:
+            deviceThread = BlueGigaDeviceThread(
+                self.callbacks, 
+                deviceConfig, 
+                self.loggingQueue)
+            deviceThread.start()
+            self.deviceThreads.append(deviceThread)
+
+        # take dropped clients out of the dongle whitelists
+        if self.moduleConfig['BtleWhitelistEnabled']:
+            if self.clientRegistry:
+                self.clientRegistry.onClientRemoved += self.forgetClient
+            else:
+                self.eventManager.onClientRemoved += self.forgetAddress
+
+        # Periodic jobs: the sweep every X interval and the
+        # nearby update UpdateFPS times a second.
+        # Registry shards run their own sweep.
+        if self.clientRegistry:
+            self.scheduler.addJob(
+                'sweepOldClients',
+                self._cleanupInterval/1000,
+                self.clientRegistry.sweepOldClients)
+        if self.moduleConfig['SendUpdateMessages']:
+            self.scheduler.addJob(
+                'publishUpdate',
+                1/self.moduleConfig['UpdateFPS'],
+                self.eventManager.publishUpdate)
+        if self.clientRegistry and self._stateFile:
+            self.scheduler.addJob(
+                'saveRegistryState',
+                self.moduleConfig['RegistryStateInterval']/1000,
+                self.saveRegistryState)
+        if self.advertisementLog:
+            self.scheduler.addJob(
+                'flushAdvertisementLog',
+                self.moduleConfig['AdvertisementLogFlushInterval']/1000,
+                self.advertisementLog.flush)
+        self.scheduler.addJob(
+            'logDeviceStats',
+            _DEVICE_STATS_INTERVAL,
+            self.logDeviceStats)
+        self.scheduler.start()
 
         self.logger.info("Starting to watch collection point inbound message queue")
         while self.alive:
@@ -103,9 +204,69 @@ class BtleCollectionPoint(Thread):
             else:
                 time.sleep(.45)
 
+    def logScan(self, detectedClient):
+        self.advertisementLog.write(detectedClient)
+        self._onScan(detectedClient)
+
+    def logScanBatch(self, detectedClients):
+        self.advertisementLog.writeMany(detectedClients)
+        self._onScanBatch(detectedClients)
+
     def handleBtleClientEvent(self, detectedClient):
         self.eventManager.registerDetectedClient(detectedClient)
 
+    def handleBtleClientEvents(self, detectedClients):
+        self.eventManager.registerClients(detectedClients)
+
+    def getDeviceStats(self):
+        """
+        Detections read and dropped by each dongle.
+        Drops are detections the buffer had to throw away,
+        unmapped are samples dropped for their uuid.
+        """
+        sourceDrops = {}
+        if self.detectionBuffer:
+            sourceDrops = self.detectionBuffer.getStats()['sourceDrops']
+        stats = {}
+        for deviceThread in self.deviceThreads:
+            deviceId = deviceThread.btleConfig['BtleDeviceId']
+            detections = deviceThread.detectionCount
+            drops = sourceDrops.get(deviceId, 0)
+            stats[deviceId] = {
+                'detections': detections,
+                'drops': drops,
+                'dropRate': drops/detections if detections else 0,
+                'unmapped': deviceThread.unmappedCount
+                }
+        return stats
+
+    def logDeviceStats(self):
+        self.logger.info("Device stats: %s"%self.getDeviceStats())
+
+    def loadRegistryState(self):
+        """ Restore the clients tracked before the last shutdown. """
+        try:
+            loaded = self.clientRegistry.loadState(self._stateFile)
+            self.logger.info("Restored %s clients from %s"%(loaded, self._stateFile))
+        except FileNotFoundError:
+            self.logger.info("No registry state in %s, starting empty"%self._stateFile)
+        except Exception as e:
+            self.logger.error("Unable to restore clients from %s: %s"%(self._stateFile, e))
+
+    def saveRegistryState(self):
+        try:
+            self.clientRegistry.saveState(self._stateFile)
+        except Exception as e:
+            self.logger.error("Unable to save clients to %s: %s"%(self._stateFile, e))
+
+    def forgetClient(self, sender, client):
+        self.forgetAddress(sender, client.address)
+
+    def forgetAddress(self, sender, address):
+        """ Raw MAC of a dropped client, from the registry shards. """
+        for deviceThread in self.deviceThreads:
+            deviceThread.scanFilter.forget(address)
+
     def handleMessage(self, msg):
         # Handle incoming messages, eg. from other collection points
         pass
@@ -127,9 +288,22 @@ class BtleCollectionPoint(Thread):
 
     def shutdown(self):
         self.logger.info("Shutting down")
-        self.repeatTimerSweepClients.stop()
+        self.scheduler.stop()
+        for deviceThread in self.deviceThreads:
+            deviceThread.stop()
+        for deviceThread in self.deviceThreads:
+            deviceThread.join(_JOIN_TIMEOUT)
+        # the worker registers what is left in the buffer before it
+        # ends, the state is only saved once it is done
+        if self.detectionWorker:
+            self.detectionWorker.stop()
+            self.detectionWorker.join(_JOIN_TIMEOUT)
+        if self.advertisementLog:
+            self.advertisementLog.close()
+        # after the readers so the last detections are in it
+        if self.clientRegistry and self._stateFile:
+            self.saveRegistryState()
         self.eventManager.stop()
-        self.deviceThread.stop()
         # self.killProcess(self.deviceThread)
         self.alive = False
         time.sleep(1)
@@ -0,0 +1,266 @@
+"""
+DetectionBuffer
+Bounded buffer between the device thread and the registry.
+
+The device thread only puts detections in the buffer, a
+DetectionWorker takes everything pending in one batch and
+hands it to EventManager.registerClients, so a slow registry
+or outbound queue never holds up the serial port.
+
+DetectionCoalescer optionally folds the detections of each
+MAC over a time window into one aggregated detection, which
+also merges what several dongles heard of the same beacon.
+"""
+
+from simplesensor.shared import ThreadsafeLogger
+from collections import deque, OrderedDict
+from threading import Thread, Condition
+import time
+
+# overflow policies
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+POLICIES = (DROP_OLDEST, COALESCE)
+
+# merge policies
+AGGREGATE = 'aggregate'
+BEST_RSSI = 'best_rssi'
+MERGE_POLICIES = (AGGREGATE, BEST_RSSI)
+
+class DetectionBuffer(object):
+    """
+    Thread safe bounded buffer of detections.
+
+    drop_oldest keeps every detection in arrival order and drops
+    the oldest one when full.
+    coalesce keeps only the newest pending detection of each MAC
+    and drops the MAC that has waited longest when full.
+    """
+
+    def __init__(self, maxSize=4096, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError("Unknown detection buffer policy: %s"%policy)
+        self.maxSize = maxSize
+        self.policy = policy
+        self.condition = Condition()
+        if policy == COALESCE:
+            self.pending = OrderedDict()
+        else:
+            self.pending = deque()
+
+        # Counters
+        self.received = 0
+        self.drops = 0
+        self.coalesced = 0
+        self.maxDepth = 0
+        # dropped detections by the device that heard them
+        self.sourceDrops = {}
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def put(self, detection):
+        self.putMany((detection,))
+
+    def putMany(self, detections):
+        """ Add detections, never blocks. """
+        with self.condition:
+            pending = self.pending
+            if self.policy == COALESCE:
+                for detection in detections:
+                    mac = detection.mac
+                    if mac in pending:
+                        self.coalesced += 1
+                    elif len(pending) >= self.maxSize:
+                        self.dropped(pending.popitem(last=False)[1])
+                    pending[mac] = detection
+            else:
+                for detection in detections:
+                    if len(pending) >= self.maxSize:
+                        self.dropped(pending.popleft())
+                    pending.append(detection)
+            self.received += len(detections)
+            if len(pending) > self.maxDepth:
+                self.maxDepth = len(pending)
+            self.condition.notify()
+
+    def dropped(self, detection):
+        """ Count a dropped detection, called with the lock held. """
+        self.drops += 1
+        source = detection.deviceId
+        self.sourceDrops[source] = self.sourceDrops.get(source, 0) + 1
+
+    def take(self, timeout=None):
+        """
+        Return every pending detection, oldest first.
+        Waits up to timeout seconds for one to arrive,
+        returns an empty list if none did.
+        """
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+            if self.policy == COALESCE:
+                batch = list(self.pending.values())
+            else:
+                batch = list(self.pending)
+            self.pending.clear()
+        return batch
+
+    def wake(self):
+        """ Wake up a thread waiting in take. """
+        with self.condition:
+            self.condition.notify_all()
+
+    def getStats(self):
+        with self.condition:
+            return {
+                'received': self.received,
+                'drops': self.drops,
+                'coalesced': self.coalesced,
+                'depth': len(self.pending),
+                'maxDepth': self.maxDepth,
+                'sourceDrops': dict(self.sourceDrops)
+                }
+
+class DetectionCoalescer(object):
+    """
+    Folds all detections of a MAC within a window of
+    seconds into one detection carrying the sample count,
+    min, max and mean RSSI and the newest tx and ids.
+
+    With several dongles, aggregate counts every sample
+    heard by any dongle and averages over all of them.
+    best_rssi uses the strongest sample as the RSSI and
+    the count of the dongle that heard the beacon most,
+    so one advertisement heard twice counts once.
+    """
+
+    def __init__(self, window, mergePolicy=AGGREGATE):
+        if mergePolicy not in MERGE_POLICIES:
+            raise ValueError("Unknown detection merge policy: %s"%mergePolicy)
+        self.window = window
+        self.bestRssi = mergePolicy == BEST_RSSI
+        self.windowEnd = None
+        # mac -> [newest detection, count, min, max, sum of rssi, counts by device]
+        self.aggregates = {}
+
+    def add(self, detections):
+        if detections and self.windowEnd is None:
+            self.windowEnd = time.monotonic() + self.window
+        aggregates = self.aggregates
+        for detection in detections:
+            mac = detection.mac
+            rssi = detection.rssi
+            aggregate = aggregates.get(mac)
+            if aggregate is None:
+                aggregate = aggregates[mac] = [detection, 1, rssi, rssi, rssi, None]
+            else:
+                aggregate[0] = detection
+                aggregate[1] += 1
+                if rssi < aggregate[2]:
+                    aggregate[2] = rssi
+                elif rssi > aggregate[3]:
+                    aggregate[3] = rssi
+                aggregate[4] += rssi
+            if self.bestRssi:
+                deviceCounts = aggregate[5]
+                if deviceCounts is None:
+                    deviceCounts = aggregate[5] = {}
+                source = detection.deviceId
+                deviceCounts[source] = deviceCounts.get(source, 0) + 1
+
+    def timeout(self, now, maxTimeout):
+        """ Seconds until the current window closes, at most maxTimeout. """
+        if self.windowEnd is None:
+            return maxTimeout
+        return min(maxTimeout, max(0, self.windowEnd - now))
+
+    def flush(self, now):
+        """
+        Return the aggregated detections once the
+        window is over, otherwise an empty list.
+        """
+        if self.windowEnd is None or now < self.windowEnd:
+            return []
+        aggregates = self.aggregates
+        self.aggregates = {}
+        self.windowEnd = None
+        batch = []
+        for detection, count, rssiMin, rssiMax, rssiSum, deviceCounts in aggregates.values():
+            if count == 1:
+                batch.append(detection)
+                continue
+            rssi = detection.rssi
+            if deviceCounts is not None:
+                count = max(deviceCounts.values())
+                rssi = rssiMax
+                rssiSum = rssiMax*count
+            batch.append(detection.replace(
+                rssi=rssi,
+                count=count,
+                rssiMin=rssiMin,
+                rssiMax=rssiMax,
+                rssiMean=rssiSum/count))
+        return batch
+
+class DetectionWorker(Thread):
+    """
+    Drains a DetectionBuffer in batches into a handler,
+    normally EventManager.registerClients, through
+    the coalescer when one is given.
+    """
+
+    def __init__(self, detectionBuffer, handler, loggingQueue, statsInterval=60, coalescer=None):
+        super().__init__()
+        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.alive = True
+        self.buffer = detectionBuffer
+        self.handler = handler
+        self.coalescer = coalescer
+        self._statsInterval = statsInterval
+        self._lastDrops = 0
+
+    def run(self):
+        nextStats = time.monotonic() + self._statsInterval
+        coalescer = self.coalescer
+        while self.alive:
+            if coalescer:
+                batch = self.buffer.take(
+                    timeout=coalescer.timeout(time.monotonic(), 0.5))
+                coalescer.add(batch)
+                batch = coalescer.flush(time.monotonic())
+            else:
+                batch = self.buffer.take(timeout=0.5)
+            self.handle(batch)
+            if time.monotonic() >= nextStats:
+                nextStats += self._statsInterval
+                self.logStats()
+
+        # stopped, hand over what the readers put in the buffer
+        # last and the window the coalescer still has open
+        batch = self.buffer.take(timeout=0)
+        if coalescer:
+            coalescer.add(batch)
+            batch = coalescer.flush(float('inf'))
+        self.handle(batch)
+
+    def handle(self, batch):
+        if batch:
+            try:
+                self.handler(batch)
+            except Exception as e:
+                self.logger.error("Unable to register detections: %s"%e)
+
+    def logStats(self):
+        stats = self.buffer.getStats()
+        if stats['drops'] > self._lastDrops:
+            self.logger.warning("Detection buffer dropped %i detections: %s"%(
+                stats['drops'] - self._lastDrops, stats))
+        else:
+            self.logger.debug("Detection buffer: %s"%stats)
+        self._lastDrops = stats['drops']
+
+    def stop(self):
+        self.alive = False
+        self.buffer.wake()
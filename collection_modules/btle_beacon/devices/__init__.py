@@ -1 +1,2 @@
-from .detectionData import DetectionData
\ No newline at end of file
+from .detectionData import DetectionData
+from .beaconDecoder import IBeaconDecoder
\ No newline at end of file
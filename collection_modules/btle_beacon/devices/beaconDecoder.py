@@ -0,0 +1,48 @@
+"""
+Beacon decoder
+Decodes and filters iBeacon advertisements straight out of the
+scan response data, before any identifiers are formatted.
+"""
+
+import struct
+
+# AD type (manufacturer specific), Apple company id, iBeacon type and length
+_IBEACON_PREFIX = b'\xff\x4c\x00\x02\x15'
+# the prefix follows the 3 byte flags structure and the AD length byte
+_IBEACON_OFFSET = 4
+# prefix, uuid, major, minor, measured tx power
+_IBEACON = struct.Struct('>5s16sHHb')
+_IBEACON_LENGTH = _IBEACON_OFFSET + _IBEACON.size
+
+class IBeaconDecoder(object):
+    """
+    Decode iBeacon advertisement data and apply the
+    UUID focus list and major/minor ranges to the raw values.
+    """
+
+    def __init__(self, uuidFocusList=None, majorMin=0, majorMax=0xFFFF,
+            minorMin=0, minorMax=0xFFFF):
+        # raw 16 byte UUIDs, None to accept every UUID
+        self.uuidFocus = None if uuidFocusList is None else frozenset(uuidFocusList)
+        self.majorMin = majorMin
+        self.majorMax = majorMax
+        self.minorMin = minorMin
+        self.minorMax = minorMax
+
+    def decode(self, data):
+        """
+        Return (uuid, major, minor, tx) for an iBeacon advertisement
+        that passes the filters, None for anything else.
+        uuid is the raw 16 bytes.
+        """
+        if len(data) < _IBEACON_LENGTH:
+            return None
+        prefix, uuid, major, minor, tx = _IBEACON.unpack_from(data, _IBEACON_OFFSET)
+        if prefix != _IBEACON_PREFIX:
+            return None
+        if self.uuidFocus is not None and uuid not in self.uuidFocus:
+            return None
+        if (not (self.majorMin <= major <= self.majorMax) or
+            not (self.minorMin <= minor <= self.minorMax)):
+                return None
+        return uuid, major, minor, tx
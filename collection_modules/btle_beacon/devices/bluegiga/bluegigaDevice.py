@@ -2,10 +2,22 @@
 # https://github.com/jrowberg/bglib/blob/master/Python/Examples/bled112_scanner.py
 #
 #
-from .bglib import BGLib
+from .bglib import BGLib, CommandTimeout
+from .capture import CaptureSerial, CaptureWriter, ReplaySerial
 from simplesensor.shared import ThreadsafeLogger
 from serial import Serial
 import optparse
+import os
+import time
+
+# seconds between readiness checks while the dongle is not there yet
+_READY_POLL_INTERVAL = 0.25
+# seconds before the dongle is reset again after a BGAPI timeout,
+# doubled for every reset that does not bring it back
+_RESET_BACKOFF = 1.0
+_RESET_BACKOFF_MAX = 60.0
+# seconds the dongle gets to reboot, system_reset is answered by the boot event
+_BOOT_TIMEOUT = 5.0
 
 class BluegigaDevice(object):
     """
@@ -20,9 +32,20 @@ class BluegigaDevice(object):
         self.btleConfig = btleConfig
         self.scanCallback = scanCallback
         self.debug = debugMode
-        # define basic BGAPI parser
-        self.bgapi_rx_buffer = []
-        self.bgapi_rx_expected_length = 0
+        self._readTimeout = self.btleConfig['BtleDeviceReadTimeout']/1000
+        self._commandTimeout = self.btleConfig['BtleCommandTimeout']/1000
+        self._readyTimeout = self.btleConfig['BtleReadyTimeout']/1000
+
+        # Counters, seconds spent reading and parsing and
+        # bytes still waiting after the last read
+        self.parseTime = 0
+        self.backlog = 0
+        # monotonic time the next reset may be sent at
+        self._resetBackoff = _RESET_BACKOFF
+        self._nextReset = 0
+        # called from the reader once the dongle scans again after a
+        # reset, to send the settings the reset wiped
+        self.onRestarted = None
 
     def start(self):
         packet_mode = False
@@ -31,9 +54,7 @@ class BluegigaDevice(object):
         self.ble = BGLib()
         self.ble.packet_mode = packet_mode
         self.ble.debug = self.debug
-
-        # add handler for BGAPI timeout condition (hopefully won't happen)
-        self.ble.on_timeout += self.my_timeout
+        self.ble.command_timeout = self._commandTimeout
 
         # on busy hander
         self.ble.on_busy = self.on_busy
@@ -46,24 +67,35 @@ class BluegigaDevice(object):
             "BLED112 on com port %s at baud rate %s"%(
                 self.btleConfig['BtleDeviceId'],
                 self.btleConfig['BtleDeviceBaudRate']))
-        self.serial = Serial(
-            port=self.btleConfig['BtleDeviceId'], 
-            baudrate=self.btleConfig['BtleDeviceBaudRate'], 
-            timeout=1)
-        self.serial.flushInput()
-        self.serial.flushOutput()
+        started = time.monotonic()
+        self.serial = self.openWhenReady()
+
+        # add handler for BGAPI timeout condition (hopefully won't happen),
+        # only now, readiness checks time out while the dongle is not there
+        self.ble.on_timeout += self.my_timeout
 
-        # disconnect if we are connected already
-        self.ble.send_command(self.serial, self.ble.ble_cmd_connection_disconnect(0))
-        self.ble.check_activity(self.serial, 1)
+        # the commands are independent and the dongle handles them in the
+        # order they are sent, so send them all and then wait for the responses
+        self.ble.wait_commands(self.serial, self.sendCommands(self.startCommands()))
+        self.logger.info("BLED112 on %s started in %.3f s"%(
+            self.btleConfig['BtleDeviceId'], time.monotonic() - started))
 
-        # stop advertising if we are advertising already
-        self.ble.send_command(self.serial, self.ble.ble_cmd_gap_set_mode(0, 0))
-        self.ble.check_activity(self.serial, 1)
+        # set the timeout read() blocks for
+        self.serial.timeout = self._readTimeout
 
-        # stop scanning if we are scanning already
-        self.ble.send_command(self.serial, self.ble.ble_cmd_gap_end_procedure())
-        self.ble.check_activity(self.serial, 1)
+    def startCommands(self):
+        """
+        Commands that put the dongle in a known state and start
+        scanning with the configured parameters, sent on start up
+        and again after a reset.
+        """
+        commands = [
+            # disconnect if we are connected already
+            self.ble.ble_cmd_connection_disconnect(0),
+            # stop advertising if we are advertising already
+            self.ble.ble_cmd_gap_set_mode(0, 0),
+            # stop scanning if we are scanning already
+            self.ble.ble_cmd_gap_end_procedure()]
 
         # set the TX
         # range 0 to 15 (real TX power from -23 to +3dBm)
@@ -75,10 +107,8 @@ class BluegigaDevice(object):
         #interval_man 6-3200
         #latency 0-500
         #timeout 10-3200
-        self.ble.send_command(
-            self.serial, 
+        commands.append(
             self.ble.ble_cmd_connection_update(0x00,0x001e,0x002e,0x0000,0x0064))
-        self.ble.check_activity(self.serial, 1)
 
         # set scan parameters
         #scan_interval 0x4 - 0x4000
@@ -108,34 +138,151 @@ class BluegigaDevice(object):
         # read the scan response data.
         # 0: Passive scanning is used. No scan request is made.
         #self.ble.send_command(self.serial, self.ble.ble_cmd_gap_set_scan_parameters(0x4B,0x32,1))
-        self.ble.send_command(
-            self.serial, 
-            self.ble.ble_cmd_gap_set_scan_parameters(0xC8,0xC8,0))
-        self.ble.check_activity(self.serial, 1)
+        commands.append(
+            self.ble.ble_cmd_gap_set_scan_parameters(
+                self.btleConfig['BtleScanInterval'],
+                self.btleConfig['BtleScanWindow'],
+                self.btleConfig['BtleScanActive']))
 
         # start scanning now
-        self.ble.send_command(self.serial, self.ble.ble_cmd_gap_discover(1))
-        self.ble.check_activity(self.serial, 1)
+        commands.append(self.ble.ble_cmd_gap_discover(1))
+        return commands
+
+    def openWhenReady(self):
+        """
+        Open the serial port once the device exists and the dongle
+        answers system_hello, checking again until BtleReadyTimeout
+        runs out. Returns the open port with its buffers flushed.
+        """
+        deviceId = self.btleConfig['BtleDeviceId']
+        deadline = time.monotonic() + self._readyTimeout
+        waiting = False
+        while True:
+            serial = None
+            try:
+                # COM ports on windows are not paths
+                if (not self.btleConfig['BtleReplayFile'] and
+                    deviceId.startswith('/') and not os.path.exists(deviceId)):
+                    raise IOError("%s does not exist"%deviceId)
+                serial = self.openSerial()
+                serial.flushInput()
+                serial.flushOutput()
+                hello = self.ble.send_command(serial, self.ble.ble_cmd_system_hello())
+                self.ble.wait_commands(serial, (hello,))
+                hello.result()
+                return serial
+            except Exception as e:
+                if serial is not None:
+                    serial.close()
+                if time.monotonic() >= deadline:
+                    raise
+                if not waiting:
+                    waiting = True
+                    self.logger.info("Waiting for BLED112 on %s: %s"%(deviceId, e))
+                time.sleep(_READY_POLL_INTERVAL)
+
+    def openSerial(self):
+        """
+        Serial port of the dongle, or a capture being replayed
+        in place of it. Reads are recorded when capturing.
+        """
+        if self.btleConfig['BtleReplayFile']:
+            self.logger.info("Replaying capture %s at speed %s"%(
+                self.btleConfig['BtleReplayFile'], self.btleConfig['BtleReplaySpeed']))
+            serial = ReplaySerial(
+                self.btleConfig['BtleReplayFile'],
+                speed=self.btleConfig['BtleReplaySpeed'],
+                loop=self.btleConfig['BtleReplayLoop'],
+                timeout=1)
+        else:
+            serial = Serial(
+                port=self.btleConfig['BtleDeviceId'], 
+                baudrate=self.btleConfig['BtleDeviceBaudRate'], 
+                timeout=1)
+        if self.btleConfig['BtleCaptureFile']:
+            self.logger.info("Capturing to %s"%self.btleConfig['BtleCaptureFile'])
+            serial = CaptureSerial(serial, CaptureWriter(self.btleConfig['BtleCaptureFile']))
+        return serial
+
+    def close(self):
+        serial = getattr(self, 'serial', None)
+        if serial is not None:
+            serial.close()
 
     # handler to notify of an API parser timeout condition
     def my_timeout(self,sender, args):
         self.logger.error( "BGAPI timed out. Make sure the BLE device is in a known/idle state." )
-        # might want to try the following lines to reset, though it probably
-        # wouldn't work at this point if it's already timed out:
-        self.ble.send_command(self.serial, self.ble.ble_cmd_system_reset(0))
-        self.ble.check_activity(self.serial, 1)
-        self.ble.send_command(self.serial, self.ble.ble_cmd_gap_discover(1))
-        self.ble.check_activity(self.serial, 1)
+        now = time.monotonic()
+        if now < self._nextReset:
+            return
+        # try to reset, backing off while the resets time out as well.
+        # The reader picks up the boot event, nothing blocks on it here.
+        self._nextReset = now + self._resetBackoff
+        self._resetBackoff = min(self._resetBackoff*2, _RESET_BACKOFF_MAX)
+        self.logger.info("Resetting BLED112, next reset in %.0f s at the earliest"%(
+            self._nextReset - now))
+        reset, = self.sendCommands((self.ble.ble_cmd_system_reset(0),), _BOOT_TIMEOUT)
+        reset.add_done_callback(self.resetDone)
+
+    def resetDone(self, future):
+        """
+        The dongle booted, or the reset timed out and the next
+        timeout tries again. A reset wipes the scan parameters,
+        so everything start sent goes out again.
+        """
+        if future.exception() is not None:
+            return
+        self.logger.info("BLED112 on %s booted, starting to scan again"%
+            self.btleConfig['BtleDeviceId'])
+        self.sendCommands(self.startCommands())
+        if self.onRestarted:
+            self.onRestarted()
+        self._resetBackoff = _RESET_BACKOFF
+        self._nextReset = 0
 
     def on_busy(self,sender, args):
         self.logger.warn( "BGAPI device is busy." )
 
     def scan(self):
         # check for all incoming data (no timeout, non-blocking)
+        start = time.perf_counter()
         self.ble.check_activity(self.serial)
+        self.parseTime += time.perf_counter() - start
+        if self.ble.pending_commands:
+            self.ble.expire_commands()
 
         # check for all incoming data (with timeout)
         # self.ble.check_activity(self.serial,timeout=1)
 
+    def sendCommands(self, packets, timeout=None):
+        """
+        Send commands without waiting for their responses, those are
+        parsed along with the scan data. Returns the response futures.
+        """
+        futures = [self.ble.send_command(self.serial, packet, timeout) for packet in packets]
+        for future in futures:
+            future.add_done_callback(self.commandDone)
+        return futures
 
+    def commandDone(self, future):
+        if isinstance(future.exception(), CommandTimeout):
+            self.logger.warning("BGAPI %s"%future.exception())
 
+    def read(self):
+        """
+        Block until data arrives from the device, or the read timeout
+        passes, then parse everything that is waiting in one go.
+        """
+        if self.ble.pending_commands:
+            self.ble.expire_commands()
+        data = self.serial.read(1)
+        if not data:
+            self.backlog = 0
+            return
+        start = time.perf_counter()
+        self.ble.parse_chunk(data)
+        waiting = self.serial.inWaiting()
+        if waiting:
+            self.ble.parse_chunk(self.serial.read(waiting))
+        self.parseTime += time.perf_counter() - start
+        self.backlog = self.serial.inWaiting()
@@ -0,0 +1,251 @@
+"""
+Capture
+Records the bytes read from a BLED112 and plays them back.
+
+A capture file is an 8 byte header, CAPTURE_MAGIC, followed by one
+record per serial read: the time.monotonic_ns() of the read as an
+unsigned 64 bit int, the length as an unsigned 16 bit int and the
+bytes, all little endian. Captures are appended to, so a file can
+hold several sessions, each starting with a record of length 0. The
+monotonic clock of every session has its own origin, readCapture
+moves each session to start where the one before it stopped.
+
+ReplaySerial stands in for the Serial object of BluegigaDevice and
+feeds a capture into BGLib at the recorded speed, N times faster or
+as fast as the reader takes it. It answers the commands written to it
+with a successful response, like a dongle would, and leaves out the
+responses recorded in the capture.
+"""
+
+import struct
+import time
+from threading import Condition
+from .bglib import _DISPATCH_TABLE, _PACKET_TYPES
+
+CAPTURE_MAGIC = b'BGCAP\x00\x01\x00'
+
+_RECORD = struct.Struct('<QH')
+_MAX_RECORD = 0xFFFF
+
+def commandResponse(packetClass, packetCommand):
+    """ Successful response to a BLE command, all fields zero. """
+    if (packetClass, packetCommand) == (0, 0):
+        # system_reset answers with the boot event
+        payloadStruct = _DISPATCH_TABLE[(0x80, 0, 0)][0]
+        return struct.pack('<4B', 0x80, payloadStruct.size, 0, 0) + bytes(payloadStruct.size)
+    entry = _DISPATCH_TABLE.get((0x00, packetClass, packetCommand))
+    size = entry[0].size if entry else 0
+    return struct.pack('<4B', 0x00, size, packetClass, packetCommand) + bytes(size)
+
+def readCapture(path):
+    """
+    Yield (ns, bytes) for every record of a capture file, the
+    sessions after the first rebased to follow the one before.
+    """
+    offset = 0
+    last = None
+    rebase = False
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not a capture file"%path)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            timestamp, length = _RECORD.unpack(header)
+            if not length:
+                # session start
+                rebase = last is not None
+                continue
+            data = f.read(length)
+            if len(data) < length:
+                # cut short, eg. by a crash while recording
+                return
+            if rebase:
+                offset = last - timestamp
+                rebase = False
+            last = timestamp = timestamp + offset
+            yield timestamp, data
+
+class CaptureWriter(object):
+    """ Appends serial reads to a capture file. """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        self.file.write(_RECORD.pack(time.monotonic_ns(), 0))
+        self.records = 0
+
+    def write(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        for pos in range(0, len(data), _MAX_RECORD):
+            chunk = data[pos:pos + _MAX_RECORD]
+            self.file.write(_RECORD.pack(timestamp, len(chunk)))
+            self.file.write(chunk)
+            self.records += 1
+
+    def close(self):
+        self.file.close()
+
+class CaptureSerial(object):
+    """
+    Wraps a Serial object and records everything read from it.
+    """
+
+    def __init__(self, serial, writer):
+        self.serial = serial
+        self.writer = writer
+
+    @property
+    def timeout(self):
+        return self.serial.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.serial.timeout = value
+
+    def read(self, size=1):
+        data = self.serial.read(size)
+        if data:
+            self.writer.write(data)
+        return data
+
+    def close(self):
+        self.serial.close()
+        self.writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+class ReplaySerial(object):
+    """
+    Serial port lookalike playing back a capture file.
+    speed 1 replays at the recorded speed, 2 twice as fast and
+    0 as fast as possible. With loop the capture starts over
+    when it runs out, otherwise reads just time out from then on.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False, timeout=None):
+        self.port = path
+        self.speed = speed
+        self.loop = loop
+        self.timeout = timeout
+
+        self.records = list(readCapture(path))
+        self.position = 0
+        # capture time mapped to the start of playback, in ns
+        self.captureStart = self.records[0][0] if self.records else 0
+        self.playbackStart = time.monotonic_ns()
+        self.finished = not self.records
+        self.loops = 0
+
+        # released capture bytes not yet cut into whole packets
+        self.pending = bytearray()
+        # whole packets and command responses ready to be read
+        self.output = bytearray()
+        self.condition = Condition()
+
+    def release(self, now):
+        """ Move the records that are due into the output buffer. """
+        records = self.records
+        while not self.finished:
+            timestamp, data = records[self.position]
+            if self.speed > 0 and (timestamp - self.captureStart)/self.speed > now - self.playbackStart:
+                return
+            self.pending += data
+            self.position += 1
+            if self.position == len(records):
+                if self.loop:
+                    self.position = 0
+                    self.loops += 1
+                    self.playbackStart = now
+                else:
+                    self.finished = True
+            if self.speed == 0 and len(self.output) + len(self.pending) >= _MAX_RECORD:
+                break
+        self.cutPackets()
+
+    def cutPackets(self):
+        """
+        Move whole event packets from pending to output, so command
+        responses are never written into the middle of a packet.
+        Recorded responses belong to commands of the recording
+        session and are left out.
+        """
+        pending = self.pending
+        pos = 0
+        end = len(pending)
+        while pos < end:
+            packetType = pending[pos]
+            if packetType not in _PACKET_TYPES:
+                pos += 1
+                continue
+            if end - pos < 2:
+                break
+            length = 4 + (packetType & 0x07) + pending[pos + 1]
+            if end - pos < length:
+                break
+            if packetType & 0x80:
+                self.output += pending[pos:pos + length]
+            pos += length
+        del pending[:pos]
+
+    def nextDue(self):
+        """ Monotonic ns at which the next record is due. """
+        timestamp = self.records[self.position][0]
+        return self.playbackStart + max(0, timestamp - self.captureStart)/self.speed
+
+    def inWaiting(self):
+        with self.condition:
+            self.release(time.monotonic_ns())
+            return len(self.output)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def read(self, size=1):
+        """
+        Return up to size bytes, waiting for the next record
+        to come due for as long as the timeout allows.
+        """
+        with self.condition:
+            now = time.monotonic_ns()
+            deadline = None if self.timeout is None else now + int(self.timeout*1e9)
+            self.release(now)
+            while not self.output:
+                if deadline is not None and now >= deadline:
+                    return b''
+                wait = deadline
+                if not self.finished and self.speed > 0:
+                    wait = self.nextDue() if wait is None else min(wait, self.nextDue())
+                self.condition.wait(None if wait is None else max(0, wait - now)/1e9)
+                now = time.monotonic_ns()
+                self.release(now)
+            data = bytes(self.output[:size])
+            del self.output[:size]
+            return data
+
+    def write(self, data):
+        """ Answer every command in data with a successful response. """
+        with self.condition:
+            pos = 0
+            while pos + 4 <= len(data):
+                length = 4 + (data[pos] & 0x07) + data[pos + 1]
+                self.output += commandResponse(data[pos + 2], data[pos + 3])
+                pos += length
+            self.condition.notify_all()
+        return len(data)
+
+    def flushInput(self):
+        with self.condition:
+            del self.output[:]
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        self.finished = True
@@ -5,11 +5,16 @@ import platform
 from threading import Thread
 # from multiprocessing import Process
 from . import BluegigaDevice
-from .. import DetectionData
-from simplesensor.shared import ThreadsafeLogger
+from .scanFilter import ScanFilter
+from .dutyCycle import DutyCycleController
+from .. import DetectionData, IBeaconDecoder
+from ...moduleLogger import ModuleLogger
+from ...uidMap import sharedUIDMap, DROP
 
 # required callback keys
 _ON_SCAN = 'onScan'
+# optional callback keys
+_ON_SCAN_BATCH = 'onScanBatch'
 
 class DeviceThread(Thread):
     """
@@ -19,24 +24,41 @@ class DeviceThread(Thread):
         super().__init__()
         # Logger
         self.loggingQueue = loggingQueue
-        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.logger = ModuleLogger(loggingQueue, __name__, btleConfig)
         self.alive = True
         self.callbacks = self.sanitizeCallbacks(callbacks)
         self.btleConfig = btleConfig
 
         # consts
-        self._majorMin = self.btleConfig['BtleAdvertisingMajorMin']
-        self._majorMax = self.btleConfig['BtleAdvertisingMajorMax']
-        self._minorMin = self.btleConfig['BtleAdvertisingMinorMin']
-        self._minorMax = self.btleConfig['BtleAdvertisingMinorMax']
-        self._uuidFocusList = self.btleConfig['BtleUuidFocusList']
-
-        if ('any' in self._uuidFocusList or 
-            'all' in self._uuidFocusList or
-            len(self._uuidFocusList)==0):
-            self.filterOnUuid = False
+        self._testMode = self.btleConfig['BtleTestMode']
+        self._readMode = self.btleConfig['BtleDeviceReadMode']
+        self._deviceId = self.btleConfig['BtleDeviceId']
+
+        # Counters
+        self.advertisementCount = 0
+        self.detectionCount = 0
+        self.unmappedCount = 0
+
+        # detections parsed from one read are handed over together
+        # when the batch callback is given
+        self._batch = []
+        self._onScanBatch = self.callbacks.get(_ON_SCAN_BATCH)
+        if self._onScanBatch:
+            self._onScan = self._batch.append
         else:
-            self.filterOnUuid = True
+            self._onScan = self.callbacks[_ON_SCAN]
+
+        self.decoder = IBeaconDecoder(
+            self.uuidFocusBytes(self.btleConfig['BtleUuidFocusList']),
+            self.btleConfig['BtleAdvertisingMajorMin'],
+            self.btleConfig['BtleAdvertisingMajorMax'],
+            self.btleConfig['BtleAdvertisingMinorMin'],
+            self.btleConfig['BtleAdvertisingMinorMax'])
+
+        # uuids not in the uid map are dropped before the registry sees them
+        self.uidMap = None
+        if self.btleConfig['UidMapUnmappedPolicy'] == DROP:
+            self.uidMap = sharedUIDMap(self.btleConfig, self.loggingQueue)
 
         # self.queue = queue
         self.device = BluegigaDevice(
@@ -44,10 +66,30 @@ class DeviceThread(Thread):
             self.btleConfig,
             self.loggingQueue)
 
+        # filtering on the dongle
+        self.scanFilter = None
+        if (self.btleConfig['BtleWhitelistEnabled'] or
+            self.btleConfig['BtleScanDuplicateFiltering']):
+            self.scanFilter = ScanFilter(
+                self.device,
+                self.btleConfig,
+                self.loggingQueue)
+
+        # scan duty cycle following the load
+        self.dutyCycle = None
+        if self.btleConfig['BtleDutyCycleEnabled']:
+            self.dutyCycle = DutyCycleController(
+                self,
+                self.btleConfig,
+                self.loggingQueue)
+
+        if self.scanFilter or self.dutyCycle:
+            self.device.onRestarted = self.deviceRestarted
+
     def run(self):
         """
         Main thread entry point.
-        Repeatedly call scan() method on
+        Repeatedly read from the
         device controller BluegigaDevice.
 
         Send results or failures back to main
@@ -56,10 +98,38 @@ class DeviceThread(Thread):
         try:
             self.device.start()
         except Exception as e:
-            self.logger.error("Unable to connect to BTLE device: %s"%e)
+            self.logger.error("Unable to connect to BTLE device: %s", e)
             self.sendFailureNotice("Unable to connect to BTLE device")
             self.stop()
 
+        if self.alive and self.scanFilter:
+            self.scanFilter.start(time.monotonic())
+        if self.alive and self.dutyCycle:
+            self.dutyCycle.start(time.monotonic())
+
+        if self._readMode == 'poll':
+            self.pollLoop()
+        else:
+            self.readLoop()
+        self.device.close()
+
+    def readLoop(self):
+        """
+        Block on the device until data arrives, so advertisements
+        are handled as soon as they come in and the thread sleeps
+        while the room is quiet.
+        """
+        controlled = self.scanFilter or self.dutyCycle
+        while self.alive:
+            self.device.read()
+            self.flushBatch()
+            if controlled:
+                self.tickControllers()
+
+    def pollLoop(self):
+        """
+        Check the device for data every 10ms.
+        """
         while self.alive:
             # try:
             self.device.scan()
@@ -67,88 +137,123 @@ class DeviceThread(Thread):
             #     self.logger.error("Unable to scan BTLE device: %s"%e)
             #     self.sendFailureNotice("Unable to connect to BTLE device to perform a scan")
             #     self.stop()
+            self.flushBatch()
+            if self.scanFilter or self.dutyCycle:
+                self.tickControllers()
 
             # don't burden the CPU
             time.sleep(0.01)
 
+    def tickControllers(self):
+        """
+        Let the dongle controllers send their commands,
+        only this thread writes to the device.
+        """
+        now = time.monotonic()
+        if self.scanFilter:
+            self.scanFilter.tick(now)
+        if self.dutyCycle:
+            self.dutyCycle.tick(now)
+
+    def deviceRestarted(self):
+        """
+        The dongle was reset and scans with the configured parameters
+        again, the controllers send what they had set up once more.
+        Called from this thread by the reader.
+        """
+        if self.dutyCycle:
+            self.dutyCycle.restore()
+        if self.scanFilter:
+            self.scanFilter.restore()
+
+    def flushBatch(self):
+        """
+        Hand the detections collected since the last flush
+        to the batch callback.
+        """
+        if self._batch:
+            batch = self._batch[:]
+            del self._batch[:]
+            self._onScanBatch(batch)
+
+    def uuidFocusBytes(self, uuidFocusList):
+        """
+        Convert the configured UUID focus list to raw 16 byte UUIDs.
+        Return None when every UUID should be accepted.
+        """
+        if ('any' in uuidFocusList or 
+            'all' in uuidFocusList or
+            len(uuidFocusList)==0):
+            return None
+
+        uuids = []
+        for udid in uuidFocusList:
+            try:
+                uuid = bytes.fromhex(udid)
+            except ValueError:
+                uuid = b''
+            if len(uuid) != 16:
+                self.logger.warning("Ignoring invalid UUID in focus list: %s", udid)
+                continue
+            uuids.append(uuid)
+        return uuids
+
     def scanCallback(self,sender,args):
         """
         Callback for the scan event on the device controller.
-        Prints the event in a formatted way for tuning purposes.
+        Decodes and filters the advertisement, the raw MAC and
+        UUID bytes are kept, hex is only made when a message is
+        serialized.
         """
-        #check to make sure there is enough data to be a beacon
-        if len(args["data"]) > 15:
-            try:
-                majorNumber = args["data"][26] | (args["data"][25] << 8)
-                # self.logger.debug("majorNumber=%i"%majorNumber)
-            except:
-                majorNumber = 0
-            try:
-                minorNumber = args["data"][28] | (args["data"][27] << 8)
-                # self.logger.debug("minorNumber=%i"%minorNumber)
-            except:
-                minorNumber = 0
+        self.advertisementCount += 1
+        beacon = self.decoder.decode(args["data"])
+        if beacon is None:
+            return
+        if self.uidMap is not None and beacon[0] not in self.uidMap.map:
+            self.unmappedCount += 1
+            return
 
-            try:
-                udid = "%s" % ''.join(['%02X' % b for b in args["data"][9:25]])
-            except:
-                pass
-
-            if (self.filterOnUuid and udid not in self._uuidFocusList):
-                return
-
-            if (not (self._majorMin <= majorNumber <= self._majorMax) or 
-                not (self._minorMin <= minorNumber <= self._minorMax)):
-                    return
-
-            rssi = args["rssi"]
-            beaconMac = "%s" % ''.join(['%02X' % b for b in args["sender"][::-1]])
-
-            if len(args["data"]) > 29:
-                rawTxPower = args["data"][29]
-            else:
-                rawTxPower = 0
-
-            if rawTxPower <= 127:
-                txPower = rawTxPower
-            else:
-                txPower = rawTxPower - 256
-
-            if self.btleConfig['BtleTestMode']:
-                self.logger.debug("=============================== eventScanResponse START ===============================")
-                #self.logger.debug("self.btleConfig['BtleAdvertisingMinor'] == %i and self.btleConfig['BtleAdvertisingMinor'] == %i "%(majorNumber,minorNumber))
-                #self.logger.debug("yep, we care about this major and minor so lets create a detected client and pass it to the event manager")
-                self.logger.debug("Major=%s"%majorNumber)
-                self.logger.debug("Minor=%s"%minorNumber)
-                self.logger.debug("UDID=%s"%udid)
-                self.logger.debug("rssi=%s"%rssi)
-                self.logger.debug("beaconMac=%s"%beaconMac)
-                self.logger.debug("txPower=%i"%txPower)
-                self.logger.debug("rawTxPower=%i"%rawTxPower)
-                self.logger.debug("================================= eventScanResponse END =================================")
-
-            #package it up for sending to the queue
-            detectionData = DetectionData(
-                'btle',
-                udid=udid,
-                beaconMac=beaconMac,
-                majorNumber=majorNumber,
-                minorNumber=minorNumber,
-                tx=txPower,
-                rssi=rssi)
-            
-            #put it on the queue for the event manager to pick up
-            self.callbacks[_ON_SCAN](detectionData)
+        if self.scanFilter:
+            self.scanFilter.observe(args["sender"], args["address_type"])
+
+        uuid, majorNumber, minorNumber, txPower = beacon
+        sender = args["sender"]
+        rssi = args["rssi"]
+
+        if self._testMode:
+            # once per beacon per sample interval, not for every packet
+            self.logger.debugSampled(sender, "\n".join((
+                "=============================== eventScanResponse START ===============================",
+                "Major=%s",
+                "Minor=%s",
+                "UDID=%s",
+                "rssi=%s",
+                "beaconMac=%s",
+                "txPower=%i",
+                "================================= eventScanResponse END =================================")),
+                majorNumber, minorNumber, uuid.hex().upper(), rssi,
+                sender[::-1].hex().upper(), txPower)
+
+        #package it up for sending to the queue, the one object made per packet
+        detectionData = DetectionData.fromFields((
+            sender, uuid, majorNumber, minorNumber, txPower, rssi,
+            time.monotonic_ns(), self._deviceId, 1, rssi, rssi, rssi))
+
+        #put it on the queue for the event manager to pick up
+        self.detectionCount += 1
+        self._onScan(detectionData)
 
     def sanitizeCallbacks(self, cbs):
         """
         Make sure required callbacks are included and callable.
-        Return only the required callbacks.
+        Return only the required and optional callbacks.
         """
         assert(callable(cbs[_ON_SCAN]))
-        if len(cbs) > 1:
-            return [cbs[_ON_SCAN]]
-        return cbs
+        sanitized = {_ON_SCAN: cbs[_ON_SCAN]}
+        if cbs.get(_ON_SCAN_BATCH) is not None:
+            assert(callable(cbs[_ON_SCAN_BATCH]))
+            sanitized[_ON_SCAN_BATCH] = cbs[_ON_SCAN_BATCH]
+        return sanitized
 
     def stop(self):
         self.alive = False
@@ -0,0 +1,134 @@
+"""
+DutyCycleController
+Moves the dongle between scan duty cycle profiles with the load.
+
+Every second the controller looks at the advertisement rate, the bytes
+left waiting on the serial port after a read and the share of time the
+reader spends parsing. When the port backs up it switches to the
+throttled profile, when the room is empty to the idle profile, and to
+the normal profile (the configured scan parameters) otherwise.
+
+Entering a profile takes a threshold to be crossed, leaving it takes
+the load to fall to half of it, and a profile is kept for at least the
+hold time, so the dongle does not flap between profiles.
+
+A dongle scanning at a lower duty cycle hears fewer advertisements, so
+the measured rate is scaled by the scan window/interval ratio of the
+normal profile over the current one before it is compared, the rate
+thresholds are always rates at the normal profile.
+"""
+
+from simplesensor.shared import ThreadsafeLogger
+
+IDLE = 'idle'
+NORMAL = 'normal'
+THROTTLED = 'throttled'
+
+# seconds between load checks
+_EVALUATION_INTERVAL = 1.0
+# gap_discover mode
+_DISCOVER_OBSERVATION = 1
+
+class DutyCycleController(object):
+
+    def __init__(self, deviceThread, btleConfig, loggingQueue):
+        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.deviceThread = deviceThread
+        self.device = deviceThread.device
+
+        # profile name -> (scan interval, scan window, active)
+        self.profiles = {
+            NORMAL: (
+                btleConfig['BtleScanInterval'],
+                btleConfig['BtleScanWindow'],
+                btleConfig['BtleScanActive'])
+            }
+        for name, parameters in btleConfig['BtleDutyCycleProfiles'].items():
+            self.profiles[name] = tuple(parameters)
+        self._normalDuty = self.duty(NORMAL)
+
+        # consts
+        self._idleRate = btleConfig['BtleDutyCycleIdleRate']
+        self._busyRate = btleConfig['BtleDutyCycleBusyRate']
+        self._busyBacklog = btleConfig['BtleDutyCycleBusyBacklog']
+        self._busyParseLoad = btleConfig['BtleDutyCycleBusyParseLoad']
+        self._hold = btleConfig['BtleDutyCycleHold']/1000
+
+        self.profile = NORMAL
+        self.changes = 0
+        self.profileSince = None
+        self.nextEvaluation = None
+        self.lastAdvertisements = 0
+        self.lastParseTime = 0
+
+    def start(self, now):
+        self.profileSince = now
+        self.nextEvaluation = now + _EVALUATION_INTERVAL
+        self.lastAdvertisements = self.deviceThread.advertisementCount
+        self.lastParseTime = self.device.parseTime
+
+    def tick(self, now):
+        """ Called from the device thread after every read. """
+        if now < self.nextEvaluation:
+            return
+        elapsed = now - self.nextEvaluation + _EVALUATION_INTERVAL
+        self.nextEvaluation = now + _EVALUATION_INTERVAL
+
+        advertisements = self.deviceThread.advertisementCount
+        parseTime = self.device.parseTime
+        # at the normal profile's duty cycle
+        rate = (advertisements - self.lastAdvertisements)/elapsed*self._normalDuty/self.duty(self.profile)
+        parseLoad = (parseTime - self.lastParseTime)/elapsed
+        backlog = self.device.backlog
+        self.lastAdvertisements = advertisements
+        self.lastParseTime = parseTime
+
+        target = self.targetProfile(rate, backlog, parseLoad)
+        if target != self.profile and now - self.profileSince >= self._hold:
+            self.setProfile(target, now, rate, backlog, parseLoad)
+
+    def duty(self, name):
+        """ Share of the time a profile scans, window over interval. """
+        interval, window, active = self.profiles[name]
+        return window/interval
+
+    def targetProfile(self, rate, backlog, parseLoad):
+        """
+        Profile for the load, entering at a threshold and leaving
+        at half. rate is scaled to the normal profile.
+        """
+        scale = 0.5 if self.profile == THROTTLED else 1
+        if (rate > self._busyRate*scale or
+            backlog > self._busyBacklog*scale or
+            parseLoad > self._busyParseLoad*scale):
+            return THROTTLED
+        scale = 2 if self.profile == IDLE else 1
+        if rate < self._idleRate*scale:
+            return IDLE
+        return NORMAL
+
+    def setProfile(self, name, now, rate, backlog, parseLoad):
+        interval, window, active = self.sendProfile(name)
+        self.changes += 1
+        self.logger.info(("duty_cycle device=%s profile=%s previous=%s held_s=%.1f "+
+            "rate=%.1f backlog=%i parse_load=%.3f interval=%i window=%i active=%i changes=%i")%(
+            self.deviceThread.btleConfig['BtleDeviceId'], name, self.profile,
+            now - self.profileSince, rate, backlog, parseLoad,
+            interval, window, active, self.changes))
+        self.profile = name
+        self.profileSince = now
+
+    def sendProfile(self, name):
+        """ Scan with the parameters of a profile, returns them. """
+        interval, window, active = self.profiles[name]
+        ble = self.device.ble
+        self.device.sendCommands((
+            ble.ble_cmd_gap_end_procedure(),
+            ble.ble_cmd_gap_set_scan_parameters(interval, window, active),
+            ble.ble_cmd_gap_discover(_DISCOVER_OBSERVATION)))
+        return interval, window, active
+
+    def restore(self):
+        """ Send the current profile again after the dongle was reset. """
+        if self.profile != NORMAL:
+            self.sendProfile(self.profile)
@@ -0,0 +1,192 @@
+"""
+ScanFilter
+Filters advertisements on the dongle instead of on the host.
+
+The controller whitelist is filled with the MACs of beacons we care
+about, the configured ones plus every beacon that passes the decoder
+filters during a learning window, and the dongle is switched to only
+report whitelisted advertisers. Learning windows are reopened
+periodically and each one rebuilds the learned part of the whitelist,
+so beacons that left fall out of it. MACs the registry has dropped are
+taken out right away.
+
+While the dongle filters it does not report beacons that are not on the
+whitelist, so a beacon that arrives, or comes back after it was dropped,
+is picked up by the next learning window. While it reports everything,
+the whitelist being empty or too big for the dongle, beacons are added
+as they are heard.
+
+Scan duplicate filtering makes the dongle report each advertiser once
+per scan, scanning is restarted periodically to get fresh RSSI values.
+
+All commands are sent from the device thread, other threads only hand
+MACs to forget through a deque.
+"""
+
+from simplesensor.shared import ThreadsafeLogger
+from collections import deque
+
+# gap_set_filtering scan policies
+_SCAN_ALL = 0
+_SCAN_WHITELIST = 1
+# gap_discover mode
+_DISCOVER_OBSERVATION = 1
+
+class ScanFilter(object):
+
+    def __init__(self, device, btleConfig, loggingQueue):
+        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.device = device
+
+        # consts
+        self._whitelistEnabled = btleConfig['BtleWhitelistEnabled']
+        self._learningWindow = btleConfig['BtleWhitelistLearningWindow']/1000
+        self._relearnInterval = btleConfig['BtleWhitelistRelearnInterval']/1000
+        self._maxSize = btleConfig['BtleWhitelistMaxSize']
+        self._duplicateFiltering = btleConfig['BtleScanDuplicateFiltering']
+        self._rearmInterval = btleConfig['BtleScanDuplicateRearmInterval']/1000
+
+        # raw little endian address -> address type
+        self.configured = self.parseMacs(btleConfig['BtleWhitelist'])
+        self.whitelist = dict(self.configured)
+        # MACs other threads want taken out, as raw over the air bytes
+        self.forgotten = deque()
+
+        self.learning = False
+        self.dirty = False
+        # gap_set_filtering scan policy last sent
+        self.scanPolicy = _SCAN_ALL
+        self.learningEnd = None
+        self.nextRelearn = None
+        self.nextRearm = None
+        self.full = False
+
+    def parseMacs(self, macs):
+        """
+        Configured MACs as hex, optionally with /0 (public)
+        or /1 (random) for the address type, random by default.
+        """
+        parsed = {}
+        for mac in macs:
+            address, _, addressType = mac.partition('/')
+            try:
+                raw = bytes.fromhex(address.replace(':', ''))[::-1]
+                addressType = int(addressType) if addressType else 1
+            except ValueError:
+                raw = b''
+            if len(raw) != 6:
+                self.logger.warning("Ignoring invalid MAC in whitelist: %s"%mac)
+                continue
+            parsed[raw] = addressType
+        return parsed
+
+    def start(self, now):
+        """ Set up filtering right after the device started scanning. """
+        if self._whitelistEnabled and self._learningWindow > 0:
+            self.startLearning(now)
+        else:
+            self.apply()
+        if self._whitelistEnabled and self._relearnInterval > 0:
+            self.nextRelearn = now + self._relearnInterval
+        if self._duplicateFiltering and self._rearmInterval > 0:
+            self.nextRearm = now + self._rearmInterval
+
+    def observe(self, sender, addressType):
+        """
+        Called from the scan callback for beacons that pass
+        the decoder filters.
+        """
+        if sender in self.whitelist:
+            return
+        if self.learning:
+            self.whitelist[sender] = addressType
+        elif self.scanPolicy == _SCAN_ALL and self._whitelistEnabled:
+            # not filtering, the whitelist can start or keep
+            # growing, it only needs loading if it fits
+            self.whitelist[sender] = addressType
+            self.dirty = self.dirty or len(self.whitelist) <= self._maxSize
+
+    def forget(self, mac):
+        """ Thread safe, mac as raw bytes like the registry keys. """
+        self.forgotten.append(mac)
+
+    def tick(self, now):
+        """ Called from the device thread after every read. """
+        while self.forgotten:
+            raw = self.forgotten.popleft()
+            if raw in self.whitelist and raw not in self.configured:
+                del self.whitelist[raw]
+                self.dirty = True
+
+        if self.learning and now >= self.learningEnd:
+            self.learning = False
+            self.logger.info("Whitelist learning done, %i MACs"%len(self.whitelist))
+            self.apply()
+        elif self.nextRelearn is not None and now >= self.nextRelearn:
+            self.nextRelearn = now + self._relearnInterval
+            self.startLearning(now)
+        elif self.dirty and not self.learning:
+            self.apply()
+        elif self.nextRearm is not None and now >= self.nextRearm:
+            # restart scanning so the dongle reports every advertiser again
+            self.device.sendCommands((
+                self.device.ble.ble_cmd_gap_end_procedure(),
+                self.device.ble.ble_cmd_gap_discover(_DISCOVER_OBSERVATION)))
+
+        if self.nextRearm is not None and now >= self.nextRearm:
+            self.nextRearm = now + self._rearmInterval
+
+    def restore(self):
+        """ Send the filtering again after the dongle was reset. """
+        if self.learning or self.full:
+            self.setFiltering(_SCAN_ALL)
+        else:
+            self.apply()
+
+    def startLearning(self, now):
+        """
+        Scan everything for a while to learn the MACs of our beacons,
+        starting over from the configured ones.
+        """
+        self.learning = True
+        self.learningEnd = now + self._learningWindow
+        self.whitelist = dict(self.configured)
+        self.setFiltering(_SCAN_ALL)
+
+    def apply(self):
+        """ Load the whitelist into the dongle and filter on it. """
+        self.dirty = False
+        ble = self.device.ble
+        if not self._whitelistEnabled:
+            self.setFiltering(_SCAN_ALL)
+            return
+
+        if len(self.whitelist) > self._maxSize:
+            if not self.full:
+                self.logger.warning("%i MACs do not fit in the whitelist of %i, "%(
+                    len(self.whitelist), self._maxSize)+"scanning without it")
+            self.full = True
+            if self.scanPolicy != _SCAN_ALL:
+                self.setFiltering(_SCAN_ALL)
+            return
+        self.full = False
+
+        commands = [ble.ble_cmd_gap_end_procedure(), ble.ble_cmd_system_whitelist_clear()]
+        for address, addressType in self.whitelist.items():
+            commands.append(ble.ble_cmd_system_whitelist_append(address, addressType))
+        self.scanPolicy = _SCAN_WHITELIST if self.whitelist else _SCAN_ALL
+        commands.append(ble.ble_cmd_gap_set_filtering(
+            self.scanPolicy,
+            0,
+            int(self._duplicateFiltering)))
+        commands.append(ble.ble_cmd_gap_discover(_DISCOVER_OBSERVATION))
+        self.device.sendCommands(commands)
+        self.logger.info("Whitelist loaded with %i MACs"%len(self.whitelist))
+
+    def setFiltering(self, scanPolicy):
+        self.scanPolicy = scanPolicy
+        ble = self.device.ble
+        self.device.sendCommands((
+            ble.ble_cmd_gap_end_procedure(),
+            ble.ble_cmd_gap_set_filtering(scanPolicy, 0, int(self._duplicateFiltering)),
+            ble.ble_cmd_gap_discover(_DISCOVER_OBSERVATION)))
@@ -2,20 +2,96 @@
 Detection data
 The raw event from the device interface.
 """
-from datetime import datetime 
-class DetectionData(object):
-    def __init__(self,type,**kwargs):
-        self.type=type
-        if self.type == 'btle':
-            self.udid=kwargs.get('udid','undefined')
-            self.createTime = datetime.now()
-            self.extraData = {}
-            self.extraData['beaconMac'] = kwargs.get('beaconMac','undefined')
-            self.extraData['majorNumber'] = kwargs.get('majorNumber',0)
-            self.extraData['minorNumber'] = kwargs.get('minorNumber',0)
-            self.extraData['udid'] = self.udid
-            self.extraData['tx'] = kwargs.get('tx',0)
-            self.extraData['rssi'] = kwargs.get('rssi',0)
+from operator import itemgetter
+
+class DetectionData(tuple):
+    """
+    One advertisement, or several folded together, as an immutable tuple
+    of (mac, uuid, major, minor, tx, rssi, timestamp, deviceId, count,
+    rssiMin, rssiMax, rssiMean).
+
+    mac and uuid are the raw bytes of the packet, mac in over the air
+    (little endian) order. timestamp is the time.monotonic_ns() the
+    advertisement was parsed at. count, rssiMin, rssiMax and rssiMean
+    describe folded advertisements, for a single one they are 1 and rssi.
+    Hex strings and the dict view are only made when asked for.
+    """
+
+    __slots__ = ()
+
+    _fields = ('mac', 'uuid', 'major', 'minor', 'tx', 'rssi', 'timestamp',
+        'deviceId', 'count', 'rssiMin', 'rssiMax', 'rssiMean')
+
+    def __new__(cls, mac, uuid, major, minor, tx, rssi, timestamp,
+            deviceId=None, count=1, rssiMin=None, rssiMax=None, rssiMean=None):
+        return tuple.__new__(cls, (mac, uuid, major, minor, tx, rssi, timestamp,
+            deviceId, count,
+            rssi if rssiMin is None else rssiMin,
+            rssi if rssiMax is None else rssiMax,
+            rssi if rssiMean is None else rssiMean))
+
+    # tuple.__new__ without the defaults, for the scan callback
+    fromFields = classmethod(tuple.__new__)
+
+    mac = property(itemgetter(0))
+    uuid = property(itemgetter(1))
+    major = property(itemgetter(2))
+    minor = property(itemgetter(3))
+    tx = property(itemgetter(4))
+    rssi = property(itemgetter(5))
+    timestamp = property(itemgetter(6))
+    deviceId = property(itemgetter(7))
+    count = property(itemgetter(8))
+    rssiMin = property(itemgetter(9))
+    rssiMax = property(itemgetter(10))
+    rssiMean = property(itemgetter(11))
+
+    @property
+    def beaconMac(self):
+        """ MAC as the hex string used in messages. """
+        return macToHex(self[0])
+
+    @property
+    def udid(self):
+        return self[1].hex().upper()
+
+    def replace(self, **fields):
+        """ Copy with some fields changed. """
+        values = list(self)
+        for name, value in fields.items():
+            values[self._fields.index(name)] = value
+        return tuple.__new__(type(self), values)
+
+    def asDict(self):
+        return {
+            'beaconMac': self.beaconMac,
+            'udid': self.udid,
+            'majorNumber': self[2],
+            'minorNumber': self[3],
+            'tx': self[4],
+            'rssi': self[5],
+            'timestamp': self[6],
+            'deviceId': self[7],
+            'count': self[8],
+            'rssiMin': self[9],
+            'rssiMax': self[10],
+            'rssiMean': self[11]
+            }
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __repr__(self):
+        return 'DetectionData(%s)'%', '.join(
+            '%s=%r'%(name, value) for name, value in zip(self._fields, self))
 
     def __str__(self):
-        return "udid: {} \n createTime: {}".format(self.udid, self.createTime)
\ No newline at end of file
+        return "udid: {} \n timestamp: {}".format(self.udid, self[6])
+
+def macToHex(mac):
+    """ Raw over the air MAC to the hex string used in messages. """
+    return mac[::-1].hex().upper()
+
+def macFromHex(mac):
+    """ Hex MAC, with or without colons, to raw over the air bytes. """
+    return bytes.fromhex(mac.replace(':', ''))[::-1]
@@ -5,11 +5,11 @@ Controls and handles events and figures out
 if the event needs to be handled and put in 
 the list of registered clients.
 """
-from simplesensor.shared import Message, ThreadsafeLogger
+from simplesensor.shared import Message
+from .moduleLogger import ModuleLogger
 from .registry import BtleClient
+from .timeBase import timeBase
 from datetime import datetime
-from threading import Thread
-import time
 
 _UPDATE_TOPIC = 'btle_update_nearby'
 _CLIENT_IN_TOPIC = 'client_in'
@@ -18,7 +18,7 @@ _CLIENT_OUT_TOPIC = 'client_out'
 class EventManager(object):
     def __init__(self, moduleConfig, pOutBoundQueue, clientRegistry, loggingQueue):
         self.loggingQueue = loggingQueue
-        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.logger = ModuleLogger(loggingQueue, __name__, moduleConfig)
 
         self.__stats_totalRemoveEvents = 0
         self.__stats_totalNewEvents = 0
@@ -40,25 +40,21 @@ class EventManager(object):
             (self._rssiClientInThresh * self._rssiErrorVar/2)
             )
 
-        if self._sendUpdateMessages:
-            self._updateFPS = self.moduleConfig['UpdateFPS']
-            self.updateLoopThread = Thread(target=self.updateLoop)
-            self.updateLoopThread.start()
+        self._updateDelta = self.moduleConfig['UpdateMode'] == 'delta'
 
-    def updateLoop(self):
+    def publishUpdate(self):
         """
-        updateLoop
-        Sends an update message on a set frequency.
+        publishUpdate
+        Sends an update message, run UpdateFPS
+        times a second by the scheduler.
         """
-        while(self.alive):
+        if self.alive:
             self.sendEventToController(topic=_UPDATE_TOPIC)
-            time.sleep(1/self._updateFPS)
 
     def registerDetectedClient(self, detectedData):
         #self.logger.debug("Registering detected client %s"%
         #   detectedData.extraData["beaconMac"])
-        eClient = self.clientRegistry.getClient(
-            detectedData.extraData["beaconMac"])
+        eClient = self.clientRegistry.getClient(detectedData.mac)
 
         #check for existing
         if eClient == None:
@@ -66,8 +62,7 @@ class EventManager(object):
             if self.moduleConfig['InterfaceType'] == 'btle':
                 rClient = BtleClient(
                     detectedData,
-                    self.moduleConfig,
-                    self.loggingQueue)
+                    self.clientRegistry.clientContext)
             #self.logger.debug("New client with MAC %s found."%
             #   detectedData.extraData["beaconMac"])
 
@@ -97,8 +92,14 @@ class EventManager(object):
             self.clientRegistry.updateClient(eClient)
 
     def registerClients(self,detectedDatas):
-        for detectedData in detectedDatas:
-            self.registerDetectedClient(detectedData)
+        # filter updates for the whole batch are applied together
+        filterBank = self.clientRegistry.filterBank
+        filterBank.beginBatch()
+        try:
+            for detectedData in detectedDatas:
+                self.registerDetectedClient(detectedData)
+        finally:
+            filterBank.endBatch()
 
     def getEventAuditData(self):
         """Returns a dict with the total New and Remove events the engine has seen since startup"""
@@ -163,15 +164,15 @@ class EventManager(object):
         if client:
             data = client.getExtendedDataForEvent()  
         else:
-            data = self.clientRegistry.getUpdateData(self.__clientOutThresholdMin)
-            if len(data['nearby']) == 0: return
+            data = self.getUpdateData()
+            if data is None: return
 
         eventMessage = Message(
             topic=topic,
             sender_id=self.moduleConfig['CollectionPointId'],
             sender_type=self.moduleConfig['GatewayType'],
             extended_data=data,
-            timestamp=client.lastRegisteredTime if client else datetime.now())
+            timestamp=timeBase.toDatetime(client.lastRegisteredTime) if client else datetime.now())
 
         if topic == _CLIENT_IN_TOPIC:
             client.setClientInMessageSentToController()
@@ -187,5 +188,18 @@ class EventManager(object):
 
         self.outBoundEventQueue.put(eventMessage)
 
+    def getUpdateData(self):
+        """
+        extended_data for the update message, or None
+        when there is nothing to send.
+        """
+        if self._updateDelta:
+            data = self.clientRegistry.getUpdateDelta(self.__clientOutThresholdMin)
+            if not (data['entered'] or data['changed'] or data['left']): return None
+        else:
+            data = self.clientRegistry.getUpdateData(self.__clientOutThresholdMin)
+            if len(data['nearby']) == 0: return None
+        return data
+
     def stop(self):
         self.alive = False
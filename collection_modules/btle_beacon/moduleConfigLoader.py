@@ -6,6 +6,12 @@ import configparser
 import os.path
 import json
 
+# settings that can be given once or as a list with one value per device
+_PER_DEVICE_KEYS = ('BtleScanInterval', 'BtleScanWindow', 'BtleScanActive')
+# files that can be given once or as a list with exactly one path per device,
+# a single path is numbered per device when there are several
+_PER_DEVICE_FILES = ('BtleCaptureFile', 'BtleReplayFile')
+
 def load(loggingQueue, name):
     """ Load module specific config into dictionary, return it"""    
     logger = ThreadsafeLogger(loggingQueue, '{0}-{1}'.format(name, 'ConfigLoader'))
@@ -57,6 +63,30 @@ def loadModule(thisConfig, logger, configParser):
     logger.info("cec data add : %s" % configValue)
     thisConfig['CecData'] = configValue
 
+    """uid map file, csv of uuid,industry rows or json of uuid -> industry. Built in table when empty"""
+    try:
+        configValue=configParser.get('ModuleConfig','uid_map_file')
+    except:
+        configValue = ""
+    logger.info("uid map file : %s" % configValue)
+    thisConfig['UidMapFile'] = configValue
+
+    """uid map reload interval in milliseconds, 0 never reloads"""
+    try:
+        configValue=configParser.getint('ModuleConfig','uid_map_reload_interval')
+    except:
+        configValue = 0
+    logger.info("uid map reload interval in milliseconds : %s" % configValue)
+    thisConfig['UidMapReloadInterval'] = configValue
+
+    """uid map unmapped policy, keep, tag or drop samples of uuids not in the map"""
+    try:
+        configValue=configParser.get('ModuleConfig','uid_map_unmapped_policy').lower()
+    except:
+        configValue = "keep"
+    logger.info("uid map unmapped policy : %s" % configValue)
+    thisConfig['UidMapUnmappedPolicy'] = configValue
+
     """eventmanager_debug"""
     try:
         configValue=configParser.getboolean('ModuleConfig','eventmanager_debug')
@@ -73,6 +103,30 @@ def loadModule(thisConfig, logger, configParser):
     logger.info("Show client range debug debug : %s" % configValue)
     thisConfig['ShowClientRangeDebug'] = configValue
 
+    """Log level of the beacon pipeline, messages under it are never formatted or queued"""
+    try:
+        configValue=configParser.get('ModuleConfig','log_level').upper()
+    except:
+        configValue = "INFO"
+    logger.info("Log level : %s" % configValue)
+    thisConfig['LogLevel'] = configValue
+
+    """Log levels per logger name, json dict of name -> level, eg. {"registry": "DEBUG"}"""
+    try:
+        configValue=json.loads(configParser.get('ModuleConfig','log_levels'))
+    except:
+        configValue = {}
+    logger.info("Log levels : %s" % configValue)
+    thisConfig['LogLevels'] = configValue
+
+    """Log sample interval in milliseconds, per packet logs are logged once per interval"""
+    try:
+        configValue=configParser.getint('ModuleConfig','log_sample_interval')
+    except:
+        configValue = 1000
+    logger.info("Log sample interval in milliseconds : %s" % configValue)
+    thisConfig['LogSampleInterval'] = configValue
+
     try:
         configValue=configParser.get('ModuleConfig','collection_point_id')
     except:
@@ -127,6 +181,14 @@ def loadModule(thisConfig, logger, configParser):
     logger.info("Abandoned client timeout in milliseconds : %s" % configValue)
     thisConfig['AbandonedClientTimeout'] = configValue
 
+    """Abandoned client sweep tolerance in milliseconds"""
+    try:
+        configValue=configParser.getint('ModuleConfig','abandoned_client_sweep_tolerance')
+    except:
+        configValue = 5000
+    logger.info("Abandoned client sweep tolerance in milliseconds : %s" % configValue)
+    thisConfig['AbandonedClientSweepTolerance'] = configValue
+
     """Btle rssi client in threshold"""
     try:
         configValue=configParser.getint('ModuleConfig','btle_rssi_client_in_threshold')
@@ -143,13 +205,20 @@ def loadModule(thisConfig, logger, configParser):
     logger.info("Btle rssi client in threshold type : %s" % configValue)
     thisConfig['BtleRssiClientInThresholdType'] = configValue
 
-    """Btle device id (com5 or /dev/ttyACM0)"""
+    """Btle device id (com5 or /dev/ttyACM0), or a list of them to read from several dongles"""
     try:
-        configValue=configParser.get('ModuleConfig','btle_device_id')
+        tVal=configParser.get('ModuleConfig','btle_device_id')
+        try:
+            configValue = json.loads(tVal)
+        except ValueError:
+            configValue = tVal
+        if type(configValue)!=list:
+            configValue = [tVal]
     except:
-        configValue = "com3"
-    logger.info("Btle device id : %s" % configValue)
-    thisConfig['BtleDeviceId'] = configValue
+        configValue = ["com3"]
+    logger.info("Btle device ids : %s" % configValue)
+    thisConfig['BtleDeviceIds'] = configValue
+    thisConfig['BtleDeviceId'] = configValue[0]
 
     """Btle device baud rate is 38400 range is 1200 - 2000000"""
     try:
@@ -159,6 +228,313 @@ def loadModule(thisConfig, logger, configParser):
     logger.info("Btle device baud rate : %s" % configValue)
     thisConfig['BtleDeviceBaudRate'] = configValue
 
+    """Btle device read mode (blocking or poll)"""
+    try:
+        configValue=configParser.get('ModuleConfig','btle_device_read_mode')
+    except:
+        configValue = "blocking"
+    logger.info("Btle device read mode : %s" % configValue)
+    thisConfig['BtleDeviceReadMode'] = configValue
+
+    """Btle device read timeout in milliseconds"""
+    try:
+        configValue=configParser.getint('ModuleConfig','btle_device_read_timeout')
+    except:
+        configValue = 500
+    logger.info("Btle device read timeout in milliseconds : %s" % configValue)
+    thisConfig['BtleDeviceReadTimeout'] = configValue
+
+    """Btle command timeout in milliseconds, how long a command waits for its response"""
+    try:
+        configValue=configParser.getint('ModuleConfig','btle_command_timeout')
+    except:
+        configValue = 1000
+    logger.info("Btle command timeout in milliseconds : %s" % configValue)
+    thisConfig['BtleCommandTimeout'] = configValue
+
+    """Btle ready timeout in milliseconds, how long start up waits for the dongle to show up and answer"""
+    try:
+        configValue=configParser.getint('ModuleConfig','btle_ready_timeout')
+    except:
+        configValue = 15000
+    logger.info("Btle ready timeout in milliseconds : %s" % configValue)
+    thisConfig['BtleReadyTimeout'] = configValue
+
+    """Btle capture file, records the serial stream, one path or a list with one per device"""
+    try:
+        tVal=configParser.get('ModuleConfig','btle_capture_file')
+        try:
+            configValue = json.loads(tVal)
+        except ValueError:
+            configValue = tVal
+    except:
+        configValue = ''
+    logger.info("Btle capture file : %s" % configValue)
+    thisConfig['BtleCaptureFile'] = configValue
+
+    """Btle replay file, a capture read in place of the device, one path or a list with one per device"""
+    try:
+        tVal=configParser.get('ModuleConfig','btle_replay_file')
+        try:
+            configValue = json.loads(tVal)
+        except ValueError:
+            configValue = tVal
+    except:
+        configValue = ''
+    logger.info("Btle replay file : %s" % configValue)
+    thisConfig['BtleReplayFile'] = configValue
+
+    """Btle replay speed, 1 is the recorded speed, 0 as fast as possible"""
+    try:
+        configValue=configParser.getfloat('ModuleConfig','btle_replay_speed')
+    except:
+        configValue = 1.0
+    logger.info("Btle replay speed : %s" % configValue)
+    thisConfig['BtleReplaySpeed'] = configValue
+
+    """Btle replay loop, start the capture over when it runs out"""
+    try:
+        configValue=configParser.getboolean('ModuleConfig','btle_replay_loop')
+    except:
+        configValue = False
+    logger.info("Btle replay loop : %s" % configValue)
+    thisConfig['BtleReplayLoop'] = configValue
+
+    """Btle scan interval in units of 625us, one value or a list with one per device"""
+    try:
+        configValue=json.loads(configParser.get('ModuleConfig','btle_scan_interval'))
+    except:
+        configValue = 0xC8
+    logger.info("Btle scan interval : %s" % configValue)
+    thisConfig['BtleScanInterval'] = configValue
+
+    """Btle scan window in units of 625us, one value or a list with one per device"""
+    try:
+        configValue=json.loads(configParser.get('ModuleConfig','btle_scan_window'))
+    except:
+        configValue = 0xC8
+    logger.info("Btle scan window : %s" % configValue)
+    thisConfig['BtleScanWindow'] = configValue
+
+    """Btle active scanning (1 active, 0 passive), one value or a list with one per device"""
+    try:
+        configValue=json.loads(configParser.get('ModuleConfig','btle_scan_active'))
+    except:
+        configValue = 0
+    logger.info("Btle scan active : %s" % configValue)
+    thisConfig['BtleScanActive'] = configValue
+
+    """Btle whitelist enabled, only scan for beacons in the dongle's whitelist"""
+    try:
+        configValue=configParser.getboolean('ModuleConfig','btle_whitelist_enabled')
+    except:
+        configValue = False
+    logger.info("Btle whitelist enabled : %s" % configValue)
+    thisConfig['BtleWhitelistEnabled'] = configValue
+
+    """Btle whitelist, MACs always in the whitelist"""
+    try:
+        configValue=json.loads(configParser.get('ModuleConfig','btle_whitelist'))
+        if type(configValue)!=list:
+            configValue = []
+    except:
+        configValue = []
+    logger.info("Btle whitelist : %s" % configValue)
+    thisConfig['BtleWhitelist'] = configValue
+
+    """Btle whitelist learning window in milliseconds"""
+    try:
+        configValue=configParser.getint('ModuleConfig','btle_whitelist_learning_window')
+    except:
+        configValue = 10000
+    logger.info("Btle whitelist learning window in milliseconds : %s" % configValue)
+    thisConfig['BtleWhitelistLearningWindow'] = configValue
+
+    """Btle whitelist relearn interval in milliseconds"""
+    try:
+        configValue=configParser.getint('ModuleConfig','btle_whitelist_relearn_interval')
+    except:
+        configValue = 300000
+    logger.info("Btle whitelist relearn interval in milliseconds : %s" % configValue)
+    thisConfig['BtleWhitelistRelearnInterval'] = configValue
+
+    """Btle whitelist max size"""
+    try:
+        configValue=configParser.getint('ModuleConfig','btle_whitelist_max_size')
+    except:
+        configValue = 8
+    logger.info("Btle whitelist max size : %s" % configValue)
+    thisConfig['BtleWhitelistMaxSize'] = configValue
+
+    """Btle scan duplicate filtering"""
+    try:
+        configValue=configParser.getboolean('ModuleConfig','btle_scan_duplicate_filtering')
+    except:
+        configValue = False
+    logger.info("Btle scan duplicate filtering : %s" % configValue)
+    thisConfig['BtleScanDuplicateFiltering'] = configValue
+
+    """Btle scan duplicate filtering rearm interval in milliseconds"""
+    try:
+        configValue=configParser.getint('ModuleConfig','btle_scan_duplicate_rearm_interval')
+    except:
+        configValue = 1000
+    logger.info("Btle scan duplicate rearm interval in milliseconds : %s" % configValue)
+    thisConfig['BtleScanDuplicateRearmInterval'] = configValue
+
+    """Btle duty cycle enabled, switch scan profiles with the load"""
+    try:
+        configValue=configParser.getboolean('ModuleConfig','btle_duty_cycle_enabled')
+    except:
+        configValue = False
+    logger.info("Btle duty cycle enabled : %s" % configValue)
+    thisConfig['BtleDutyCycleEnabled'] = configValue
+
+    """Btle duty cycle profiles, name -> [scan interval, scan window, active]"""
+    configValue = {'idle': [1600, 80, 0], 'throttled': [200, 100, 0]}
+    try:
+        configValue.update(json.loads(configParser.get('ModuleConfig','btle_duty_cycle_profiles')))
+    except:
+        pass
+    logger.info("Btle duty cycle profiles : %s" % configValue)
+    thisConfig['BtleDutyCycleProfiles'] = configValue
+
+    """Btle duty cycle idle rate, advertisements/sec below which the idle profile is used"""
+    try:
+        configValue=configParser.getfloat('ModuleConfig','btle_duty_cycle_idle_rate')
+    except:
+        configValue = 1.0
+    logger.info("Btle duty cycle idle rate : %s" % configValue)
+    thisConfig['BtleDutyCycleIdleRate'] = configValue
+
+    """Btle duty cycle busy rate, advertisements/sec above which the throttled profile is used"""
+    try:
+        configValue=configParser.getfloat('ModuleConfig','btle_duty_cycle_busy_rate')
+    except:
+        configValue = 70.0
+    logger.info("Btle duty cycle busy rate : %s" % configValue)
+    thisConfig['BtleDutyCycleBusyRate'] = configValue
+
+    """Btle duty cycle busy backlog, bytes waiting on the serial port"""
+    try:
+        configValue=configParser.getint('ModuleConfig','btle_duty_cycle_busy_backlog')
+    except:
+        configValue = 1024
+    logger.info("Btle duty cycle busy backlog : %s" % configValue)
+    thisConfig['BtleDutyCycleBusyBacklog'] = configValue
+
+    """Btle duty cycle busy parse load, share of time spent reading and parsing"""
+    try:
+        configValue=configParser.getfloat('ModuleConfig','btle_duty_cycle_busy_parse_load')
+    except:
+        configValue = 0.5
+    logger.info("Btle duty cycle busy parse load : %s" % configValue)
+    thisConfig['BtleDutyCycleBusyParseLoad'] = configValue
+
+    """Btle duty cycle hold in milliseconds, least time between profile changes"""
+    try:
+        configValue=configParser.getint('ModuleConfig','btle_duty_cycle_hold')
+    except:
+        configValue = 10000
+    logger.info("Btle duty cycle hold in milliseconds : %s" % configValue)
+    thisConfig['BtleDutyCycleHold'] = configValue
+
+    """Detection buffer enabled"""
+    try:
+        configValue=configParser.getboolean('ModuleConfig','detection_buffer_enabled')
+    except:
+        configValue = True
+    logger.info("Detection buffer enabled : %s" % configValue)
+    thisConfig['DetectionBufferEnabled'] = configValue
+
+    """Detection buffer size"""
+    try:
+        configValue=configParser.getint('ModuleConfig','detection_buffer_size')
+    except:
+        configValue = 4096
+    logger.info("Detection buffer size : %s" % configValue)
+    thisConfig['DetectionBufferSize'] = configValue
+
+    """Detection buffer overflow policy (drop_oldest or coalesce)"""
+    try:
+        configValue=configParser.get('ModuleConfig','detection_buffer_policy')
+    except:
+        configValue = "drop_oldest"
+    logger.info("Detection buffer policy : %s" % configValue)
+    thisConfig['DetectionBufferPolicy'] = configValue
+
+    """Detection coalesce window in milliseconds"""
+    try:
+        configValue=configParser.getint('ModuleConfig','detection_coalesce_window')
+    except:
+        configValue = 0
+    logger.info("Detection coalesce window in milliseconds : %s" % configValue)
+    thisConfig['DetectionCoalesceWindow'] = configValue
+
+    """Detection merge policy (aggregate or best_rssi)"""
+    try:
+        configValue=configParser.get('ModuleConfig','detection_merge_policy')
+    except:
+        configValue = "aggregate"
+    logger.info("Detection merge policy : %s" % configValue)
+    thisConfig['DetectionMergePolicy'] = configValue
+
+    """Registry shards, number of worker processes the registry is split over (0 is off)"""
+    try:
+        configValue=configParser.getint('ModuleConfig','registry_shards')
+    except:
+        configValue = 0
+    logger.info("Registry shards : %s" % configValue)
+    thisConfig['RegistryShards'] = configValue
+
+    """Registry state file, clients are saved to it and restored from it on start (empty is off)"""
+    try:
+        configValue=configParser.get('ModuleConfig','registry_state_file')
+    except:
+        configValue = ""
+    logger.info("Registry state file : %s" % configValue)
+    thisConfig['RegistryStateFile'] = configValue
+
+    """Registry state interval in milliseconds between saves of the registry state file"""
+    try:
+        configValue=configParser.getint('ModuleConfig','registry_state_interval')
+    except:
+        configValue = 10000
+    logger.info("Registry state interval in milliseconds : %s" % configValue)
+    thisConfig['RegistryStateInterval'] = configValue
+
+    """Advertisement log directory, every detection is logged to segment files in it (empty is off)"""
+    try:
+        configValue=configParser.get('ModuleConfig','advertisement_log_dir')
+    except:
+        configValue = ""
+    logger.info("Advertisement log directory : %s" % configValue)
+    thisConfig['AdvertisementLogDir'] = configValue
+
+    """Advertisement log segment interval in milliseconds, a new segment file is started this often"""
+    try:
+        configValue=configParser.getint('ModuleConfig','advertisement_log_segment_interval')
+    except:
+        configValue = 3600000
+    logger.info("Advertisement log segment interval in milliseconds : %s" % configValue)
+    thisConfig['AdvertisementLogSegmentInterval'] = configValue
+
+    """Advertisement log max segments, older segments are deleted (0 keeps all)"""
+    try:
+        configValue=configParser.getint('ModuleConfig','advertisement_log_max_segments')
+    except:
+        configValue = 0
+    logger.info("Advertisement log max segments : %s" % configValue)
+    thisConfig['AdvertisementLogMaxSegments'] = configValue
+
+    """Advertisement log flush interval in milliseconds between writes of the buffered records"""
+    try:
+        configValue=configParser.getint('ModuleConfig','advertisement_log_flush_interval')
+    except:
+        configValue = 1000
+    logger.info("Advertisement log flush interval in milliseconds : %s" % configValue)
+    thisConfig['AdvertisementLogFlushInterval'] = configValue
+
     """Btle UUID focus list"""
     try:
         tVal=configParser.get('ModuleConfig','btle_uuid_focus_list')
@@ -287,6 +663,14 @@ def loadModule(thisConfig, logger, configParser):
     logger.info("Update message FPS : %s" % configValue)
     thisConfig['UpdateFPS'] = configValue
 
+    """ Update messages mode (full or delta) """
+    try:
+        configValue=configParser.get('ModuleConfig','update_mode')
+    except:
+        configValue = "full"
+    logger.info("Update message mode : %s" % configValue)
+    thisConfig['UpdateMode'] = configValue
+
     """Btle client out count threshold"""
     try:
         configValue=configParser.getint('ModuleConfig','btle_client_out_count_threshold')
@@ -304,3 +688,43 @@ def loadModule(thisConfig, logger, configParser):
     thisConfig['SlackChannelWebhookUrl'] = configValue
 
     return thisConfig
+
+def deviceConfigs(thisConfig):
+    """
+    Split the module config into one config per device in
+    BtleDeviceIds, each with its own BtleDeviceId and scan
+    parameters. A list shorter than the device list repeats
+    its last value.
+
+    Devices never share a capture or replay file, a single
+    path becomes <path>.<index> with several devices and a
+    list has to give one path per device.
+    """
+    deviceIds = thisConfig['BtleDeviceIds']
+    for key in _PER_DEVICE_KEYS:
+        if thisConfig[key] == []:
+            raise ValueError("%s is an empty list"%key)
+    for key in _PER_DEVICE_FILES:
+        value = thisConfig[key]
+        if type(value) == list and len(value) != len(deviceIds):
+            raise ValueError("%s lists %i paths for %i devices"%(
+                key, len(value), len(deviceIds)))
+
+    configs = []
+    for i, deviceId in enumerate(deviceIds):
+        deviceConfig = dict(thisConfig)
+        deviceConfig['BtleDeviceId'] = deviceId
+        for key in _PER_DEVICE_KEYS:
+            value = thisConfig[key]
+            if type(value) == list:
+                value = value[min(i, len(value)-1)]
+            deviceConfig[key] = value
+        for key in _PER_DEVICE_FILES:
+            value = thisConfig[key]
+            if type(value) == list:
+                value = value[i]
+            elif value and len(deviceIds) > 1:
+                value = '%s.%i'%(value, i)
+            deviceConfig[key] = value
+        configs.append(deviceConfig)
+    return configs
@@ -0,0 +1,134 @@
+"""
+ModuleLogger
+Level gated front for ThreadsafeLogger on the beacon hot paths.
+
+ThreadsafeLogger formats every message and puts it on the logging
+queue, whatever level the sink logs at. ModuleLogger drops messages
+under its level before anything is formatted or queued:
+
+    self.logger.debug("sweep: client %s", mac)
+
+only formats when debug is enabled for the logger. Levels are set per
+logger name with log_levels, anything else logs at log_level.
+Per packet logs go through the sampled methods, which log a key at
+most once per log_sample_interval and count what they skipped.
+"""
+
+from simplesensor.shared import ThreadsafeLogger
+import logging
+import time
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+CRITICAL = logging.CRITICAL
+
+# least seconds between dropping the sampled keys that went quiet
+_MIN_PRUNE_INTERVAL = 1.0
+
+def levelFor(name, defaultLevel, levels):
+    """
+    Level of a logger name. A key of levels matches whole dotted
+    parts of the name, eg. registry or registry.clientRegistry,
+    and the longest matching key wins.
+    """
+    dotted = '.%s.'%name
+    best = None
+    for key in levels:
+        if ('.%s.'%key) in dotted and (best is None or len(key) > len(best)):
+            best = key
+    level = levels[best] if best is not None else defaultLevel
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    if not isinstance(level, int):
+        raise ValueError("Unknown log level for %s: %s"%(name, level))
+    return level
+
+class ModuleLogger(object):
+
+    def __init__(self, loggingQueue, name, moduleConfig):
+        self.logger = ThreadsafeLogger(loggingQueue, name)
+        self.name = name
+        self.level = levelFor(name, moduleConfig['LogLevel'], moduleConfig['LogLevels'])
+        self.debugEnabled = self.level <= DEBUG
+        self.infoEnabled = self.level <= INFO
+
+        self._sampleInterval = moduleConfig['LogSampleInterval']/1000
+        # key -> [next time it may log, messages skipped since],
+        # keys past their time are dropped every prune interval
+        self.samples = {}
+        self._pruneInterval = max(self._sampleInterval, _MIN_PRUNE_INTERVAL)
+        self._nextPrune = time.monotonic() + self._pruneInterval
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def debug(self, msg, *args):
+        if self.debugEnabled:
+            self.logger.debug(msg%args if args else msg)
+
+    def info(self, msg, *args):
+        if self.infoEnabled:
+            self.logger.info(msg%args if args else msg)
+
+    def warning(self, msg, *args):
+        if self.level <= WARNING:
+            self.logger.warning(msg%args if args else msg)
+
+    warn = warning
+
+    def error(self, msg, *args):
+        if self.level <= ERROR:
+            self.logger.error(msg%args if args else msg)
+
+    def critical(self, msg, *args):
+        if self.level <= CRITICAL:
+            self.logger.critical(msg%args if args else msg)
+
+    def debugSampled(self, key, msg, *args):
+        """ debug, at most once per sample interval for key. """
+        if self.debugEnabled and self.sample(key):
+            self.debug(self.sampledMessage(key, msg), *args)
+
+    def infoSampled(self, key, msg, *args):
+        """ info, at most once per sample interval for key. """
+        if self.infoEnabled and self.sample(key):
+            self.info(self.sampledMessage(key, msg), *args)
+
+    def sample(self, key):
+        """ True when key may log now, otherwise counts it as skipped. """
+        now = time.monotonic()
+        if now >= self._nextPrune:
+            self.prune(now)
+        sample = self.samples.get(key)
+        if sample is None:
+            self.samples[key] = [now + self._sampleInterval, 0]
+            return True
+        if now < sample[0]:
+            sample[1] += 1
+            return False
+        sample[0] = now + self._sampleInterval
+        return True
+
+    def prune(self, now):
+        """
+        Drop the keys that may log again, one per beacon MAC would
+        pile up otherwise. What they skipped is not reported.
+        """
+        self._nextPrune = now + self._pruneInterval
+        samples = self.samples
+        for key, sample in list(samples.items()):
+            if now >= sample[0]:
+                samples.pop(key, None)
+
+    def sampledMessage(self, key, msg):
+        sample = self.samples.get(key)
+        if sample is None:
+            # pruned by another thread in between
+            return msg
+        skipped = sample[1]
+        sample[1] = 0
+        if skipped:
+            return msg + ' (%i more since the last)'%skipped
+        return msg
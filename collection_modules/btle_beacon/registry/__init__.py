@@ -1,3 +1,3 @@
-from .btleClient import BtleClient
+from .btleClient import BtleClient, ClientContext
 from .clientRegistry import ClientRegistry
-from .filter import Filter
\ No newline at end of file
+from .filter import Filter, FilterBank
\ No newline at end of file
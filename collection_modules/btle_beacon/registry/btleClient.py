@@ -2,92 +2,158 @@
 BtleClient
 """
 
-from simplesensor.shared import ThreadsafeLogger
+from ..moduleLogger import ModuleLogger
 # from ..devices import DetectionData
-from .filter import Filter
-from ..uidMap import UIDMap
+from .filter import Filter, FilterBank
+from ..uidMap import sharedUIDMap
+from ..timeBase import timeBase
+from ..devices.detectionData import macToHex
 import time
-from datetime import datetime
 import math
- 
-class BtleClient(object):
-    def __init__(self, detectionData, collectionPointConfig, loggingQueue):
-        self.loggingQueue = loggingQueue
-        self.logger = ThreadsafeLogger(loggingQueue, "BtleRegisteredClient")
-        
-        # Counters and variables
-        self.clientInRangeTrigerCount = 1
-        self.prevClientInMsgTime = None
-        self.prevClientOutMsgTime = None
-        self.numClientInRange=0
-        self.numClientOutRange=0
-        self.timeInCollectionPointInMilliseconds = 0
-        self.firstRegisteredTime = datetime.now()
+
+class ClientContext(object):
+    """
+    State shared by every client of a registry.
+    Config constants, the logger, the uid map and
+    the filter bank are built once here instead of
+    once per client.
+    """
+
+    def __init__(self, collectionPointConfig, loggingQueue, filterBank=None):
         self.collectionPointConfig = collectionPointConfig
-        self.filter = Filter(detectionData.extraData['rssi'])
+        self.logger = ModuleLogger(loggingQueue, "BtleRegisteredClient", collectionPointConfig)
+        self.filterBank = filterBank if filterBank is not None else FilterBank()
+        self.uidMap = None
         try:
-            self.uidMap = UIDMap()
+            # one table for the whole process, keyed by raw uuid
+            self.uidMap = sharedUIDMap(collectionPointConfig, loggingQueue)
         except Exception as e:
-            self.logger.warning('cant instantiate uid map: %s '%e)
+            self.logger.warning('cant instantiate uid map: %s ', e)
 
         # Constants
-        self._proximityEventInterval = self.collectionPointConfig['ProximityEventInterval']
-        self._outClientThreshold = self.collectionPointConfig['BtleClientOutCountThreshold']
+        self.clientInRangeTrigerCount = 1
+        self.proximityEventInterval = collectionPointConfig['ProximityEventInterval']
+        self.proximityEventIntervalNs = self.proximityEventInterval*1000000
+        self.outClientThreshold = collectionPointConfig['BtleClientOutCountThreshold']
 
-        self._gatewayType = self.collectionPointConfig['GatewayType']
+        self.gatewayType = collectionPointConfig['GatewayType']
 
-        self._rssiClientInThresh = self.collectionPointConfig['BtleRssiClientInThreshold']
-        self._rssiErrorVar = self.collectionPointConfig['BtleRssiErrorVariance']
-        self.__clientOutThresholdMin = int(
-            self._rssiClientInThresh + 
-            (self._rssiClientInThresh * self._rssiErrorVar)
+        self.rssiClientInThresh = collectionPointConfig['BtleRssiClientInThreshold']
+        self.rssiErrorVar = collectionPointConfig['BtleRssiErrorVariance']
+        self.clientOutThresholdMin = int(
+            self.rssiClientInThresh + 
+            (self.rssiClientInThresh * self.rssiErrorVar)
             )
-        self._clientInThreshType = self.collectionPointConfig['BtleRssiClientInThresholdType']
-        self._debugEventManager = self.collectionPointConfig['EventManagerDebug']
+        self.clientInThreshType = collectionPointConfig['BtleRssiClientInThresholdType']
+        self.debugEventManager = collectionPointConfig['EventManagerDebug']
+        self.showClientRangeDebug = collectionPointConfig['ShowClientRangeDebug']
+        self.cecData = collectionPointConfig['CecData']
+        self.timeBase = timeBase
+
+class BtleClient(object):
+    # one record per tracked beacon, everything shared lives on the context
+    __slots__ = (
+        'context',
+        'filter',
+        'address',
+        'mac',
+        'uuid',
+        'major',
+        'minor',
+        'rssi',
+        'averageRssi',
+        'sampleCount',
+        'txPower',
+        'prevClientInMsgTime',
+        'prevClientOutMsgTime',
+        'numClientInRange',
+        'numClientOutRange',
+        'timeInCollectionPointInMilliseconds',
+        'firstRegisteredTime',
+        'lastRegisteredTime',
+        'lastSeen',
+        'snapshot'
+        )
+
+    def __init__(self, detectionData, context):
+        self.context = context
+        
+        # Counters and variables
+        self.prevClientInMsgTime = None
+        self.prevClientOutMsgTime = None
+        self.numClientInRange=0
+        self.numClientOutRange=0
+        self.timeInCollectionPointInMilliseconds = 0
+        # times are time.monotonic_ns(), rendered by the time base
+        self.firstRegisteredTime = detectionData.timestamp
+        # raw MAC keys the registry, the hex one is for messages and logs
+        self.address = detectionData.mac
+        self.mac = detectionData.beaconMac
+        self.snapshot = None
+        self.filter = Filter(detectionData.rssiMean, context.filterBank)
 
         # Initiate event when client is detected
         self.handleNewDetectedClientEvent(detectionData)
 
+    @property
+    def logger(self):
+        return self.context.logger
+
+    @property
+    def beaconId(self):
+        return self.uuid.hex().upper()
+
     def updateWithNewDetectedClientData(self, detectionData):
         """
         updateWithNewDetectedClientData
         part of interface for Registered Client
         """
-        self.timeInCollectionPointInMilliseconds = (datetime.now() - self.firstRegisteredTime).total_seconds()*1000
+        self.timeInCollectionPointInMilliseconds = (detectionData.timestamp - self.firstRegisteredTime)/1000000
         # standard shared methods when we see a detected client
         self.handleNewDetectedClientEvent(detectionData)
 
     # Common methods are handled here for updateWithNewDetectedClientData and init
     def handleNewDetectedClientEvent(self, detectionData):
-        self.lastRegisteredTime = datetime.now()
-        self.detectionData = detectionData
-        self.txPower = detectionData.extraData['tx']
-        self.beaconId = detectionData.extraData['udid']
-        self.filter.update(self.detectionData.extraData['rssi'])
+        # detections are stamped with time.monotonic_ns() when parsed
+        self.lastRegisteredTime = detectionData.timestamp
+        self.lastSeen = detectionData.timestamp / 1e9
+        self.snapshot = None
+        self.rssi = detectionData.rssi
+        # detections can be an aggregate of several advertisements
+        self.averageRssi = detectionData.rssiMean
+        self.sampleCount = detectionData.count
+        self.major = detectionData.major
+        self.minor = detectionData.minor
+        self.txPower = detectionData.tx
+        self.uuid = detectionData.uuid
+        self.filter.update(self.averageRssi)
         self.incrementInternalClientEventCounts(detectionData)
 
     def incrementInternalClientEventCounts(self, detectionData):
-        if self._gatewayType == 'proximity':
-            if self._clientInThreshType == 'rssi':
+        context = self.context
+        if context.gatewayType == 'proximity':
+            if context.clientInThreshType == 'rssi':
                 # Are they in or are they out of range 
                 # Increment internal count, used to normalize events.
-                if (self.detectionData.extraData['rssi'] >= self._rssiClientInThresh):
-                    self.numClientInRange += 1
+                # every advertisement in the detection counts as evidence
+                if (self.averageRssi >= context.rssiClientInThresh):
+                    self.numClientInRange += self.sampleCount
                     self.numClientOutRange = 0
                     self.logClientRange("CLIENTIN")
-                elif (self.detectionData.extraData['rssi'] < self.__clientOutThresholdMin):
-                    self.numClientOutRange += 1
+                elif (self.averageRssi < context.clientOutThresholdMin):
+                    self.numClientOutRange += self.sampleCount
                     self.numClientInRange = 0
                     self.logClientRange("CLIENTOUT")
 
     #part of interface for Registered Client
     def shouldSendClientInEvent(self):
-        if self._gatewayType == 'proximity':
+        context = self.context
+        if context.gatewayType == 'proximity':
             if (self.prevClientInMsgTime == None or 
                 (self.prevClientOutMsgTime != None and 
-                    (self.prevClientOutMsgTime-self.prevClientInMsgTime).total_seconds() > 0) or
-                (datetime.now() - self.prevClientInMsgTime).total_seconds()*1000 >= self._proximityEventInterval):
-                    if self.numClientInRange > self.clientInRangeTrigerCount:
+                    self.prevClientOutMsgTime > self.prevClientInMsgTime) or
+                time.monotonic_ns() - self.prevClientInMsgTime >= context.proximityEventIntervalNs):
+                    if self.numClientInRange > context.clientInRangeTrigerCount:
                         # self.logClientEventSend(" ClientIN event sent to controller ")
                         self.zeroEventRangeCounters()
                         return True
@@ -98,16 +164,17 @@ class BtleClient(object):
 
     #part of interface for Registered Client
     def shouldSendClientOutEvent(self):
-        if self._gatewayType == 'proximity':
+        context = self.context
+        if context.gatewayType == 'proximity':
             #check the time to see if we need to send a message
             #have we ever sent an IN event? if not we dont need to send an out event
             if self.prevClientInMsgTime:
                 #have we sent a client out since the last client in?  if so we dont need to throw another
                 if (self.prevClientOutMsgTime == None or self.prevClientOutMsgTime < self.prevClientInMsgTime):
                     #do we have enought qualifying out events. we dont want to throw one too soon
-                    if (self.numClientOutRange >= self._outClientThreshold):
+                    if (self.numClientOutRange >= context.outClientThreshold):
                         # self.logClientEventSend("ClientOUT event a sent to controller")
-                        self.logger.debug("out case B: client %s"%self.detectionData.extraData["beaconMac"])
+                        self.logger.debug("out case B: client %s", self.mac)
                         self.zeroEventRangeCounters()
                         return True
                 elif (self.prevClientOutMsgTime != None and 
@@ -116,14 +183,14 @@ class BtleClient(object):
 
                 #check timing on last event sent
                 if (self.prevClientOutMsgTime is not None and
-                    (datetime.now() - self.prevClientOutMsgTime).total_seconds()*1000 > self._proximityEventInterval):
+                    time.monotonic_ns() - self.prevClientOutMsgTime > context.proximityEventIntervalNs):
                         # self.logClientEventSend("ClientOUT event b sent to controller")
-                        self.logger.debug("out case A: client %s"%self.detectionData.extraData["beaconMac"])
+                        self.logger.debug("out case A: client %s", self.mac)
                         self.zeroEventRangeCounters()
                         return True
                 elif self.prevClientOutMsgTime is not None:
                     return False
-            elif self.numClientOutRange > self._outClientThreshold:
+            elif self.numClientOutRange > context.outClientThreshold:
                 # self.logger.debug("Client out count "+
                 #    "%i is past max.  Resetting." %self.numClientOutRange)
                 self.numClientOutRange = 0
@@ -133,37 +200,30 @@ class BtleClient(object):
 
     #part of interface for Registered Client
     def sweepShouldSendClientOutEvent(self):
-        self.logger.debug("trace 1")
-        if self._gatewayType == 'proximity':
+        if self.context.gatewayType == 'proximity':
             # has an in event been sent yet? if not, no sweep needed
-            self.logger.debug("trace 2")
             if self.prevClientInMsgTime:
-                self.logger.debug("trace 3")
                 # sweep old clients, so check most recent message sent
                 # if no message has been sent in the past proximityEventInterval*3 milliseconds
                 # sweep the client because it is probably gone
                 if (self.prevClientOutMsgTime is None or 
                     (self.prevClientInMsgTime>self.prevClientOutMsgTime and
-                    (datetime.now() - self.prevClientOutMsgTime).total_seconds()*1000 > 
-                        self._proximityEventInterval*3)):
-                            self.logger.debug("trace 4")
-                            self.logger.debug("sweep: client %s"%self.detectionData.extraData["beaconMac"])
+                    time.monotonic_ns() - self.prevClientOutMsgTime >
+                        self.context.proximityEventIntervalNs*3)):
+                            self.logger.debug("sweep: client %s", self.mac)
                             # self.logClientEventSend("Sweep case a is sending ClientOUT on")
                             self.zeroEventRangeCounters()
                             return True
                 else:
-                    self.logger.debug("trace 5")
                     return False
             else:
-                self.logger.debug("trace 6")
                 return False
         #TODO add in other types of gateway types
-        self.logger.debug("trace 7")
         return False
 
     #part of interface for Registered Client
     def getMac(self):
-        return self.detectionData.extraData["beaconMac"]
+        return self.mac
 
     def getTxPower(self):
         return self.txPower
@@ -174,92 +234,156 @@ class BtleClient(object):
         self.numClientInRange = 0
 
     def logClientEventSend(self,message):
-        if self._debugEventManager:
-            self.logger.debug("")
-            self.logger.debug("%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%")
-            self.logger.debug("%%%%%%%%%%%%%%%%%% %s %%%%%%%%%%%%%%%%%%" %message)
-            self.logger.debug("    MAC is %s " %self.getMac())
-            self.logger.debug("    Beacon ID is %s " %self.beaconId)
-            self.logger.debug("    filtered RSSI %i" %self.filter.state)
-            self.logger.debug("    RSSI %i" %self.detectionData.extraData['rssi'])
-            self.logger.debug("    Major %i" %self.detectionData.extraData['majorNumber'])
-            self.logger.debug("    Minor %i" %self.detectionData.extraData['minorNumber'])
-            self.logger.debug("    BTLE RSSI client in threshold %i" %self.collectionPointConfig['BtleRssiClientInThreshold'])
-            self.logger.debug("    BTLE RSSI client out threshold %i" %self.__clientOutThresholdMin)
-            self.logger.debug("    inCount %i : outCount %i" %(self.numClientInRange,self.numClientOutRange))
-            self.logger.debug("%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%")
-            self.logger.debug("")
+        if self.context.debugEventManager and self.logger.debugEnabled:
+            self.logger.debug("\n".join((
+                "%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%",
+                "%%%%%%%%%%%%%%%%%% %s %%%%%%%%%%%%%%%%%%",
+                "    MAC is %s ",
+                "    Beacon ID is %s ",
+                "    filtered RSSI %i",
+                "    RSSI %i",
+                "    Major %i",
+                "    Minor %i",
+                "    BTLE RSSI client in threshold %i",
+                "    BTLE RSSI client out threshold %i",
+                "    inCount %i : outCount %i",
+                "%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%")),
+                message, self.getMac(), self.beaconId, self.filter.state,
+                self.rssi, self.major, self.minor,
+                self.context.rssiClientInThresh, self.context.clientOutThresholdMin,
+                self.numClientInRange, self.numClientOutRange)
         return
 
 
     def logClientRange(self,eventType):
-        if self.collectionPointConfig['ShowClientRangeDebug']:
-
-            if eventType.upper() == "CLIENTIN":
-                self.logger.debug("<<<<<<<<<<<<<<<<< IN RANGE <<<<<<<<<<<<<<<<<")
-            else:
-                self.logger.debug(">>>>>>>>>>>>>>>>> OUT OF RANGE >>>>>>>>>>>>>>>>>")
-
-            self.logger.debug("    MAC is %s " %self.getMac())
-            self.logger.debug("    Beacon ID is %s " %self.beaconId)
-            self.logger.debug("    RSSI %i" %self.detectionData.extraData['rssi'])
-            self.logger.debug("    Major %i" %self.detectionData.extraData['majorNumber'])
-            self.logger.debug("    Minor %i" %self.detectionData.extraData['minorNumber'])
-            self.logger.debug("    BTLE RSSI client in threshold %i" %self.collectionPointConfig['BtleRssiClientInThreshold'])
-            self.logger.debug("    BTLE RSSI client out threshold %i" %self.__clientOutThresholdMin)
-            self.logger.debug("    inCount %i : outCount %i" %(self.numClientInRange,self.numClientOutRange))
-
-            if eventType.upper() == "CLIENTIN":
-                self.logger.debug("<<<<<<<<<<<<<<<<< IN RANGE END <<<<<<<<<<<<<<<<<")
-            else:
-                self.logger.debug(">>>>>>>>>>>>>>>>> OUT OF RANGE END >>>>>>>>>>>>>>>>>")
-
-            self.logger.debug("")
+        """ Logged for every sample, so at most once per sample interval per client. """
+        if self.context.showClientRangeDebug and self.logger.debugEnabled:
+            clientIn = eventType.upper() == "CLIENTIN"
+            self.logger.debugSampled((self.mac, clientIn), "\n".join((
+                "<<<<<<<<<<<<<<<<< IN RANGE <<<<<<<<<<<<<<<<<" if clientIn else
+                    ">>>>>>>>>>>>>>>>> OUT OF RANGE >>>>>>>>>>>>>>>>>",
+                "    MAC is %s ",
+                "    Beacon ID is %s ",
+                "    RSSI %i",
+                "    Major %i",
+                "    Minor %i",
+                "    BTLE RSSI client in threshold %i",
+                "    BTLE RSSI client out threshold %i",
+                "    inCount %i : outCount %i",
+                "<<<<<<<<<<<<<<<<< IN RANGE END <<<<<<<<<<<<<<<<<" if clientIn else
+                    ">>>>>>>>>>>>>>>>> OUT OF RANGE END >>>>>>>>>>>>>>>>>")),
+                self.getMac(), self.beaconId, self.rssi, self.major, self.minor,
+                self.context.rssiClientInThresh, self.context.clientOutThresholdMin,
+                self.numClientInRange, self.numClientOutRange)
         return
 
     #part of interface for Registered Client
     def getExtendedDataForEvent(self):
+        """
+        Event data for this client. The dict is cached until
+        the next sample or sent message, callers must not change it.
+        """
+        if self.snapshot is None:
+            self.snapshot = self.buildExtendedDataForEvent()
+        return self.snapshot
+
+    def buildExtendedDataForEvent(self):
         extraData = {}
-        extraData['gatewayType'] = self.collectionPointConfig['GatewayType']
-        extraData['lastRegisteredTime'] = self.lastRegisteredTime if self.lastRegisteredTime==None else self.lastRegisteredTime.isoformat() 
-        extraData['firstRegisteredTime'] = self.firstRegisteredTime if self.firstRegisteredTime==None else self.firstRegisteredTime.isoformat() 
-        extraData['prevClientInMsgTime'] = self.prevClientInMsgTime if self.prevClientInMsgTime==None else self.prevClientInMsgTime.isoformat()
-        extraData['prevClientOutMsgTime'] = self.prevClientOutMsgTime if self.prevClientOutMsgTime==None else self.prevClientOutMsgTime.isoformat()
+        extraData['gatewayType'] = self.context.gatewayType
+        isoformat = self.context.timeBase.isoformatOrNone
+        extraData['lastRegisteredTime'] = isoformat(self.lastRegisteredTime)
+        extraData['firstRegisteredTime'] = isoformat(self.firstRegisteredTime)
+        extraData['prevClientInMsgTime'] = isoformat(self.prevClientInMsgTime)
+        extraData['prevClientOutMsgTime'] = isoformat(self.prevClientOutMsgTime)
         extraData['timeInCollectionPointInMilliseconds'] = self.timeInCollectionPointInMilliseconds
-        extraData['rssi'] = self.detectionData.extraData['rssi']
-        extraData['averageRssi'] = self.detectionData.extraData['rssi']
+        extraData['rssi'] = self.rssi
+        extraData['averageRssi'] = self.averageRssi
         extraData['filteredRssi'] = self.filter.state
         extraData['txPower'] = self.getTxPower()
         extraData['beaconId'] = self.beaconId
-        extraData['beaconMac'] = self.detectionData.extraData["beaconMac"]
-        extraData['major'] = self.detectionData.extraData["majorNumber"]
-        extraData['minor'] = self.detectionData.extraData["minorNumber"]
-        if self.collectionPointConfig['CecData']:
-            extraData['industry'] = self.uidMap.get(self.beaconId)
+        extraData['beaconMac'] = self.mac
+        extraData['major'] = self.major
+        extraData['minor'] = self.minor
+        if self.context.cecData:
+            extraData['industry'] = self.context.uidMap.get(self.uuid)
 
         return extraData
        
     def getExtendedDataForUpdateEvent(self):
         extraData = {}
-        extraData['rssi'] = self.detectionData.extraData['rssi']
+        extraData['rssi'] = self.rssi
         extraData['filteredRssi'] = self.filter.state
         extraData['beaconId'] = self.beaconId
-        extraData['beaconMac'] = self.detectionData.extraData["beaconMac"]
-        extraData['major'] = self.detectionData.extraData["majorNumber"]
-        extraData['minor'] = self.detectionData.extraData["minorNumber"]
-        if self.collectionPointConfig['CecData']:
-            extraData['industry'] = self.uidMap.get(self.beaconId)
+        extraData['beaconMac'] = self.mac
+        extraData['major'] = self.major
+        extraData['minor'] = self.minor
+        if self.context.cecData:
+            extraData['industry'] = self.context.uidMap.get(self.uuid)
 
         return extraData
 
     #part of interface for Registered Client
     def setClientInMessageSentToController(self):
         self.logger.debug('set client in message sent')
-        self.prevClientInMsgTime = datetime.now()
+        self.prevClientInMsgTime = time.monotonic_ns()
+        self.snapshot = None
         self.numClientInRange = 0
 
     #part of interface for Registered Client
     def setClientOutMessageSentToController(self):
         self.logger.debug('set client out message sent')
-        self.prevClientOutMsgTime = datetime.now()
+        self.prevClientOutMsgTime = time.monotonic_ns()
+        self.snapshot = None
         self.numClientOutRange = 0
+
+    def getSavedState(self, now):
+        """
+        State to restore the client from after a restart, json
+        friendly. Times are saved as ns before now.
+        """
+        return {
+            'address': self.address.hex(),
+            'uuid': self.uuid.hex(),
+            'major': self.major,
+            'minor': self.minor,
+            'txPower': self.txPower,
+            'rssi': self.rssi,
+            'averageRssi': self.averageRssi,
+            'sampleCount': self.sampleCount,
+            'filterWindow': self.filter.window,
+            'numClientInRange': self.numClientInRange,
+            'numClientOutRange': self.numClientOutRange,
+            'firstRegisteredAge': now - self.firstRegisteredTime,
+            'lastRegisteredAge': now - self.lastRegisteredTime,
+            'prevClientInMsgAge': None if self.prevClientInMsgTime is None else now - self.prevClientInMsgTime,
+            'prevClientOutMsgAge': None if self.prevClientOutMsgTime is None else now - self.prevClientOutMsgTime
+            }
+
+    @classmethod
+    def fromSavedState(cls, state, now, context):
+        """ Client saved by getSavedState, now is the time it was saved at. """
+        client = cls.__new__(cls)
+        client.context = context
+        client.address = bytes.fromhex(state['address'])
+        client.mac = macToHex(client.address)
+        client.uuid = bytes.fromhex(state['uuid'])
+        client.major = state['major']
+        client.minor = state['minor']
+        client.txPower = state['txPower']
+        client.rssi = state['rssi']
+        client.averageRssi = state['averageRssi']
+        client.sampleCount = state['sampleCount']
+        client.filter = Filter.fromWindow(state['filterWindow'], context.filterBank)
+        client.numClientInRange = state['numClientInRange']
+        client.numClientOutRange = state['numClientOutRange']
+        client.firstRegisteredTime = now - state['firstRegisteredAge']
+        client.lastRegisteredTime = now - state['lastRegisteredAge']
+        client.lastSeen = client.lastRegisteredTime / 1e9
+        client.timeInCollectionPointInMilliseconds = (
+            client.lastRegisteredTime - client.firstRegisteredTime)/1000000
+        client.prevClientInMsgTime = (None if state['prevClientInMsgAge'] is None
+            else now - state['prevClientInMsgAge'])
+        client.prevClientOutMsgTime = (None if state['prevClientOutMsgAge'] is None
+            else now - state['prevClientOutMsgAge'])
+        client.snapshot = None
+        return client
@@ -1,85 +1,27 @@
 """
-This file has three classes.  
 All the classes are related to tracking clients that are in range.
 
 ClientRegistry
 Holds registered clients
 
 RegistryEvent
-RegistryEventHandler
+The event descriptor of BGLib, the registry fires its events the same way
 
 """
 
-from simplesensor.shared import ThreadsafeLogger
+from ..moduleLogger import ModuleLogger
+from ..devices.bluegiga.bglib import BGAPIEvent
+from .filter import FilterBank
+from .btleClient import BtleClient, ClientContext
+from threading import RLock
+from itertools import count
+import heapq
+import json
+import os
 import time
 from datetime import datetime
 
-class RegistryEvent(object):
-
-    def __init__(self, doc=None):
-        self.__doc__ = doc
-
-    def __get__(self, obj, objtype=None):
-        if obj is None:
-            return self
-        return RegistryEventHandler(self, obj)
-
-    def __set__(self, obj, value):
-        pass
-
-
-class RegistryEventHandler(object):
-
-    def __init__(self, event, obj):
-
-        self.event = event
-        self.obj = obj
-
-    def _getfunctionlist(self):
-
-        """(internal use) """
-
-        try:
-            eventhandler = self.obj.__eventhandler__
-        except AttributeError:
-            eventhandler = self.obj.__eventhandler__ = {}
-        return eventhandler.setdefault(self.event, [])
-
-    def add(self, func):
-
-        """Add new event handler function.
-
-        Event handler function must be defined like func(sender, earg).
-        You can add handler also by using '+=' operator.
-        """
-
-        self._getfunctionlist().append(func)
-        return self
-
-    def remove(self, func):
-
-        """Remove existing event handler function.
-
-        You can remove handler also by using '-=' operator.
-        """
-
-        self._getfunctionlist().remove(func)
-        return self
-
-    def fire(self, earg=None):
-
-        """Fire event and call all handler functions
-
-        You can call EventHandler object itself like e(earg) instead of
-        e.fire(earg).
-        """
-
-        for func in self._getfunctionlist():
-            func(self.obj, earg)
-
-    __iadd__ = add
-    __isub__ = remove
-    __call__ = fire
+RegistryEvent = BGAPIEvent
 
 class ClientRegistry(object):
     onClientRemoved = RegistryEvent()
@@ -90,30 +32,69 @@ class ClientRegistry(object):
     def __init__(self,collectionPointConfig,loggingQueue):
         # Logger
         self.loggingQueue = loggingQueue
-        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.logger = ModuleLogger(loggingQueue, __name__, collectionPointConfig)
 
-        self.rClients = {}  #registered clients
+        self.rClients = {}  #registered clients by raw MAC
         self.collectionPointConfig = collectionPointConfig
+        self.filterBank = FilterBank()  #filter state of every client
+        # config, logger and uid map shared by every client
+        self.clientContext = ClientContext(
+            collectionPointConfig,
+            loggingQueue,
+            self.filterBank)
+
+        # the device thread registers clients while the
+        # sweep runs on its own timer thread
+        self.lock = RLock()
+
+        # expiry index, heap of (deadline, sequence, client).
+        # a client is pushed once when it enters the registry,
+        # updates only move client.lastSeen and the entry is
+        # pushed back with the real deadline when it comes up
+        self._expiryHeap = []
+        self._expirySequence = count()
+        self._clientTimeout = collectionPointConfig['AbandonedClientTimeout']/1000
+
+        # nearby clients at the last getUpdateDelta call
+        self._lastNearby = {}
 
     def getAll(self, thresh=-68):
         """
         Get registered clients as dict
         Only return clients above thresh RSSI
         """
-        toret = {}
-        for k, v in self.rClients.items():
-            xdata = v.getExtendedDataForEvent()
-            if xdata['rssi']>thresh:
-                toret[k] = xdata
-        return toret
+        with self.lock:
+            clients = [v for v in self.rClients.values() if v.rssi>thresh]
+        # event data is cached per client until its next sample
+        return {v.mac: v.getExtendedDataForEvent() for v in clients}
 
     def getUpdateData(self, thresh=-68):
         return {'nearby': self.getAll(thresh)}
 
+    def getUpdateDelta(self, thresh=-68):
+        """
+        Clients that entered, changed or left the nearby
+        set since the previous call. A client changed when
+        its cached event data was rebuilt.
+        """
+        nearby = self.getAll(thresh)
+        previous = self._lastNearby
+        self._lastNearby = nearby
+        entered = {}
+        changed = {}
+        for mac, xdata in nearby.items():
+            prevData = previous.get(mac)
+            if prevData is None:
+                entered[mac] = xdata
+            elif prevData is not xdata:
+                changed[mac] = xdata
+        left = [mac for mac in previous if mac not in nearby]
+        return {'entered': entered, 'changed': changed, 'left': left}
+
     def getClient(self,mac):
         """
-        Get an existing registered client by mac 
-        and if its found return it. 
+        Get an existing registered client by raw mac
+        bytes and if its found return it. 
         If no existing registered client is found 
         return None.
         """
@@ -132,45 +113,124 @@ class ClientRegistry(object):
         Returns a list of removed clients.
         """
         self.logger.debug("*** Sweeping clients existing count" +
-            " %s***"%len(self.rClients))
-
-        clientsToBeRemoved=[] #list of clients to be cleaned up
+            " %s***", len(self.rClients))
 
-        clientTimeout = self.collectionPointConfig['AbandonedClientTimeout']
-        now = datetime.now()
-
-        for mac in self.rClients:
-            regClient = self.rClients[mac]
-
-            # self.logger.debug('now-regClient.lastRegisteredTime ---- clientTimeout >0 : %s ---- %s'%(((now-regClient.lastRegisteredTime).total_seconds()*1000), clientTimeout))
-            # if regClient.sweepShouldSendClientOutEvent():
-            if (now-regClient.lastRegisteredTime).total_seconds()*1000-clientTimeout>0:
-                clientsToBeRemoved.append(regClient)
+        clientsToBeRemoved = self.popExpiredClients(time.monotonic())
 
         for client in clientsToBeRemoved:
             # self.logger.debug("Client sweep removing mac %s"%client.getMac())
-            self.removeClient(client)
+            self.clientRemoved(client)
 
         self.logger.debug("*** End of sweeping tags existing count "+
-            "%s***"%len(self.rClients))
+            "%s***", len(self.rClients))
 
         self.onSweepComplete(clientsToBeRemoved)
 
         return clientsToBeRemoved
 
+    def popExpiredClients(self, now):
+        """
+        Take clients not seen for AbandonedClientTimeout
+        out of the registry. Only clients at the top
+        of the expiry heap are looked at.
+        """
+        expired = []
+        heap = self._expiryHeap
+        with self.lock:
+            while heap and heap[0][0] <= now:
+                deadline, sequence, client = heapq.heappop(heap)
+                if self.rClients.get(client.address) is not client:
+                    # removed or replaced since it was pushed
+                    continue
+                deadline = client.lastSeen + self._clientTimeout
+                if deadline > now:
+                    # seen again, push back with the real deadline
+                    heapq.heappush(heap, (deadline, next(self._expirySequence), client))
+                    continue
+                del self.rClients[client.address]
+                expired.append(client)
+        return expired
+
+    def _track(self, client):
+        """ Add client to the registry, called with the lock held. """
+        address = client.address
+        if self.rClients.get(address) is not client:
+            self.rClients[address] = client
+            heapq.heappush(self._expiryHeap, (
+                client.lastSeen + self._clientTimeout,
+                next(self._expirySequence),
+                client))
+
     def addClient(self,client):
         #self.logger.debug("in addNewRegisteredClient with %s"%client.getUdid())
-        self.rClients[client.getMac()] = client
+        with self.lock:
+            self._track(client)
         self.onClientAdded(client)
 
     def updateClient(self,client):
         #self.logger.debug("in updateRegisteredClient with %s"%client.getUdid())
-        self.rClients[client.getMac()] = client
+        with self.lock:
+            self._track(client)
         self.onClientUpdated(client)
 
     def removeClient(self,client):
         #self.logger.debug("in removeRegisteredClient with %s"%client.getUdid())
-        self.logger.info('length before remove: %s'%len(self.rClients))
-        self.rClients.pop(client.getMac())
-        self.logger.info('length after remove: %s'%len(self.rClients))
+        with self.lock:
+            self.logger.info('length before remove: %s', len(self.rClients))
+            self.rClients.pop(client.address)
+            self.logger.info('length after remove: %s', len(self.rClients))
+        self.clientRemoved(client)
+
+    def saveState(self, path):
+        """
+        Write every client to path for loadState. The file
+        is replaced in one go, a crash never leaves half of it.
+        Returns the number of clients saved.
+        """
+        now = time.monotonic_ns()
+        with self.lock:
+            clients = list(self.rClients.values())
+            # the wall clock tells loadState how long we were gone,
+            # monotonic times do not survive a reboot
+            state = {
+                'savedAt': time.time_ns(),
+                'clients': [client.getSavedState(now) for client in clients]
+                }
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp, path)
+        return len(clients)
+
+    def loadState(self, path, accept=None):
+        """
+        Add the clients saved to path by saveState, without firing
+        onClientAdded, so their in/out messages carry on where they
+        left off. Clients that would have been abandoned by now and,
+        when given, those accept(address) is false for are skipped.
+        Returns the number of clients loaded.
+        """
+        with open(path) as f:
+            state = json.load(f)
+        # time since the save, as if the clock kept running while we were down
+        downTime = max(0, time.time_ns() - state['savedAt'])
+        savedAt = time.monotonic_ns() - downTime
+        timeout = self._clientTimeout*1000000000
+        loaded = 0
+        with self.lock:
+            for saved in state['clients']:
+                if saved['lastRegisteredAge'] + downTime > timeout:
+                    continue
+                if accept is not None and not accept(bytes.fromhex(saved['address'])):
+                    continue
+                self._track(BtleClient.fromSavedState(saved, savedAt, self.clientContext))
+                loaded += 1
+        return loaded
+
+    def clientRemoved(self, client):
+        """ Fire onClientRemoved and free the client's filter slot. """
         self.onClientRemoved(client)
+        # handlers may have put the client back
+        with self.lock:
+            if self.rClients.get(client.address) is not client:
+                client.filter.release()
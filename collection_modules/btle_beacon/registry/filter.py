@@ -1,56 +1,237 @@
 """
 Filter
 Kalman filter implementation.
+
+Filter.update used to run a pykalman KalmanFilter over the last six
+measurements, starting from the same initial state every time, and then
+filter_update once more with the newest measurement. The gains of that
+sequence only depend on how many measurements are in the window, so the
+filtered state is a fixed weighted sum of the window. FilterBank keeps the
+window of every client in NumPy arrays and applies those weights, which
+gives the same state with O(1) work per sample and no pykalman object per
+client.
 """
 
-from pykalman import KalmanFilter
+from threading import RLock
+import numpy as np
+
+# pykalman defaults used by the previous implementation
+_TRANSITION_COVARIANCE = 1.0
+_OBSERVATION_COVARIANCE = 0.8
+_INITIAL_STATE_COVARIANCE = 1.0
+# the initial state mean is 0 so it adds nothing to the weighted sum
+
+# number of measurements the filter runs over
+WINDOW_SIZE = 6
+
+def _windowWeights(n):
+	"""
+	Weights, oldest measurement first, and covariance of the filtered
+	state for a window of n measurements.
+	"""
+	weights = []
+	covariance = _INITIAL_STATE_COVARIANCE
+	predicted = covariance
+	# filter over the window, then filter_update with the newest measurement
+	for step in range(n + 1):
+		if step > 0:
+			predicted = covariance + _TRANSITION_COVARIANCE
+		gain = predicted / (predicted + _OBSERVATION_COVARIANCE)
+		weights = [w * (1 - gain) for w in weights]
+		if step < n:
+			weights.append(gain)
+		else:
+			weights[-1] += gain
+		covariance = (1 - gain) * predicted
+	return weights, covariance
+
+def _buildTables():
+	""" Right aligned weights and covariances for every window length. """
+	weights = np.zeros((WINDOW_SIZE + 1, WINDOW_SIZE))
+	covariances = [None]
+	for n in range(1, WINDOW_SIZE + 1):
+		w, covariance = _windowWeights(n)
+		weights[n, WINDOW_SIZE - n:] = w
+		covariances.append(covariance)
+	return weights, covariances
+
+_WEIGHTS, _COVARIANCES = _buildTables()
+
+class FilterBank(object):
+	"""
+	Filter state for many clients, one slot per client.
+	Windows are right aligned, newest measurement last.
+
+	The registering thread queues updates in a batch while the
+	scheduler, the sweep and state saves read states, so the arrays
+	and the queue are only touched with the lock held.
+	"""
+
+	def __init__(self, capacity=256):
+		self.lock = RLock()
+		self.windows = np.zeros((capacity, WINDOW_SIZE))
+		self.counts = np.zeros(capacity, dtype=np.intp)
+		self.states = np.zeros(capacity)
+		self.freeSlots = list(range(capacity - 1, -1, -1))
+		self.pendingSlots = []
+		self.pendingRssi = []
+		# open batches, updates are queued while above 0
+		self.batching = 0
+
+	def allocate(self, first_obs):
+		""" Take a slot for a new client, return its index. """
+		with self.lock:
+			if not self.freeSlots:
+				self.grow()
+			slot = self.freeSlots.pop()
+			self.windows[slot] = 0
+			self.windows[slot, -1] = first_obs
+			self.counts[slot] = 1
+			self.states[slot] = first_obs
+		return slot
+
+	def release(self, slot):
+		with self.lock:
+			# queued samples of the slot go to its old client, not
+			# to the next one allocate hands the slot to
+			self.flush()
+			self.freeSlots.append(slot)
+
+	def grow(self):
+		""" Double the capacity, called with the lock held. """
+		capacity = len(self.states)
+		self.windows = np.concatenate((self.windows, np.zeros((capacity, WINDOW_SIZE))))
+		self.counts = np.concatenate((self.counts, np.zeros(capacity, dtype=np.intp)))
+		self.states = np.concatenate((self.states, np.zeros(capacity)))
+		self.freeSlots.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+	def update(self, slot, rssi):
+		""" Add a measurement for one client, return its filtered state. """
+		with self.lock:
+			if self.batching:
+				self.pendingSlots.append(slot)
+				self.pendingRssi.append(rssi)
+				return None
+			window = self.windows[slot]
+			window[:-1] = window[1:]
+			window[-1] = rssi
+			n = min(self.counts[slot] + 1, WINDOW_SIZE)
+			self.counts[slot] = n
+			state = float(window.dot(_WEIGHTS[n]))
+			self.states[slot] = state
+			return state
+
+	def updateMany(self, slots, rssis):
+		""" Add measurements for many clients at once. """
+		slots = np.asarray(slots, dtype=np.intp)
+		rssis = np.asarray(rssis, dtype=float)
+		with self.lock:
+			# a slot can only be shifted once per pass, so repeated
+			# slots are applied in order over following passes
+			while len(slots):
+				unique, first = np.unique(slots, return_index=True)
+				windows = self.windows[unique]
+				windows[:, :-1] = windows[:, 1:]
+				windows[:, -1] = rssis[first]
+				counts = np.minimum(self.counts[unique] + 1, WINDOW_SIZE)
+				self.windows[unique] = windows
+				self.counts[unique] = counts
+				self.states[unique] = np.einsum('ij,ij->i', windows, _WEIGHTS[counts])
+				rest = np.ones(len(slots), dtype=bool)
+				rest[first] = False
+				slots = slots[rest]
+				rssis = rssis[rest]
+
+	def beginBatch(self):
+		""" Queue updates until endBatch, then apply them together. """
+		with self.lock:
+			self.batching += 1
+
+	def endBatch(self):
+		with self.lock:
+			self.batching -= 1
+			if not self.batching:
+				self.flush()
+
+	def flush(self):
+		with self.lock:
+			if self.pendingSlots:
+				slots, rssis = self.pendingSlots, self.pendingRssi
+				self.pendingSlots, self.pendingRssi = [], []
+				self.updateMany(slots, rssis)
+
+	def state(self, slot):
+		with self.lock:
+			self.flush()
+			return float(self.states[slot])
+
+	def covariance(self, slot):
+		with self.lock:
+			self.flush()
+			return _COVARIANCES[self.counts[slot]]
+
+	def window(self, slot):
+		""" Measurements of a slot, oldest first. """
+		with self.lock:
+			self.flush()
+			n = int(self.counts[slot])
+			return self.windows[slot, WINDOW_SIZE - n:].tolist()
+
+	def restore(self, slot, window):
+		""" Put back measurements taken from window. """
+		window = window[-WINDOW_SIZE:]
+		n = len(window)
+		with self.lock:
+			self.windows[slot] = 0
+			self.windows[slot, WINDOW_SIZE - n:] = window
+			self.counts[slot] = n
+			self.states[slot] = float(self.windows[slot].dot(_WEIGHTS[n]))
+
+_defaultBank = None
+
+def defaultBank():
+	""" Bank used by filters created without one. """
+	global _defaultBank
+	if _defaultBank is None:
+		_defaultBank = FilterBank()
+	return _defaultBank
 
 class Filter(object):
-	def __init__(self, first_obs):
-		self.transition_covariance = 0.8
-		self.observation_covariance = 0.8
-
-		self.state = first_obs
-		self.measurements = [first_obs]
-		self.covariance = None
-
-		self.transition_matrices = [0.8]
-		self.observation_matrices = [0.8]
-		self.initial_state_mean = [first_obs]
-		self.kf = KalmanFilter(
-			# self.transition_matrices, 
-			# observation_matrices=self.observation_matrices,
-			initial_state_mean=0,
-			n_dim_state=1,
-			# self.transition_covariance,
-			observation_covariance=self.observation_covariance)
-
-		# self.state, self.covariance = self.kf.filter(self.measurements)
-		# self.state = self.state[0]
-		# self.covariance = self.covariance[0][0]
+	""" Filter for one client, backed by a slot in a FilterBank. """
+
+	__slots__ = ('bank', 'slot')
+
+	def __init__(self, first_obs, bank=None):
+		self.bank = bank if bank is not None else defaultBank()
+		self.slot = self.bank.allocate(first_obs)
+
+	@property
+	def state(self):
+		return self.bank.state(self.slot)
+
+	@property
+	def covariance(self):
+		return self.bank.covariance(self.slot)
+
+	@property
+	def window(self):
+		return self.bank.window(self.slot)
+
+	@classmethod
+	def fromWindow(cls, window, bank=None):
+		""" Filter continuing from a saved window. """
+		instance = cls(window[-1], bank)
+		instance.bank.restore(instance.slot, window)
+		return instance
 
 	def update(self, rssi):
-		# self.state = self.kf.filter([rssi])[0][0][0]
-		self.measurements = self.measurements[-5:]
-		self.measurements.append(rssi)
-		means, covariances = self.kf.filter(self.measurements)
-
-		self.state, self.covariance = self.kf.filter_update(
-    		means[-1], covariances[-1], [rssi])
-		self.state = self.state[0]
-		self.covariance = self.covariance[0][0]
-
-	# def update(self, rssi):
-	# 	self.state, self.covariance = self.kf.filter_update(
- #    		[self.state], [self.covariance], [rssi])
-	# 	try:
-	# 		self.state = self.state[0][0]
-	# 	except:
-	# 		self.state = self.state[0]
-	# 	self.covariance = self.covariance[0][0]
-
-	def transition_function(self):
-		return
-
-	def observation_functions(self):
-		return
\ No newline at end of file
+		if self.slot is None:
+			# released while a detection was in flight, start over
+			self.slot = self.bank.allocate(rssi)
+		self.bank.update(self.slot, rssi)
+
+	def release(self):
+		""" Give the slot back to the bank once the client is gone. """
+		if self.slot is not None:
+			self.bank.release(self.slot)
+			self.slot = None
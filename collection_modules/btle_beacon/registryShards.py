@@ -0,0 +1,332 @@
+"""
+Registry shards
+Splits the client registry over worker processes by MAC.
+
+Each RegistryShard process owns a ClientRegistry and EventManager
+for the MACs hashed to it, so registry updates, filtering and the
+in/out state machine run on as many cores as there are shards.
+ShardedRegistry in the collection point process hands detections
+to the shards, forwards their client_in and client_out messages to
+the outbound queue and merges their nearby lists into one
+btle_update_nearby message.
+
+Detections go to the shards as packed records, one bytes object per
+shard and batch, so the parent neither pickles nor routes them one by
+one: the batch is packed once and split by MAC with NumPy.
+"""
+
+from simplesensor.shared import Message, ThreadsafeLogger
+from .registry import ClientRegistry
+from .registry.clientRegistry import RegistryEvent
+from .eventManager import EventManager
+from .scheduler import Scheduler
+from .devices import DetectionData
+from multiprocessing import Process, Queue
+from threading import Thread, Condition, Lock
+from datetime import datetime
+import numpy as np
+import queue
+import struct
+
+_UPDATE_TOPIC = 'btle_update_nearby'
+
+# items on a shard's detection queue besides lists of detections
+_STOP = None
+_SYNC = 'sync'
+
+# items on the result queue besides messages
+_NEARBY = 'nearby'
+_SYNCED = 'synced'
+_REMOVED = 'removed'
+
+# DetectionData fields with the device id as an index in the batch's
+# device list, the raw MAC and 2 zero bytes read as the little endian
+# mac field the shard is picked by
+_RECORD = struct.Struct('<6s2x16sHHbbHqIbb2xd')
+_RECORD_DTYPE = np.dtype([
+    ('mac', '<u8'), ('uuid', 'V16'), ('major', '<u2'), ('minor', '<u2'),
+    ('tx', 'i1'), ('rssi', 'i1'), ('device', '<u2'), ('timestamp', '<i8'),
+    ('count', '<u4'), ('rssiMin', 'i1'), ('rssiMax', 'i1'), ('pad', 'V2'),
+    ('rssiMean', '<f8')])
+assert _RECORD.size == _RECORD_DTYPE.itemsize
+
+def packBatch(detectedDatas, shards):
+    """
+    Pack a batch of detections and split it by shard.
+    Returns the device id list and the packed records of
+    each shard, None for shards with nothing to do.
+    """
+    deviceIds = {}
+    pack = _RECORD.pack
+    data = b''.join([pack(mac, uuid, major, minor, tx, rssi,
+            deviceIds.setdefault(deviceId, len(deviceIds)),
+            timestamp, count, rssiMin, rssiMax, rssiMean)
+        for (mac, uuid, major, minor, tx, rssi, timestamp,
+            deviceId, count, rssiMin, rssiMax, rssiMean) in detectedDatas])
+    records = np.frombuffer(data, dtype=_RECORD_DTYPE)
+    if shards == 1:
+        return tuple(deviceIds), [data]
+    index = records['mac'] % shards
+    parts = []
+    for shard in range(shards):
+        part = records[index == shard]
+        parts.append(part.tobytes() if len(part) else None)
+    return tuple(deviceIds), parts
+
+def unpackBatch(deviceIds, data):
+    """ Detections of packed records. """
+    fromFields = DetectionData.fromFields
+    # a single sample's mean is its int rssi, as the device thread makes it
+    return [fromFields((mac, uuid, major, minor, tx, rssi, timestamp,
+            deviceIds[device], count, rssiMin, rssiMax,
+            rssi if count == 1 else rssiMean))
+        for (mac, uuid, major, minor, tx, rssi, device, timestamp,
+            count, rssiMin, rssiMax, rssiMean) in _RECORD.iter_unpack(data)]
+
+class RegistryShard(Process):
+    """
+    Worker process owning the registry partition of one shard.
+    client_in/client_out messages and the shard's nearby list
+    go back to the parent on the result queue.
+    """
+
+    def __init__(self, index, shards, moduleConfig, detectionQueue, resultQueue, loggingQueue):
+        super().__init__(daemon=True)
+        self.index = index
+        self.shards = shards
+        # the shard only sends its nearby list, the parent builds the update
+        self.moduleConfig = dict(moduleConfig, UpdateMode='full')
+        self.detectionQueue = detectionQueue
+        self.resultQueue = resultQueue
+        self.loggingQueue = loggingQueue
+        # each shard saves its own clients
+        self.stateFile = None
+        if moduleConfig['RegistryStateFile']:
+            self.stateFile = '%s.%i'%(moduleConfig['RegistryStateFile'], index)
+
+    def run(self):
+        self.logger = logger = ThreadsafeLogger(self.loggingQueue, "%s-%i"%(__name__, self.index))
+        self.clientRegistry = ClientRegistry(self.moduleConfig, self.loggingQueue)
+        self.eventManager = EventManager(
+            self.moduleConfig,
+            self.resultQueue,
+            self.clientRegistry,
+            self.loggingQueue)
+        if self.stateFile:
+            self.loadState()
+        # the parent takes dropped clients out of the dongle whitelists
+        if self.moduleConfig['BtleWhitelistEnabled']:
+            self.clientRegistry.onClientRemoved += self.clientRemoved
+        # nearby list of the last send
+        self.lastNearby = {}
+
+        scheduler = Scheduler(self.loggingQueue)
+        scheduler.addJob(
+            'sweepOldClients',
+            min(self.moduleConfig['AbandonedClientCleanupInterval'],
+                self.moduleConfig['AbandonedClientSweepTolerance'])/1000,
+            self.clientRegistry.sweepOldClients)
+        if self.moduleConfig['SendUpdateMessages']:
+            scheduler.addJob(
+                'sendNearby',
+                1/self.moduleConfig['UpdateFPS'],
+                self.sendNearby)
+        if self.stateFile:
+            scheduler.addJob(
+                'saveRegistryState',
+                self.moduleConfig['RegistryStateInterval']/1000,
+                self.saveState)
+        scheduler.start()
+
+        logger.info("Registry shard %i started"%self.index)
+        while True:
+            item = self.detectionQueue.get()
+            if item is _STOP:
+                break
+            if item == _SYNC:
+                self.resultQueue.put((_SYNCED, self.index, len(self.clientRegistry.rClients)))
+                continue
+            try:
+                self.eventManager.registerClients(unpackBatch(*item))
+            except Exception as e:
+                logger.error("Unable to register detections: %s"%e)
+
+        scheduler.stop()
+        if self.stateFile:
+            self.saveState()
+        self.eventManager.stop()
+        logger.info("Registry shard %i stopped"%self.index)
+
+    def loadState(self):
+        """ Clients of this shard, with the shard count they were saved with or not. """
+        shards, index = self.shards, self.index
+        try:
+            loaded = self.clientRegistry.loadState(self.stateFile,
+                lambda address: int.from_bytes(address, 'little') % shards == index)
+            self.logger.info("Restored %i clients from %s"%(loaded, self.stateFile))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.error("Unable to restore clients from %s: %s"%(self.stateFile, e))
+
+    def saveState(self):
+        try:
+            self.clientRegistry.saveState(self.stateFile)
+        except Exception as e:
+            self.logger.error("Unable to save clients to %s: %s"%(self.stateFile, e))
+
+    def clientRemoved(self, sender, client):
+        self.resultQueue.put((_REMOVED, self.index, client.address))
+
+    def sendNearby(self):
+        """
+        Send the nearby list and the MACs that changed since the
+        last send, those whose cached event data was rebuilt, as
+        ClientRegistry.getUpdateDelta does. The copies the parent
+        gets are new dicts every time and tell it nothing.
+        """
+        data = self.eventManager.getUpdateData()
+        nearby = data['nearby'] if data else {}
+        previous = self.lastNearby
+        self.lastNearby = nearby
+        changed = [mac for mac, xdata in nearby.items()
+            if mac in previous and previous[mac] is not xdata]
+        self.resultQueue.put((_NEARBY, self.index, (nearby, changed)))
+
+class ShardedRegistry(object):
+    """
+    Runs RegistryShard processes and stands in for the
+    EventManager of the collection point.
+
+    onClientRemoved fires with the raw MAC of every client a
+    shard dropped, on the thread forwarding the shard results,
+    when the whitelist is enabled.
+    """
+    onClientRemoved = RegistryEvent()
+
+    def __init__(self, moduleConfig, outBoundQueue, loggingQueue, shards):
+        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.moduleConfig = moduleConfig
+        self.outBoundEventQueue = outBoundQueue
+        self.shards = shards
+        self.alive = True
+
+        self._updateDelta = moduleConfig['UpdateMode'] == 'delta'
+        self._lastNearby = {}
+        # latest nearby list of each shard
+        self.partials = [{} for _ in range(shards)]
+        # MACs the shards reported changed since the last update
+        self._changed = set()
+        self._changedLock = Lock()
+
+        self.resultQueue = Queue()
+        self.detectionQueues = [Queue() for _ in range(shards)]
+        self.processes = [
+            RegistryShard(i, shards, moduleConfig, self.detectionQueues[i], self.resultQueue, loggingQueue)
+            for i in range(shards)]
+
+        self._synced = {}
+        self._syncCondition = Condition()
+        self.forwardThread = Thread(target=self.forwardResults, daemon=True)
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self.forwardThread.start()
+
+    def registerClients(self, detectedDatas):
+        """
+        Send each shard its part of the batch,
+        a MAC always goes to the same shard.
+        """
+        if not detectedDatas:
+            return
+        deviceIds, parts = packBatch(detectedDatas, self.shards)
+        for detectionQueue, part in zip(self.detectionQueues, parts):
+            if part:
+                detectionQueue.put((deviceIds, part))
+
+    def registerDetectedClient(self, detectedData):
+        self.registerClients((detectedData,))
+
+    def forwardResults(self):
+        """ Move shard messages to the outbound queue, keep nearby lists. """
+        while self.alive:
+            try:
+                item = self.resultQueue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if isinstance(item, tuple):
+                kind, index, value = item
+                if kind == _NEARBY:
+                    self.partials[index], changed = value
+                    if changed:
+                        with self._changedLock:
+                            self._changed.update(changed)
+                elif kind == _REMOVED:
+                    self.onClientRemoved(value)
+                elif kind == _SYNCED:
+                    with self._syncCondition:
+                        self._synced[index] = value
+                        self._syncCondition.notify_all()
+            else:
+                self.outBoundEventQueue.put(item)
+
+    def sync(self, timeout=None):
+        """
+        Wait until every shard has handled the detections sent
+        so far. Returns the number of clients in each shard, or
+        None on timeout.
+        """
+        with self._syncCondition:
+            self._synced = {}
+        for detectionQueue in self.detectionQueues:
+            detectionQueue.put(_SYNC)
+        with self._syncCondition:
+            if not self._syncCondition.wait_for(
+                lambda: len(self._synced) == self.shards, timeout):
+                return None
+            return [self._synced[i] for i in range(self.shards)]
+
+    def getUpdateData(self):
+        """ Merged nearby lists, or None when there is nothing to send. """
+        nearby = {}
+        for partial in self.partials:
+            nearby.update(partial)
+        if self._updateDelta:
+            previous = self._lastNearby
+            self._lastNearby = nearby
+            with self._changedLock:
+                changed, self._changed = self._changed, set()
+            data = {
+                'entered': {mac: xdata for mac, xdata in nearby.items() if mac not in previous},
+                'changed': {mac: nearby[mac] for mac in changed
+                    if mac in nearby and mac in previous},
+                'left': [mac for mac in previous if mac not in nearby]
+                }
+            if not (data['entered'] or data['changed'] or data['left']): return None
+            return data
+        if len(nearby) == 0: return None
+        return {'nearby': nearby}
+
+    def publishUpdate(self):
+        """ Send the merged update message, run by the scheduler. """
+        if not self.alive: return
+        data = self.getUpdateData()
+        if data is None: return
+        self.outBoundEventQueue.put(Message(
+            topic=_UPDATE_TOPIC,
+            sender_id=self.moduleConfig['CollectionPointId'],
+            sender_type=self.moduleConfig['GatewayType'],
+            extended_data=data,
+            timestamp=datetime.now()))
+
+    def stop(self, timeout=5):
+        for detectionQueue in self.detectionQueues:
+            detectionQueue.put(_STOP)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                self.logger.info('Terminating registry shard: %s'%process)
+                process.terminate()
+        self.alive = False
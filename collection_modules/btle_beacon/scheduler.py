@@ -0,0 +1,131 @@
+"""
+Scheduler
+One thread running the module's periodic jobs.
+
+Jobs run at a fixed rate on deadlines taken from time.monotonic,
+the next deadline is the previous deadline plus the interval so
+the time a job takes does not add up as drift. When a job runs
+past one or more of its next deadlines those runs are skipped and
+counted as overruns.
+"""
+
+from simplesensor.shared import ThreadsafeLogger
+from threading import Thread, Condition
+from itertools import count
+import heapq
+import time
+
+class ScheduledJob(object):
+    """ A periodic job and its run counters. """
+
+    def __init__(self, name, interval, function, args):
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.deadline = None
+        self.cancelled = False
+
+        # Counters
+        self.runs = 0
+        self.overruns = 0
+        self.errors = 0
+
+    def getStats(self):
+        return {
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'errors': self.errors
+            }
+
+class Scheduler(Thread):
+
+    def __init__(self, loggingQueue):
+        super().__init__()
+        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.alive = True
+        self.condition = Condition()
+        self.jobs = []
+        # heap of (deadline, sequence, job)
+        self._heap = []
+        self._sequence = count()
+
+    def addJob(self, name, interval, function, *args):
+        """
+        Run function(*args) every interval seconds,
+        first run one interval from now.
+        """
+        job = ScheduledJob(name, interval, function, args)
+        job.deadline = time.monotonic() + interval
+        with self.condition:
+            self.jobs.append(job)
+            heapq.heappush(self._heap, (job.deadline, next(self._sequence), job))
+            self.condition.notify()
+        return job
+
+    def cancelJob(self, job):
+        """ The job is dropped from the heap when it next comes up. """
+        with self.condition:
+            job.cancelled = True
+            if job in self.jobs:
+                self.jobs.remove(job)
+
+    def run(self):
+        while self.alive:
+            job = self.nextDueJob()
+            if job is None:
+                continue
+            try:
+                job.function(*job.args)
+            except Exception as e:
+                job.errors += 1
+                self.logger.error("Scheduled job %s failed: %s"%(job.name, e))
+            job.runs += 1
+            self.reschedule(job)
+
+    def nextDueJob(self):
+        """
+        Wait for the earliest deadline and pop its job.
+        Returns None when woken up early or stopped.
+        """
+        with self.condition:
+            if not self._heap:
+                self.condition.wait()
+                return None
+            deadline, sequence, job = self._heap[0]
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                self.condition.wait(wait)
+                return None
+            heapq.heappop(self._heap)
+            if job.cancelled:
+                return None
+            return job
+
+    def reschedule(self, job):
+        """ Push the job back at its next deadline on the fixed rate grid. """
+        deadline = job.deadline + job.interval
+        now = time.monotonic()
+        if deadline <= now:
+            missed = int((now - deadline)//job.interval) + 1
+            deadline += missed*job.interval
+            job.overruns += missed
+            if job.overruns == missed or job.overruns//100 > (job.overruns - missed)//100:
+                self.logger.warning("Scheduled job %s overran its interval, %s"%(
+                    job.name, job.getStats()))
+        job.deadline = deadline
+        with self.condition:
+            if not job.cancelled:
+                heapq.heappush(self._heap, (deadline, next(self._sequence), job))
+
+    def getStats(self):
+        """ Run counters of each job by name. """
+        with self.condition:
+            return {job.name: job.getStats() for job in self.jobs}
+
+    def stop(self):
+        """ Stop after the job that is running, if any. """
+        with self.condition:
+            self.alive = False
+            self.condition.notify_all()
+        self.logger.info("Scheduler stopped, jobs: %s"%self.getStats())
@@ -0,0 +1,49 @@
+"""
+TimeBase
+Monotonic nanosecond timestamps with one wall clock anchor.
+
+The registry keeps every time as an int from time.monotonic_ns(),
+so intervals are plain subtraction and NTP steps on the gateway
+do not move them. Wall clock times are only made when a message
+is serialized, from the anchor taken together with a monotonic
+reading, and the ISO strings are cached per timestamp.
+"""
+
+from datetime import datetime, timedelta
+from functools import lru_cache
+import time
+
+# re-read the wall clock this often, in ns, so
+# rendered times follow NTP corrections
+_ANCHOR_INTERVAL = 60*1000000000
+# ISO strings kept, first seen times are rendered
+# for every snapshot of a client
+_ISO_CACHE_SIZE = 65536
+
+class TimeBase(object):
+
+    def __init__(self):
+        self.anchor()
+        self.isoformat = lru_cache(maxsize=_ISO_CACHE_SIZE)(self._isoformat)
+
+    def anchor(self):
+        """ Pair the wall clock with the monotonic clock. """
+        # one attribute, so other threads never see half of it
+        self.anchorPair = (datetime.now(), time.monotonic_ns())
+
+    def toDatetime(self, ns):
+        """ Local wall clock datetime of a monotonic ns timestamp. """
+        anchorWall, anchorNs = self.anchorPair
+        if ns - anchorNs > _ANCHOR_INTERVAL:
+            self.anchor()
+            anchorWall, anchorNs = self.anchorPair
+        return anchorWall + timedelta(microseconds=(ns - anchorNs)//1000)
+
+    def _isoformat(self, ns):
+        return self.toDatetime(ns).isoformat()
+
+    def isoformatOrNone(self, ns):
+        return None if ns is None else self.isoformat(ns)
+
+# shared by everything in the process
+timeBase = TimeBase()
@@ -1,28 +1,148 @@
 """
 mapping id to industry for Adobe CEC project
+
+The table is keyed by the raw 16 byte UUID from the advertisement,
+so a sample costs one dict lookup. It is read from uid_map_file,
+a CSV of uuid,industry rows or a JSON object of uuid -> industry,
+or is the built in table below when no file is set. With
+uid_map_reload_interval a thread checks the file's modification
+time and swaps in the new table when it changed.
+
+Every registry and device thread of a process uses the same
+map, get it with sharedUIDMap.
 """
 
+from simplesensor.shared import ThreadsafeLogger
+from threading import Thread, Event, Lock
+import csv
+import json
+import os
+import re
+
+# what happens to samples of UUIDs not in the table
+KEEP = 'keep'
+TAG = 'tag'
+DROP = 'drop'
+UNMAPPED_POLICIES = (KEEP, TAG, DROP)
+# industry of unmapped UUIDs with the tag policy
+UNMAPPED_TAG = 'Unmapped'
+
+_BUILTIN_MAP = {
+    '00000000000000000000000000000001': 'Education',
+    '00000000000000000000000000000002': 'Media-and-Entertainment',
+    '00000000000000000000000000000003': 'FSI',
+    '00000000000000000000000000000004': 'Retail',
+    '00000000000000000000000000000005': 'Government',
+    '00000000000000000000000000000006': 'Healthcare',
+    '00000000000000000000000000000007': 'High-Tech',
+    '00000000000000000000000000000008': 'Manufacturing',
+    '00000000000000000000000000000009': 'Telco',
+    '00000000000000000000000000000010': 'Travel-and-Hospitality',
+    'A2FA7357C8CD4B9598FD9D091CE43337': 'Government'
+    }
+
+_NOT_HEX = re.compile(r'[\W_]+', re.UNICODE)
+
+# (path, reload interval, policy) -> UIDMap
+_shared = {}
+_sharedLock = Lock()
+
+def sharedUIDMap(moduleConfig, loggingQueue):
+    """ The process wide map for the configured file. """
+    key = (moduleConfig['UidMapFile'],
+        moduleConfig['UidMapReloadInterval'],
+        moduleConfig['UidMapUnmappedPolicy'])
+    with _sharedLock:
+        uidMap = _shared.get(key)
+        if uidMap is None:
+            uidMap = _shared[key] = UIDMap(*key, loggingQueue=loggingQueue)
+        return uidMap
+
+def parseUuid(uid):
+    """ Hex UUID, dashes and case ignored, to raw bytes. None if invalid. """
+    try:
+        uuid = bytes.fromhex(_NOT_HEX.sub('', uid))
+    except ValueError:
+        return None
+    return uuid if len(uuid) == 16 else None
+
 class UIDMap(object):
-	
-	""" Class to hold a dict of uid to object pairs. """
-	def __init__(self):
-		# Build dict of uid -> string pairs. Could be changed to map objects.
-		self.map = {
-			'00000000000000000000000000000001': 'Education',
-			'00000000000000000000000000000002': 'Media-and-Entertainment',
-			'00000000000000000000000000000003': 'FSI',
-			'00000000000000000000000000000004': 'Retail',
-			'00000000000000000000000000000005': 'Government',
-			'00000000000000000000000000000006': 'Healthcare',
-			'00000000000000000000000000000007': 'High-Tech',
-			'00000000000000000000000000000008': 'Manufacturing',
-			'00000000000000000000000000000009': 'Telco',
-			'00000000000000000000000000000010': 'Travel-and-Hospitality',
-			'A2FA7357C8CD4B9598FD9D091CE43337': 'Government' 
-		}
-
-	def get(self, uid):
-		try:
-			return self.map[uid]
-		except Exception as e:
-			return ''
\ No newline at end of file
+    """ Class to hold a dict of uid to object pairs. """
+
+    def __init__(self, path='', reloadInterval=0, unmappedPolicy=KEEP, loggingQueue=None):
+        if unmappedPolicy not in UNMAPPED_POLICIES:
+            raise ValueError("Unknown unmapped uid policy: %s"%unmappedPolicy)
+        self.logger = ThreadsafeLogger(loggingQueue, __name__)
+        self.path = path
+        self.unmappedPolicy = unmappedPolicy
+        self.dropUnmapped = unmappedPolicy == DROP
+        self.unmapped = UNMAPPED_TAG if unmappedPolicy == TAG else ''
+        self.mtime = None
+
+        # replaced whole on reload, readers never see half a table
+        if path:
+            self.mtime = os.stat(path).st_mtime_ns
+            self.map = self.load(path)
+            self.logger.info("Loaded %i uids from %s"%(len(self.map), path))
+        else:
+            self.map = self.parse(_BUILTIN_MAP.items(), 'built in map')
+
+        self.stopEvent = Event()
+        self.reloadInterval = reloadInterval/1000
+        if path and reloadInterval > 0:
+            Thread(target=self.watch, daemon=True).start()
+
+    def get(self, uuid):
+        """ Industry of a raw 16 byte UUID. """
+        return self.map.get(uuid, self.unmapped)
+
+    def __contains__(self, uuid):
+        return uuid in self.map
+
+    def __len__(self):
+        return len(self.map)
+
+    def load(self, path):
+        if path.lower().endswith('.json'):
+            with open(path) as f:
+                rows = json.load(f).items()
+        else:
+            with open(path, newline='') as f:
+                rows = [row for row in csv.reader(f) if row]
+            # header row
+            if rows and parseUuid(rows[0][0]) is None:
+                rows = rows[1:]
+        return self.parse(rows, path)
+
+    def parse(self, rows, source):
+        table = {}
+        for row in rows:
+            uid, industry = row[0], row[1] if len(row) > 1 else ''
+            uuid = parseUuid(uid)
+            if uuid is None:
+                self.logger.warning("Ignoring invalid uid in %s: %s"%(source, uid))
+                continue
+            table[uuid] = industry.strip()
+        return table
+
+    def reloadIfChanged(self):
+        """ Load the file again when it changed, keep the old table on errors. """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return False
+            table = self.load(self.path)
+        except Exception as e:
+            self.logger.error("Unable to reload uid map %s: %s"%(self.path, e))
+            return False
+        self.mtime = mtime
+        self.map = table
+        self.logger.info("Reloaded %i uids from %s"%(len(table), self.path))
+        return True
+
+    def watch(self):
+        while not self.stopEvent.wait(self.reloadInterval):
+            self.reloadIfChanged()
+
+    def stop(self):
+        self.stopEvent.set()